@@ -0,0 +1,168 @@
+""" Module for archiving raw bitcointalk HTML in compressed segments. """
+from contextlib import contextmanager
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Index record: entity, entity ID, offset, fetch time, segment, position, size
+indexRecord = struct.Struct("<16sqqqIQI")
+
+
+class Archive(object):
+
+    """Append-only store of compressed pages with a fixed-width index."""
+
+    def __init__(self, path, segmentSize=256*1024*1024, level=6):
+        """Open (or create) the archive in the given directory."""
+        """CAVEAT: Several processes may append to the same directory."""
+        self.path = path
+        self.segmentSize = segmentSize
+        self.level = level
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.maps = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Load the index, dropping a partial record left by a crash
+        indexPath = os.path.join(path, "index.dat")
+        self.index = open(indexPath, 'ab')
+        self.indexReader = open(indexPath, 'rb')
+        self.indexSize = 0
+        self.segment = 0
+        with self._fileLock():
+            size = os.path.getsize(indexPath)
+            if size % indexRecord.size != 0:
+                self.index.truncate(size - size % indexRecord.size)
+            self._catchUp()
+        self.segmentFile = open(self._segmentPath(self.segment), 'ab')
+        self.segmentFileNumber = self.segment
+
+    @contextmanager
+    def _fileLock(self):
+        """Hold the lock shared by every process appending to the archive."""
+        fcntl.flock(self.index.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.index.fileno(), fcntl.LOCK_UN)
+
+    def _catchUp(self):
+        """Load index records appended since the last look, e.g. by other
+        processes."""
+        self.indexReader.seek(self.indexSize)
+        data = self.indexReader.read()
+        data = data[:len(data) - len(data) % indexRecord.size]
+        for record in indexRecord.iter_unpack(data):
+            self._remember(*record)
+        self.indexSize += len(data)
+
+    def _segmentPath(self, segment):
+        """Path of a segment file."""
+        return os.path.join(self.path, "segment_{0:06d}.dat".format(segment))
+
+    def _remember(self, entity, entityId, offset, fetchTime, segment,
+                  position, length):
+        """Add an index record to the in-memory lookup."""
+        if isinstance(entity, bytes):
+            entity = entity.rstrip(b"\0").decode('ascii')
+        key = (entity, entityId, offset)
+        self.entries.setdefault(key, []).append(
+            (fetchTime, segment, position, length))
+        self.segment = max(self.segment, segment)
+
+    def append(self, entity, entityId, html, offset=0, fetchTime=None):
+        """Compress and store a page. Returns its fetch time."""
+        if fetchTime is None:
+            fetchTime = int(time.time())
+        blob = zlib.compress(html.encode('utf-8'), self.level)
+        with self.lock, self._fileLock():
+            # Other processes may have appended or moved on to a new segment
+            self._catchUp()
+            if self.segmentFileNumber != self.segment:
+                self.segmentFile.close()
+                self.segmentFile = open(self._segmentPath(self.segment), 'ab')
+                self.segmentFileNumber = self.segment
+            position = self.segmentFile.seek(0, os.SEEK_END)
+            if position > 0 and position + len(blob) > self.segmentSize:
+                self.segmentFile.close()
+                self.segment += 1
+                self.segmentFile = open(self._segmentPath(self.segment), 'ab')
+                self.segmentFileNumber = self.segment
+                position = self.segmentFile.seek(0, os.SEEK_END)
+            self.segmentFile.write(blob)
+            self.segmentFile.flush()
+            # Only index the page once its bytes are on disk
+            record = indexRecord.pack(
+                entity.encode('ascii'), entityId, offset, fetchTime,
+                self.segment, position, len(blob))
+            self.index.write(record)
+            self.index.flush()
+            self.indexSize += len(record)
+            self._remember(entity, entityId, offset, fetchTime,
+                           self.segment, position, len(blob))
+        return fetchTime
+
+    def refresh(self):
+        """Pick up pages other processes appended since the last look."""
+        with self.lock, self._fileLock():
+            self._catchUp()
+
+    def _read(self, segment, position, length):
+        """Read a stored page through a memory map of its segment."""
+        with self.lock:
+            pageMap = self.maps.get(segment)
+            if pageMap is None or len(pageMap) < position + length:
+                if pageMap is not None:
+                    pageMap.close()
+                f = open(self._segmentPath(segment), 'rb')
+                pageMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                f.close()
+                self.maps[segment] = pageMap
+            blob = pageMap[position:position + length]
+        return zlib.decompress(blob).decode('utf-8')
+
+    def versions(self, entity, entityId, offset=0):
+        """List the fetch times stored for a page, oldest first."""
+        return sorted(entry[0] for entry in self.entries.get(
+            (entity, entityId, offset), []))
+
+    def get(self, entity, entityId, offset=0, fetchTime=None):
+        """Pull a page, by default its most recent fetch."""
+        entries = self.entries.get((entity, entityId, offset))
+        if not entries:
+            self.refresh()
+            entries = self.entries.get((entity, entityId, offset))
+        if not entries:
+            raise KeyError((entity, entityId, offset))
+        if fetchTime is None:
+            entry = max(entries)
+        else:
+            matches = [e for e in entries if e[0] == fetchTime]
+            if len(matches) == 0:
+                raise KeyError((entity, entityId, offset, fetchTime))
+            entry = matches[-1]
+        return self._read(*entry[1:])
+
+    def keys(self):
+        """Iterate over (entity, entity ID, offset, fetch time) of all pages."""
+        for (entity, entityId, offset), entries in self.entries.items():
+            for entry in entries:
+                yield (entity, entityId, offset, entry[0])
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+    def close(self):
+        """Close the segment, index and any memory maps."""
+        with self.lock:
+            for pageMap in self.maps.values():
+                pageMap.close()
+            self.maps = {}
+            self.segmentFile.close()
+            self.indexReader.close()
+            self.index.close()
@@ -0,0 +1,163 @@
+""" Offline micro-benchmark for the bitcointalk parsers. """
+import argparse
+import bitcointalk
+import codecs
+from datetime import date
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# Fixtures to benchmark, relative to this directory, by parser
+fixtures = {
+    'parseBoardPage': [
+        "dummy/dummy_board_1.html",
+        "dummy/dummy_board_2.html",
+        "data/test_dummy_board_1.html",
+        "data/test_dummy_board_2.html"
+    ],
+    'parseProfile': [
+        "dummy/dummy_profile.html",
+        "data/test_dummy_profile.html"
+    ],
+    'parseTopicPage': [
+        "dummy/dummy_topic.html",
+        "dummy/dummy_topic_2.html",
+        "data/test_dummy_topic.html",
+        "data/test_dummy_topic_2.html"
+    ]
+}
+todaysDate = date(2014, 7, 29)
+baseDir = os.path.dirname(os.path.abspath(__file__))
+defaultBaseline = "{0}/benchmark_baseline.json".format(baseDir)
+
+
+def _percentile(samples, fraction):
+    """Pull a percentile from sorted samples by nearest rank."""
+    index = max(0, int(round(fraction * len(samples))) - 1)
+    return samples[min(index, len(samples) - 1)]
+
+
+def _parse(parserName, html):
+    """Run a parser the way the crawler does."""
+    parser = getattr(bitcointalk, parserName)
+    if parserName == 'parseBoardPage':
+        return parser(html)
+    return parser(html, todaysDate)
+
+
+def benchmarkParser(parserName, pages, iterations):
+    """Time a parser over the given pages. Returns a dict of statistics."""
+    latencies = []
+    messages = 0
+    start = time.perf_counter()
+    for i in range(iterations):
+        for html in pages:
+            pageStart = time.perf_counter()
+            data = _parse(parserName, html)
+            latencies.append(time.perf_counter() - pageStart)
+            messages += len(data.get('messages', []))
+    elapsed = time.perf_counter() - start
+
+    # Measure memory in a separate pass, as tracing slows parsing down
+    tracemalloc.start()
+    for html in pages:
+        _parse(parserName, html)
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'pages': len(latencies),
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p90_ms': _percentile(latencies, 0.90) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'pages_per_sec': len(latencies) / elapsed,
+        'messages_per_sec': messages / elapsed,
+        'peak_memory_bytes': peakMemory
+    }
+
+
+def run(iterations=20, parserNames=None):
+    """Benchmark each parser over its fixtures."""
+    results = {}
+    for parserName in parserNames or sorted(fixtures.keys()):
+        pages = []
+        for fixture in fixtures[parserName]:
+            f = codecs.open("{0}/{1}".format(baseDir, fixture), 'r', 'utf-8')
+            pages.append(f.read())
+            f.close()
+        results[parserName] = benchmarkParser(parserName, pages, iterations)
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    """List the metrics that regressed more than tolerance vs baseline."""
+    regressions = []
+    for parserName, stats in results.items():
+        if parserName not in baseline:
+            continue
+        for key, value in stats.items():
+            expected = baseline[parserName].get(key)
+            if not expected or key == 'pages':
+                continue
+            # Throughput should not drop; latency and memory should not grow
+            if key.endswith('_per_sec'):
+                change = (expected - value) / expected
+            else:
+                change = (value - expected) / expected
+            if change > tolerance:
+                regressions.append(
+                    "{0} {1}: {2:.2f} vs baseline {3:.2f} ({4:+.0%})".format(
+                        parserName, key, value, expected, change))
+    return regressions
+
+
+def main(argv=None):
+    argParser = argparse.ArgumentParser(description=__doc__.strip())
+    argParser.add_argument("--iterations", type=int, default=20)
+    argParser.add_argument("--parser", action="append",
+                           choices=sorted(fixtures.keys()))
+    argParser.add_argument("--output", help="Write results to this file.")
+    argParser.add_argument("--baseline", default=defaultBaseline)
+    argParser.add_argument("--save-baseline", action="store_true",
+                           help="Store these results as the new baseline.")
+    argParser.add_argument("--tolerance", type=float, default=0.25)
+    args = argParser.parse_args(argv)
+
+    results = run(args.iterations, args.parser)
+    for parserName, stats in sorted(results.items()):
+        print("{0}: p50 {1:.2f} ms, p90 {2:.2f} ms, p99 {3:.2f} ms, "
+              "{4:.1f} pages/s, {5:.1f} messages/s, peak {6:.1f} KB".format(
+                  parserName, stats['p50_ms'], stats['p90_ms'],
+                  stats['p99_ms'], stats['pages_per_sec'],
+                  stats['messages_per_sec'],
+                  stats['peak_memory_bytes'] / 1024.0))
+
+    if args.output:
+        f = codecs.open(args.output, 'w', 'utf-8')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+    if args.save_baseline:
+        f = codecs.open(args.baseline, 'w', 'utf-8')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+        print("Saved baseline to {0}.".format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline at {0}; run with --save-baseline.".format(
+            args.baseline))
+        return 0
+
+    f = codecs.open(args.baseline, 'r', 'utf-8')
+    baseline = json.load(f)
+    f.close()
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION: {0}".format(regression))
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,57 +1,544 @@
 """ Module for requesting data from bitcointalk.org and parsing it. """
+import asyncio
+import breaker
 import codecs
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from datetime import datetime
 from datetime import time as tm
+import hashlib
 from html.parser import HTMLParser
+import json
 import logging
+import lrucache
+import lxml.cssselect
 import lxml.html
+import metrics
 import requests
+import requests.adapters
 import os
 from random import random
+import ratelimit
+import tempfile
+import threading
 import time
+import weakref
 
 baseUrl = "https://bitcointalk.org/index.php"
 countRequested = 0
-interReqTime = 2
-lastReqTime = None
+limiter = ratelimit.TokenBucket(rate=0.5, burst=1, maxRate=1.0)
+maxInFlight = 4
+conditionalGets = True
+validators = {}
+requestTimeout = 30
+maxRetries = 4
+backoffBase = 1.0
+backoffCap = 60.0
+breakers = {}
+# Responses are reused for this many seconds instead of being fetched again,
+# holding at most about maxBytes of pages in memory
+responseTtl = 60
+responseCache = lrucache.LRUCache(256, maxBytes=16 * 2 ** 20)
+# Set to a directory to also keep responses on disk, e.g. across restarts;
+# expired files are deleted every responseCachePruneSeconds
+responseCachePath = None
+responseCacheDiskTtl = 3600
+responseCachePruneSeconds = 600
 
+# Shared state for requests across threads and async tasks
+_lock = threading.Lock()
+_session = None
+_executor = None
+_executorSize = 0
+_semaphores = weakref.WeakKeyDictionary()
+_prunedTime = None
 
-def _request(payloadString):
-    """Private method for requesting an arbitrary query string."""
+
+class NotModified(Exception):
+
+    """Raised when a conditional request finds the page unchanged."""
+
+    pass
+
+
+class FetchError(Exception):
+
+    """Raised when a page could not be fetched or read."""
+
+    def __init__(self, message, statusCode=None):
+        super(FetchError, self).__init__(message)
+        self.statusCode = statusCode
+
+
+class TransientError(FetchError):
+
+    """Raised for failures worth retrying, e.g. a 502 or a dropped socket."""
+
+    pass
+
+
+class ThrottledError(TransientError):
+
+    """Raised when the server asks us to slow down (429/503)."""
+
+    def __init__(self, message, statusCode=None, retryAfter=None):
+        super(ThrottledError, self).__init__(message, statusCode)
+        self.retryAfter = retryAfter
+
+
+class NotFoundError(FetchError):
+
+    """Raised when the requested page does not exist."""
+
+    pass
+
+
+class ParseInvalidError(FetchError):
+
+    """Raised when a fetched page does not hold the expected data."""
+
+    pass
+
+
+class Message(MutableMapping):
+
+    """Record of a parsed message, with its fields kept in slots."""
+    """CAVEAT: Behaves like a dict restricted to the message fields."""
+    """CAVEAT: The no-quote variants share the full content when a post has
+    no quotes, so a page holds at most two copies of each post."""
+
+    __slots__ = ('id', 'topic', 'topic_position', 'member', 'post_time',
+                 'subject', 'link', 'content', 'content_no_html',
+                 'content_no_quote', 'content_no_quote_no_html')
+
+    def __init__(self, **fields):
+        for key, value in fields.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key not in Message.__slots__:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in Message.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in Message.__slots__:
+            raise KeyError(key)
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return (key for key in Message.__slots__ if hasattr(self, key))
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return "Message({0})".format(dict(self))
+
+
+def _getSession():
+    """Pull the pooled keep-alive session shared by all requests."""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=max(maxInFlight, 1))
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _session.headers.update({
+                'Accept-Encoding': 'gzip, deflate',
+                'Connection': 'keep-alive'
+            })
+        return _session
+
+
+def loadValidators(path):
+    """Load the ETag/Last-Modified validators saved by a previous crawl."""
+    global validators
+    if os.path.exists(path):
+        f = codecs.open(path, 'r', 'utf-8')
+        validators = json.load(f)
+        f.close()
+    return validators
+
+
+def saveValidators(path):
+    """Save the ETag/Last-Modified validators for the next crawl."""
+    f = codecs.open(path, 'w', 'utf-8')
+    json.dump(validators, f)
+    f.close()
+
+
+def _fetch(payloadString, conditional=True):
+    """Private method for issuing the HTTP request for a query string."""
+    """CAVEAT: Without conditional, any saved validators are dropped."""
     global countRequested
-    global lastReqTime
-    if lastReqTime is not None and time.time() - lastReqTime < interReqTime:
-        timeToSleep = random()*(interReqTime-time.time()+lastReqTime)*2
-        logging.info("Sleeping for {0} seconds before request.".format(
-            timeToSleep))
-        time.sleep(timeToSleep)
     logging.info("Issuing request for the following payload: {0}".format(
         payloadString))
-    r = requests.get("{0}?{1}".format(baseUrl, payloadString))
-    lastReqTime = time.time()
-    countRequested += 1
-    if r.status_code == requests.codes.ok:
+    headers = {}
+    if not conditional:
+        validators.pop(payloadString, None)
+    elif conditionalGets and payloadString in validators:
+        cached = validators[payloadString]
+        if 'etag' in cached:
+            headers['If-None-Match'] = cached['etag']
+        if 'last_modified' in cached:
+            headers['If-Modified-Since'] = cached['last_modified']
+    endpoint = _endpoint(payloadString)
+    start = time.monotonic()
+    try:
+        r = _getSession().get(
+            "{0}?{1}".format(baseUrl, payloadString), headers=headers,
+            timeout=requestTimeout)
+    except requests.RequestException as e:
+        # Dropped sockets, timeouts, broken chunked bodies and the like
+        metrics.observe('fetch_seconds', time.monotonic() - start,
+                        endpoint=endpoint, status="error")
+        raise TransientError("Could not process request for {0}: {1}".format(
+            payloadString, e))
+    metrics.observe('fetch_seconds', time.monotonic() - start,
+                    endpoint=endpoint, status=r.status_code)
+    metrics.increment('fetch_bytes_total', len(r.content), endpoint=endpoint)
+    limiter.observe(r.status_code, r.elapsed.total_seconds())
+    with _lock:
+        countRequested += 1
+    if r.status_code == requests.codes.not_modified:
+        raise NotModified("Payload {0} has not been modified.".format(
+            payloadString))
+    elif r.status_code == requests.codes.ok:
+        if conditionalGets:
+            cached = {}
+            if 'ETag' in r.headers:
+                cached['etag'] = r.headers['ETag']
+            if 'Last-Modified' in r.headers:
+                cached['last_modified'] = r.headers['Last-Modified']
+            if len(cached) > 0:
+                validators[payloadString] = cached
         return r.text
+
+    message = "Could not process request for {0}. " \
+        "Received status code {1}.".format(payloadString, r.status_code)
+    if r.status_code in (429, 503):
+        retryAfter = r.headers.get('Retry-After')
+        if retryAfter is not None and retryAfter.isdigit():
+            retryAfter = int(retryAfter)
+        else:
+            retryAfter = None
+        raise ThrottledError(message, r.status_code, retryAfter)
+    elif r.status_code >= 500:
+        raise TransientError(message, r.status_code)
+    elif r.status_code in (404, 410):
+        raise NotFoundError(message, r.status_code)
     else:
-        raise Exception("Could not process request. \
-            Received status code {0}.".format(r.status_code))
+        raise FetchError(message, r.status_code)
+
+
+def _endpoint(payloadString):
+    """Pull the endpoint a query string hits, e.g. "topic"."""
+    endpoint = payloadString.split(";")[0]
+    if not endpoint.startswith("action="):
+        endpoint = endpoint.split("=")[0]
+    return endpoint
+
+
+def _breaker(payloadString):
+    """Pull the circuit breaker for the endpoint a query string hits."""
+    endpoint = _endpoint(payloadString)
+    with _lock:
+        if endpoint not in breakers:
+            breakers[endpoint] = breaker.CircuitBreaker(endpoint)
+        return breakers[endpoint]
+
+
+def _responseFile(payloadString):
+    """Pull the on-disk cache file of a query string."""
+    return "{0}/{1}.html".format(
+        responseCachePath,
+        hashlib.sha1(payloadString.encode('utf-8')).hexdigest())
+
+
+def _cachedResponse(payloadString):
+    """Pull a cached response for a query string, or None if there is none."""
+    """CAVEAT: Looks in memory first, then on disk if a path is set."""
+    if responseTtl <= 0:
+        return None
+    cached = responseCache.get(payloadString)
+    if cached is not None:
+        expiry, html = cached
+        if expiry > time.time():
+            metrics.increment('response_cache_total', tier="memory",
+                              result="hit")
+            return html
+        responseCache.discard(payloadString)
+    if responseCachePath is not None:
+        path = _responseFile(payloadString)
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if age < responseCacheDiskTtl:
+                f = codecs.open(path, 'r', 'utf-8')
+                html = f.read()
+                f.close()
+                responseCache.put(payloadString, (
+                    time.time() + min(responseTtl, responseCacheDiskTtl - age),
+                    html))
+                metrics.increment('response_cache_total', tier="disk",
+                                  result="hit")
+                return html
+        except OSError:
+            pass
+    metrics.increment('response_cache_total', result="miss")
+    return None
+
+
+def pruneResponseCache():
+    """Delete on-disk responses older than the disk TTL. Returns the count."""
+    """CAVEAT: Temp files a crashed writer left behind go the same way."""
+    global _prunedTime
+    _prunedTime = time.time()
+    if responseCachePath is None:
+        return 0
+    count = 0
+    for entry in os.scandir(responseCachePath):
+        try:
+            if (entry.name.endswith((".html", ".tmp")) and
+                    _prunedTime - entry.stat().st_mtime >=
+                    responseCacheDiskTtl):
+                os.remove(entry.path)
+                count += 1
+        except OSError:
+            pass
+    if count > 0:
+        logging.info("Pruned {0} expired responses from {1}.".format(
+            count, responseCachePath))
+    return count
+
+
+def _cacheResponse(payloadString, html):
+    """Keep a fetched response for reuse by later requests."""
+    """CAVEAT: The first write, and one every responseCachePruneSeconds,
+    also prunes the disk cache."""
+    if responseTtl <= 0:
+        return
+    responseCache.put(payloadString, (time.time() + responseTtl, html))
+    if responseCachePath is None:
+        return
+    if (_prunedTime is None or
+            time.time() - _prunedTime >= responseCachePruneSeconds):
+        pruneResponseCache()
+    # A temp file of its own, so concurrent writers of a key do not collide
+    fd, tempPath = tempfile.mkstemp(suffix=".tmp", dir=responseCachePath)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(html)
+        os.replace(tempPath, _responseFile(payloadString))
+    except OSError as e:
+        logging.warning("Could not cache response for {0}: {1}".format(
+            payloadString, e))
+        try:
+            os.remove(tempPath)
+        except OSError:
+            pass
+
+
+def _retryDelay(error, attempt):
+    """Return the jittered backoff before retrying, or None to give up."""
+    if not isinstance(error, TransientError) or attempt >= maxRetries:
+        return None
+    delay = random()*min(backoffCap, backoffBase*2**attempt)
+    if isinstance(error, ThrottledError) and error.retryAfter is not None:
+        delay = max(delay, error.retryAfter)
+    logging.warning("{0} Retrying in {1} seconds.".format(error, delay))
+    return delay
+
+
+def _request(payloadString, conditional=True):
+    """Private method for requesting an arbitrary query string."""
+    """CAVEAT: Recent responses are served from the response cache."""
+    html = _cachedResponse(payloadString)
+    if html is not None:
+        return html
+    circuit = _breaker(payloadString)
+    attempt = 0
+    while True:
+        pause = circuit.delay()
+        if pause > circuit.probeWait:
+            logging.warning(
+                "Circuit for {0} is open. Pausing for {1} seconds.".format(
+                    circuit.name, pause))
+        while pause > 0:
+            # Wait out the cooldown, then for another request's probe
+            metrics.increment('sleep_seconds_total', pause, reason="circuit")
+            time.sleep(pause)
+            pause = circuit.delay()
+        metrics.increment('sleep_seconds_total', limiter.acquire(),
+                          reason="ratelimit")
+        try:
+            html = _fetch(payloadString, conditional)
+        except NotModified:
+            # The server answered, so this counts as a success
+            circuit.record(True)
+            raise
+        except FetchError as e:
+            circuit.record(not isinstance(e, TransientError))
+            delay = _retryDelay(e, attempt)
+            if delay is None:
+                raise
+            metrics.increment('sleep_seconds_total', delay, reason="backoff")
+            time.sleep(delay)
+            attempt += 1
+        else:
+            circuit.record(True)
+            _cacheResponse(payloadString, html)
+            return html
+
+
+def _semaphore():
+    """Pull the semaphore capping in-flight requests for the running loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(maxInFlight)
+    return _semaphores[loop]
+
+
+def _fetchExecutor():
+    """Pull the thread pool running blocking fetches for async callers."""
+    global _executor
+    global _executorSize
+    if _executor is None or _executorSize < maxInFlight:
+        _executor = ThreadPoolExecutor(max_workers=maxInFlight)
+        _executorSize = maxInFlight
+    return _executor
+
+
+async def _requestAsync(payloadString, conditional=True):
+    """Private coroutine for requesting an arbitrary query string."""
+    """CAVEAT: Recent responses are served from the response cache."""
+    html = _cachedResponse(payloadString)
+    if html is not None:
+        return html
+    circuit = _breaker(payloadString)
+    attempt = 0
+    while True:
+        pause = circuit.delay()
+        if pause > circuit.probeWait:
+            logging.warning(
+                "Circuit for {0} is open. Pausing for {1} seconds.".format(
+                    circuit.name, pause))
+        while pause > 0:
+            # Wait out the cooldown, then for another request's probe
+            metrics.increment('sleep_seconds_total', pause, reason="circuit")
+            await asyncio.sleep(pause)
+            pause = circuit.delay()
+        try:
+            async with _semaphore():
+                metrics.increment('sleep_seconds_total',
+                                  await limiter.acquireAsync(),
+                                  reason="ratelimit")
+                html = await asyncio.get_running_loop().run_in_executor(
+                    _fetchExecutor(), _fetch, payloadString, conditional)
+        except NotModified:
+            # The server answered, so this counts as a success
+            circuit.record(True)
+            raise
+        except FetchError as e:
+            circuit.record(not isinstance(e, TransientError))
+            delay = _retryDelay(e, attempt)
+            if delay is None:
+                raise
+            metrics.increment('sleep_seconds_total', delay, reason="backoff")
+            await asyncio.sleep(delay)
+            attempt += 1
+        else:
+            circuit.record(True)
+            _cacheResponse(payloadString, html)
+            return html
 
 
-def requestBoardPage(boardId, topicOffest=0):
+def requestBoardPage(boardId, topicOffest=0, conditional=True):
     """Method for requesting a board."""
-    return _request("board={0}.{1}".format(boardId, topicOffest))
+    return _request("board={0}.{1}".format(boardId, topicOffest),
+                    conditional)
 
 
-def requestProfile(memberId):
+def requestProfile(memberId, conditional=True):
     """Method for requesting a profile."""
-    return _request("action=profile;u={0}".format(memberId))
+    return _request("action=profile;u={0}".format(memberId), conditional)
 
 
-def requestTopicPage(topicId, messageOffset=0):
+def requestTopicPage(topicId, messageOffset=0, conditional=True):
     """Method for requesting a topic page."""
     """CAVEAT: Note that a single request will return only 20 messages."""
-    return _request("topic={0}.{1}".format(topicId, messageOffset))
+    return _request("topic={0}.{1}".format(topicId, messageOffset),
+                    conditional)
+
+
+def requestTopicAll(topicId, conditional=True):
+    """Method for requesting every message of a topic at once."""
+    """CAVEAT: Only works for topics whose pages link to an "All" view."""
+    return _request("topic={0}.0;all".format(topicId), conditional)
+
+
+async def requestBoardPageAsync(boardId, topicOffest=0, conditional=True):
+    """Coroutine for requesting a board."""
+    return await _requestAsync("board={0}.{1}".format(boardId, topicOffest),
+                               conditional)
+
+
+async def requestProfileAsync(memberId, conditional=True):
+    """Coroutine for requesting a profile."""
+    return await _requestAsync("action=profile;u={0}".format(memberId),
+                               conditional)
+
+
+async def requestTopicPageAsync(topicId, messageOffset=0, conditional=True):
+    """Coroutine for requesting a topic page."""
+    """CAVEAT: Note that a single request will return only 20 messages."""
+    return await _requestAsync("topic={0}.{1}".format(topicId, messageOffset),
+                               conditional)
+
+
+def _compile(css):
+    """Compile a CSS selector to XPath the way HtmlElement.cssselect does."""
+    return lxml.cssselect.CSSSelector(css, translator='html')
+
+# Selectors used by the parsers, compiled once at import
+selectors = {
+    'title': _compile("title"),
+    'bodyArea': _compile("#bodyarea"),
+    'navContainer': _compile("div > div > div"),
+    'navLink': _compile("a.nav"),
+    'pageLink': _compile(
+        "#bodyarea>table td.middletext>a,#bodyarea>table td.middletext>b"),
+    'boardTopicRow': _compile("#bodyarea>div.tborder>table.bordercolor>tr"),
+    'cell': _compile("td"),
+    'topicLink': _compile("span>a"),
+    'profileLink': _compile("#bodyarea td.windowbg2 > a"),
+    'profileTable': _compile("#bodyarea td.windowbg > table"),
+    'row': _compile("tr"),
+    'signature': _compile("div.signature"),
+    'link': _compile("a"),
+    'topicSubject': _compile("td#top_subject"),
+    'post': _compile("form#quickModForm>table.bordercolor>tr"),
+    'innerPost': _compile("td td.windowbg,td.windowbg2 tr"),
+    'posterLink': _compile("td.poster_info>b>a"),
+    'postSubject': _compile("td.td_headerandpost>table>tr>td>div.subject>a"),
+    'postTime': _compile("td.td_headerandpost>table>tr>td>div.smalltext"),
+    'postNumber': _compile(
+        "td.td_headerandpost>table>tr>td>div>a.message_number"),
+    'postBody': _compile("div.post")
+}
 
 
 def parseBoardPage(html):
@@ -60,11 +547,12 @@ def parseBoardPage(html):
 
     # Extract name
     docRoot = lxml.html.fromstring(html)
-    data['name'] = docRoot.cssselect("title")[0].text
+    data['name'] = selectors['title'](docRoot)[0].text
 
     # Parse through board hierarchy
-    bodyArea = docRoot.cssselect("#bodyarea")[0]
-    linkNodes = bodyArea.cssselect("div > div > div")[0].cssselect("a.nav")
+    bodyArea = selectors['bodyArea'](docRoot)[0]
+    linkNodes = selectors['navLink'](
+        selectors['navContainer'](bodyArea)[0])
     data['container'] = None
     data['parent'] = None
     for linkNode in linkNodes:
@@ -85,8 +573,7 @@ def parseBoardPage(html):
 
     # Parse number of pages
     data['num_pages'] = 0
-    pageNodes = bodyArea.cssselect(
-        "#bodyarea>table td.middletext>a,#bodyarea>table td.middletext>b")
+    pageNodes = selectors['pageLink'](bodyArea)
     for pageNode in pageNodes:
         if pageNode.text == " ... " or pageNode.text == "All":
             continue
@@ -95,14 +582,13 @@ def parseBoardPage(html):
 
     # Parse the topic IDs
     topicIds = []
-    topics = docRoot.cssselect(
-        "#bodyarea>div.tborder>table.bordercolor>tr")
+    topics = selectors['boardTopicRow'](docRoot)
     for topic in topics:
         # print topic.text_content()
-        topicCells = topic.cssselect("td")
+        topicCells = selectors['cell'](topic)
         if len(topicCells) != 7:
             continue
-        topicLinks = topicCells[2].cssselect("span>a")
+        topicLinks = selectors['topicLink'](topicCells[2])
         if len(topicLinks) > 0:
             linkPayload = topicLinks[0].attrib['href'].replace(
                 baseUrl, '')[1:]
@@ -120,12 +606,12 @@ def parseProfile(html, todaysDate=datetime.utcnow().date()):
     docRoot = lxml.html.fromstring(html)
 
     # Pull the member ID
-    pLink = docRoot.cssselect("#bodyarea td.windowbg2 > a")[0].attrib['href']
+    pLink = selectors['profileLink'](docRoot)[0].attrib['href']
     data['id'] = int(pLink.split("u=")[1].split(";")[0])
 
     # Pull associated information
-    infoTable = docRoot.cssselect("#bodyarea td.windowbg > table")[0]
-    infoRows = infoTable.cssselect("tr")
+    infoTable = selectors['profileTable'](docRoot)[0]
+    infoRows = selectors['row'](infoTable)
     labelMapping = {
         "Name: ": "name",
         "Position: ": "position",
@@ -141,9 +627,9 @@ def parseProfile(html, todaysDate=datetime.utcnow().date()):
     data['website_link'] = None
     data['signature'] = None
     for row in infoRows:
-        columns = row.cssselect("td")
+        columns = selectors['cell'](row)
         if len(columns) != 2:
-            signature = row.cssselect("div.signature")
+            signature = selectors['signature'](row)
             if len(signature) == 0:
                 continue
             else:
@@ -156,7 +642,7 @@ def parseProfile(html, todaysDate=datetime.utcnow().date()):
             if label in labelMapping:
                 data[labelMapping[label]] = columns[1].text_content().strip()
             if label == "Website: ":
-                linkNode = columns[1].cssselect("a")[0]
+                linkNode = selectors['link'](columns[1])[0]
                 data['website_link'] = linkNode.attrib['href']
             elif label == "Date Registered: " or label == "Last Active: ":
                 data[labelMapping[label]] = data[labelMapping[label]].replace(
@@ -166,6 +652,39 @@ def parseProfile(html, todaysDate=datetime.utcnow().date()):
     return data
 
 
+def _parseContent(corePost, m):
+    """Extract a post's content, with and without HTML and quotes."""
+    """CAVEAT: Serializes the post once; quotes are left out of the no-quote
+    variants without copying or changing the tree."""
+    html = lxml.html.tostring(corePost, with_tail=False)
+    m['content'] = html[html.index(b">") + 1:html.rindex(b"</")]
+    m['content_no_html'] = corePost.text_content()
+    quotes = [child for child in corePost
+              if child.tag == "div" and
+              child.get('class') in ('quoteheader', 'quote')]
+    if len(quotes) == 0:
+        m['content_no_quote'] = m['content']
+        m['content_no_quote_no_html'] = m['content_no_html']
+        return m
+
+    # Quotes go with their tail text; the text before the first child is
+    # kept as serialized, since it holds no tags
+    content = m['content']
+    keptHtml = [content[:content.index(b"<")]]
+    keptText = [corePost.text or ""]
+    for child in corePost:
+        if child in quotes:
+            continue
+        keptHtml.append(lxml.html.tostring(child))
+        if isinstance(child.tag, str):
+            # Comments hold no text content, only their tail
+            keptText.append(child.text_content())
+        keptText.append(child.tail or "")
+    m['content_no_quote'] = b"".join(keptHtml)
+    m['content_no_quote_no_html'] = "".join(keptText)
+    return m
+
+
 def parseTopicPage(html, todaysDate=datetime.utcnow().date()):
     """Method for parsing topic HTML. Will extract messages."""
     data = {}
@@ -173,14 +692,14 @@ def parseTopicPage(html, todaysDate=datetime.utcnow().date()):
     docRoot = lxml.html.fromstring(html)
 
     # Parse the topic name
-    data['name'] = docRoot.cssselect("title")[0].text
+    data['name'] = selectors['title'](docRoot)[0].text
 
     # Parse through board hierarchy for the containing board ID and topic ID
-    bodyArea = docRoot.cssselect("#bodyarea")[0]
-    nestedDiv = bodyArea.cssselect("div > div > div")
+    bodyArea = selectors['bodyArea'](docRoot)[0]
+    nestedDiv = selectors['navContainer'](bodyArea)
     if len(nestedDiv) == 0:
-        raise Exception("Page does not have valid topic data.")
-    linkNodes = nestedDiv[0].cssselect("a.nav")
+        raise ParseInvalidError("Page does not have valid topic data.")
+    linkNodes = selectors['navLink'](nestedDiv[0])
     for linkNode in linkNodes:
         link = linkNode.attrib["href"]
         linkText = linkNode.text
@@ -192,25 +711,28 @@ def parseTopicPage(html, todaysDate=datetime.utcnow().date()):
         elif linkText == data['name']:
             data['id'] = int(linkSuffix[7:].split(".")[0])
 
-    # Parse the total count of pages in the topic
+    # Parse the total count of pages in the topic, and whether the whole
+    # topic can be requested at once through its "All" view
     data['num_pages'] = 0
-    pageNodes = bodyArea.cssselect(
-        "#bodyarea>table td.middletext>a,#bodyarea>table td.middletext>b")
+    data['all_view'] = False
+    pageNodes = selectors['pageLink'](bodyArea)
     for pageNode in pageNodes:
-        if pageNode.text == " ... " or pageNode.text == "All":
+        if pageNode.text == "All":
+            data['all_view'] = True
+            continue
+        elif pageNode.text == " ... ":
             continue
         elif int(pageNode.text) > data['num_pages']:
             data["num_pages"] = int(pageNode.text)
 
     # Parse the read count
-    tSubj = docRoot.cssselect("td#top_subject")[0].text.strip()
+    tSubj = selectors['topicSubject'](docRoot)[0].text.strip()
     data['count_read'] = int(tSubj.split("(Read ")[-1].split(" times)")[0])
 
     # Parse the messages
     messages = []
     firstPostClass = None
-    posts = docRoot.cssselect(
-        "form#quickModForm>table.bordercolor>tr")
+    posts = selectors['post'](docRoot)
     for post in posts:
         if firstPostClass is None:
             firstPostClass = post.attrib["class"]
@@ -219,14 +741,14 @@ def parseTopicPage(html, todaysDate=datetime.utcnow().date()):
                 post.attrib["class"] != firstPostClass):
             continue
         else:
-            m = {}
+            m = Message()
             m['topic'] = data['id']
-            innerPost = post.cssselect("td td.windowbg,td.windowbg2 tr")[0]
+            innerPost = selectors['innerPost'](post)[0]
 
             # Parse the member who's made the post
-            userInfoPossible = innerPost.cssselect("td.poster_info>b>a")
+            userInfoPossible = selectors['posterLink'](innerPost)
             if len(userInfoPossible) > 0:
-                userInfo = innerPost.cssselect("td.poster_info>b>a")[0]
+                userInfo = userInfoPossible[0]
                 userUrlPrefix = "{0}?action=profile;u=".format(baseUrl)
                 m['member'] = int(userInfo.attrib["href"].split(
                     userUrlPrefix)[-1])
@@ -235,36 +757,24 @@ def parseTopicPage(html, todaysDate=datetime.utcnow().date()):
                 m['member'] = 0
 
             # Parse label information about the post
-            subj = innerPost.cssselect(
-                "td.td_headerandpost>table>tr>td>div.subject>a")[0]
+            subj = selectors['postSubject'](innerPost)[0]
             m['subject'] = subj.text
             m['link'] = subj.attrib['href']
             m['id'] = int(m['link'].split('#msg')[-1])
 
             # Parse the message post time
-            postTime = innerPost.cssselect(
-                "td.td_headerandpost>table>tr>td>div.smalltext")[0]
+            postTime = selectors['postTime'](innerPost)[0]
             m['post_time'] = postTime.text_content().strip().replace(
                 "Today at", todaysDate.strftime("%B %d, %Y,"))
             m['post_time'] = datetime.strptime(
                 m['post_time'], "%B %d, %Y, %I:%M:%S %p")
 
             # Parse the topic position
-            messageNumber = innerPost.cssselect(
-                "td.td_headerandpost>table>tr>td>div>a.message_number")[0]
+            messageNumber = selectors['postNumber'](innerPost)[0]
             m['topic_position'] = int(messageNumber.text[1:])
 
             # Extract the content
-            corePost = innerPost.cssselect("div.post")[0]
-            m['content'] = lxml.html.tostring(corePost).strip()[18:-6]
-            m['content_no_html'] = corePost.text_content()
-            for child in corePost.iterchildren():
-                if (child.tag == "div" and 'class' in child.attrib and
-                    (child.attrib['class'] == 'quoteheader' or
-                        child.attrib['class'] == 'quote')):
-                    corePost.remove(child)
-            m['content_no_quote'] = lxml.html.tostring(corePost).strip()[18:-6]
-            m['content_no_quote_no_html'] = corePost.text_content()
+            _parseContent(selectors['postBody'](innerPost)[0], m)
 
             messages.append(m)
 
@@ -1,8 +1,16 @@
 """ Core scraper for bitcointalk.org. """
+import atexit
 import bitcointalk
+import frontier
 import logging
 import memoizer
-import traceback
+import metrics
+import os
+import parsepool
+import profiling
+import signal
+import sys
+import writebehind
 
 def main():
     boardId = 74
@@ -12,40 +20,40 @@ def main():
         format='%(asctime)s %(levelname)s:%(message)s',
         datefmt='%m/%d/%Y %I:%M:%S %p')
 
+    # Sample hot paths when BITCOINTALK_PROFILE is set; before the pool
+    # starts, so forked parse workers are profiled too
+    profiling.install()
+
+    # Parse pages on every core while the main process keeps fetching
+    parsepool.start()
+
+    # Export fetch, parse and DB timings while the crawl runs
+    metrics.start()
+    atexit.register(metrics.stop)
+
+    # Flush buffered writes on SIGTERM as well as on normal exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
     # Make sure we don't rescrape information already in the DB
     memoizer.remember()
+    atexit.register(memoizer.saveSnapshot)
+
+    # Send conditional requests for pages seen in earlier crawls
+    validatorsFile = "{0}/data/validators.json".format(
+        os.path.dirname(os.path.abspath(__file__)))
+    bitcointalk.loadValidators(validatorsFile)
+    atexit.register(bitcointalk.saveValidators, validatorsFile)
 
-    logging.info("Beginning scrape of board ID {0}...".format(boardId))
-    board = memoizer.scrapeBoard(boardId)
-    logging.info("Found {0} topic pages in board...".format(
-        board['num_pages']))
-    for boardPageNum in range(1, board['num_pages'] + 1):
-        logging.info(">Scraping page {0}...".format(boardPageNum))
-        topicIds = memoizer.scrapeTopicIds(boardId, boardPageNum)
-        for topicId in topicIds:
-            logging.info(">>Starting scrape of topic ID {0}...".format(topicId))
-            try:
-                topic = memoizer.scrapeTopic(topicId)
-            except Exception as e:
-                print('-' * 60)
-                print("Could not request URL for topic {0}:".format(topicId))
-                print(traceback.format_exc())
-                print('-' * 60)
-                logging.info(">>Could not request URL for topic {0}:".format(
-                    topicId))
-                continue
-            logging.info(">>Found {0} message pages in topic...".format(
-                topic['num_pages']))
-            for topicPageNum in range(1, topic['num_pages'] + 1):
-                logging.info(">>>Scraping page {0}...".format(topicPageNum))
-                messages = memoizer.scrapeMessages(topic['id'], topicPageNum)
-                for message in messages:
-                    if message['member'] > 0:
-                        memoizer.scrapeMember(message['member'])
-                logging.info(">>>Done with page {0}.".format(topicPageNum))
-            logging.info(">>Done scraping topic ID {0}.".format(topicId))
-        logging.info(">Done with page {0}.".format(boardPageNum))
+    # Queue the board; a restart resumes the unfinished crawl instead
+    frontier.seed([frontier.item('board', boardId)])
+    logging.info("Crawled {0} frontier items.".format(frontier.run()))
 
+    parsepool.stop()
+    writebehind.flush()
+    for entity, cache in sorted(memoizer.caches.items()):
+        logging.info("{0} cache: {1}".format(entity, cache.stats()))
+    logging.info("Response cache: {0}".format(
+        bitcointalk.responseCache.stats()))
     logging.info("All done.")
     logging.info("Made {0} requests in total.".format(bitcointalk.countRequested))
 
@@ -0,0 +1,81 @@
+""" Module for pausing requests to an endpoint that keeps failing. """
+from collections import deque
+import logging
+import threading
+import time
+
+
+class CircuitBreaker(object):
+
+    """Circuit breaker tripped by the error rate over recent requests."""
+
+    def __init__(self, name, window=50, minRequests=10, errorRate=0.5,
+                 cooldown=60.0, clock=time.monotonic):
+        """Create a breaker tripping once errorRate of window requests fail."""
+        self.name = name
+        self.minRequests = minRequests
+        self.errorRate = errorRate
+        self.cooldown = cooldown
+        self.clock = clock
+        self.outcomes = deque(maxlen=window)
+        self.openedAt = None
+        # Half-open: when the single probe request was let through
+        self.probeStarted = None
+        self.probeWait = 1.0
+        self.lock = threading.Lock()
+
+    def _pause(self, now):
+        """Seconds to wait at time now; call with the lock held."""
+        if self.openedAt is None:
+            return 0
+        remaining = self.openedAt + self.cooldown - now
+        if remaining > 0:
+            return remaining
+        # A probe that never reports back is given up after a cooldown
+        if (self.probeStarted is not None and
+                now - self.probeStarted < self.cooldown):
+            return min(self.probeWait,
+                       self.probeStarted + self.cooldown - now)
+        return 0
+
+    def delay(self):
+        """Return the seconds to wait before requesting (0 when closed)."""
+        """CAVEAT: After the cooldown, the one caller given 0 is the probe;
+        the others are paused until its outcome is recorded."""
+        with self.lock:
+            now = self.clock()
+            pause = self._pause(now)
+            if pause == 0 and self.openedAt is not None:
+                self.probeStarted = now
+            return pause
+
+    def isOpen(self):
+        """Whether requests to the endpoint are currently paused."""
+        with self.lock:
+            return self._pause(self.clock()) > 0
+
+    def record(self, success):
+        """Record the outcome of a request, tripping or resetting."""
+        with self.lock:
+            if self.openedAt is not None:
+                # Half-open: the probe's outcome decides
+                if (self.probeStarted is None and
+                        self.clock() < self.openedAt + self.cooldown):
+                    return
+                self.probeStarted = None
+                if success:
+                    logging.info("Closing circuit for {0}.".format(
+                        self.name))
+                    self.openedAt = None
+                    self.outcomes.clear()
+                else:
+                    self.openedAt = self.clock()
+                return
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if (len(self.outcomes) >= self.minRequests and
+                    failures >= self.errorRate * len(self.outcomes)):
+                logging.warning(
+                    "Opening circuit for {0} after {1} of {2} requests "
+                    "failed.".format(self.name, failures, len(self.outcomes)))
+                self.openedAt = self.clock()
@@ -0,0 +1,230 @@
+""" Module for a durable crawl frontier of pending work in PostgreSQL. """
+import bitcointalk
+import logging
+import memoizer
+import os
+import pg
+import socket
+import threading
+import time
+import traceback
+import writebehind
+
+# Deeper work goes first, so the frontier stays small
+priorities = {
+    'member': 0,
+    'topic': 1,
+    'boardpage': 2,
+    'board': 3
+}
+# Items are claimed this many at a time, and retried this many times,
+# waiting retrySeconds before the first retry and twice as long each time
+batchSize = 20
+maxAttempts = 3
+retrySeconds = 60
+
+# Claimed items are leased to this worker and renewed while it is alive
+worker = "{0}:{1}".format(socket.gethostname(), os.getpid())
+leaseSeconds = 300
+heartbeatSeconds = 60
+# With nothing to claim, wait this long for items other workers still hold
+pollSeconds = 10
+
+generation = None
+
+
+def item(kind, entityId, page=0):
+    """Build a (kind, ID, page, priority) frontier item."""
+    return (kind, entityId, page, priorities[kind])
+
+
+def _crawlBoard(boardId, page):
+    """Scrape a board and queue each of its pages."""
+    board = memoizer.scrapeBoard(boardId)
+    return [item('boardpage', boardId, pageNum)
+            for pageNum in range(1, board['num_pages'] + 1)]
+
+
+def _crawlBoardPage(boardId, page):
+    """Queue the topics listed on a board page."""
+    return [item('topic', topicId)
+            for topicId in memoizer.scrapeTopicIds(boardId, page)]
+
+
+def _crawlTopic(topicId, page):
+    """Scrape a topic, its board and new messages; queue new posters."""
+    """CAVEAT: Topic pages are checkpointed by scrapeTopicMessages."""
+    topic = memoizer.scrapeTopic(topicId)
+    memoizer.scrapeBoard(topic['board'])
+    members = set()
+    for batch in memoizer.scrapeTopicMessages(topicId):
+        for pageNum, messages in batch:
+            members.update(message['member'] for message in messages
+                           if message['member'] > 0)
+    return [item('member', memberId) for memberId in sorted(members)
+            if memberId not in memoizer.memo['members']]
+
+
+def _crawlMember(memberId, page):
+    """Scrape a member profile."""
+    memoizer.scrapeMember(memberId)
+    return []
+
+
+def _crawlMembers(keys):
+    """Scrape member profiles together. Returns {key: []} for successes."""
+    members = memoizer.scrapeMembers([key[1] for key in keys])
+    return dict((key, []) for key in keys if key[1] in members)
+
+crawlers = {
+    'board': _crawlBoard,
+    'boardpage': _crawlBoardPage,
+    'topic': _crawlTopic,
+    'member': _crawlMember
+}
+# Kinds crawled a claimed batch at a time rather than item by item
+batchCrawlers = {
+    'member': _crawlMembers
+}
+
+
+def seed(items):
+    """Start a new crawl of the given items, or join an unfinished one."""
+    global generation
+    latest, unfinished = pg.frontierStatus()
+    if unfinished > 0:
+        # Items left running by a dead worker are reclaimed by run(), at
+        # once on the same host and elsewhere once their lease runs out
+        generation = latest
+        logging.info("Resuming crawl {0} with {1} unfinished items.".format(
+            generation, unfinished))
+    else:
+        generation = (latest or 0) + 1
+        logging.info("Starting crawl {0}.".format(generation))
+    pg.addWork(items, generation)
+    return generation
+
+
+def _isAlive(pid):
+    """Tell whether a process of this host is still running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def reclaim():
+    """Reset items left running by dead workers of this host. Returns count."""
+    """CAVEAT: Workers of other hosts are waited out until their lease ends."""
+    host, pid = worker.rsplit(":", 1)
+    dead = []
+    for name in pg.selectWorkers():
+        workerHost, _, workerPid = (name or "").rpartition(":")
+        if (workerHost == host and workerPid.isdigit() and
+                workerPid != pid and not _isAlive(int(workerPid))):
+            dead.append(name)
+    count = pg.resetWork(dead)
+    if count > 0:
+        logging.info("Reclaimed {0} items from dead workers {1}.".format(
+            count, ", ".join(dead)))
+    return count
+
+
+class _Heartbeat(threading.Thread):
+
+    """Thread renewing the lease on the items a worker is crawling."""
+
+    def __init__(self, items):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.items = items
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(heartbeatSeconds):
+            try:
+                pg.renewWork(self.items, worker, leaseSeconds)
+            except Exception as e:
+                logging.error("Could not renew leases: {0}".format(e))
+        pg.release()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run(limit=None):
+    """Work through the frontier until it is empty. Returns items done."""
+    """CAVEAT: Items are only marked done once their writes are flushed."""
+    """CAVEAT: Several workers, on any number of hosts, may run at once."""
+    """CAVEAT: While other workers hold items, waits for them to finish or
+    for their leases to run out; items backing off are left for later."""
+    global generation
+    if generation is None:
+        generation = pg.frontierStatus()[0] or 1
+    reclaim()
+    done = 0
+    while limit is None or done < limit:
+        items = pg.claimWork(batchSize, worker, leaseSeconds)
+        if len(items) == 0:
+            if len(pg.selectWorkers()) == 0:
+                break
+            writebehind.flushIfDue()
+            time.sleep(pollSeconds)
+            continue
+        keys = [(claimed['kind'], claimed['id'], claimed['page'])
+                for claimed in items]
+        heartbeat = _Heartbeat(keys)
+        heartbeat.start()
+        finished = []
+        try:
+            for kind, batchCrawler in batchCrawlers.items():
+                batch = [key for key in keys if key[0] == kind]
+                if len(batch) == 0:
+                    continue
+                keys = [key for key in keys if key[0] != kind]
+                logging.info(">Crawling {0} {1} items...".format(
+                    len(batch), kind))
+                try:
+                    found = batchCrawler(batch)
+                except Exception:
+                    logging.error(traceback.format_exc())
+                    found = {}
+                for key in batch:
+                    if key in found:
+                        pg.addWork(found[key], generation)
+                        finished.append(key)
+                    else:
+                        pg.finishWork([key], 'failed', "Could not crawl",
+                                      maxAttempts, worker, retrySeconds)
+            for key in keys:
+                writebehind.flushIfDue()
+                logging.info(">Crawling {0} {1} (page {2})...".format(*key))
+                try:
+                    found = crawlers[key[0]](key[1], key[2])
+                except bitcointalk.NotFoundError as e:
+                    # Gone for good, so retrying would not help
+                    logging.error("{0} {1} (page {2}) does not exist: "
+                                  "{3}".format(key[0], key[1], key[2], e))
+                    writebehind.flush()
+                    pg.finishWork([key], 'failed', str(e), 0, worker)
+                    continue
+                except Exception as e:
+                    logging.error(
+                        "Could not crawl {0} {1} (page {2}):".format(*key))
+                    logging.error(traceback.format_exc())
+                    writebehind.flush()
+                    pg.finishWork([key], 'failed', str(e), maxAttempts,
+                                  worker, retrySeconds)
+                    continue
+                pg.addWork(found, generation)
+                finished.append(key)
+            writebehind.flush()
+            pg.finishWork(finished, 'done', worker=worker)
+        finally:
+            heartbeat.stop()
+        done += len(finished)
+    return done
@@ -0,0 +1,116 @@
+""" Module for compact sets of entity IDs. """
+from array import array
+from bisect import bisect_left
+from collections.abc import MutableSet
+from heapq import merge as mergeSorted
+import mmap
+import os
+
+
+class IdIndex(MutableSet):
+
+    """Set of integer IDs kept as a sorted array of 64-bit values."""
+    """CAVEAT: New IDs are held in a small set until merged into the array."""
+    """CAVEAT: A loaded index reads straight from its memory-mapped file."""
+
+    def __init__(self, ids=(), mergeSize=4096):
+        """Build the index from any iterable of IDs."""
+        self.ids = array('q')
+        self.pending = set()
+        self.mergeSize = mergeSize
+        for datumId in ids:
+            self.add(datumId)
+        self.merge()
+
+    def __contains__(self, datumId):
+        if datumId in self.pending:
+            return True
+        i = bisect_left(self.ids, datumId)
+        return i < len(self.ids) and self.ids[i] == datumId
+
+    def __iter__(self):
+        self.merge()
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids) + len(self.pending)
+
+    def __repr__(self):
+        return "IdIndex({0} IDs)".format(len(self))
+
+    def add(self, datumId):
+        """Add an ID, merging pending IDs once there are enough of them."""
+        if datumId not in self:
+            self.pending.add(datumId)
+            if len(self.pending) >= self.mergeSize:
+                self.merge()
+
+    def discard(self, datumId):
+        """Remove an ID if present."""
+        if datumId in self.pending:
+            self.pending.discard(datumId)
+            return
+        i = bisect_left(self.ids, datumId)
+        if i < len(self.ids) and self.ids[i] == datumId:
+            self._own()
+            del self.ids[i]
+
+    def _own(self):
+        """Copy a memory-mapped snapshot into a writable array."""
+        if not isinstance(self.ids, array):
+            self.ids = array('q', self.ids.tobytes())
+
+    def extendSorted(self, ids):
+        """Append a chunk of IDs in ascending order, e.g. from the DB."""
+        """CAVEAT: Falls back to add() for chunks that are out of order."""
+        if len(ids) == 0:
+            return
+        if (all(ids[i] < ids[i + 1] for i in range(len(ids) - 1)) and
+                (len(self.ids) == 0 or self.ids[-1] < ids[0])):
+            self._own()
+            self.ids.extend(ids)
+            self.pending.difference_update(ids)
+        else:
+            for datumId in ids:
+                self.add(datumId)
+
+    def merge(self):
+        """Fold pending IDs into the sorted array."""
+        if len(self.pending) == 0:
+            return
+        merged = sorted(self.pending)
+        self.pending = set()
+        if len(self.ids) == 0 or self.ids[-1] < merged[0]:
+            self._own()
+            self.ids.extend(merged)
+        else:
+            self.ids = array('q', mergeSorted(self.ids, merged))
+
+    def clear(self):
+        self.ids = array('q')
+        self.pending = set()
+
+    def save(self, path):
+        """Write the IDs to a file as raw 64-bit values, atomically."""
+        self.merge()
+        f = open(path + ".tmp", 'wb')
+        f.write(self.ids)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path, mergeSize=4096):
+        """Open an index saved by save() without reading it into memory."""
+        index = cls(mergeSize=mergeSize)
+        f = open(path, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        if size % index.ids.itemsize != 0:
+            f.close()
+            raise ValueError("Truncated ID index {0}".format(path))
+        if size > 0:
+            index.ids = memoryview(
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast('q')
+        f.close()
+        return index
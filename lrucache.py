@@ -0,0 +1,101 @@
+""" Module for bounded in-process caches of entity records. """
+from collections import OrderedDict
+import sys
+import threading
+
+
+def approximateSize(value):
+    """Estimate the memory held by a value and the items directly in it."""
+    """CAVEAT: Only looks one level deep, which covers flat records."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += sys.getsizeof(k) + sys.getsizeof(v)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += sys.getsizeof(item)
+    return size
+
+
+class LRUCache(object):
+
+    """Mapping that evicts the least recently used entry once full."""
+
+    def __init__(self, maxSize=10000, maxBytes=None, sizeOf=approximateSize):
+        """Hold at most maxSize entries, and if set about maxBytes of them."""
+        """CAVEAT: Bytes are estimated by sizeOf when an entry is stored."""
+        self.maxSize = maxSize
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Pull an entry, marking it as recently used."""
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store an entry, evicting the oldest ones beyond the bounds."""
+        """CAVEAT: An entry larger than maxBytes on its own is not kept."""
+        size = self.sizeOf(value) if self.maxBytes is not None else 0
+        with self.lock:
+            self.bytes += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > 0 and (
+                    len(self.entries) > self.maxSize or
+                    (self.maxBytes is not None and
+                     self.bytes > self.maxBytes)):
+                oldest, _ = self.entries.popitem(last=False)
+                self.bytes -= self.sizes.pop(oldest)
+                self.evictions += 1
+
+    def discard(self, key):
+        """Drop an entry if present."""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.bytes -= self.sizes.pop(key, 0)
+
+    def clear(self):
+        """Drop all entries and reset the counters."""
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Summarize size and hit rate as a dict."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
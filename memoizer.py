@@ -1,44 +1,90 @@
 """ Module for loading parsed data from bitcointalk into PostgreSQL. """
+import archive
+import asyncio
 import bitcointalk
 import codecs
 from datetime import datetime
+from datetime import timedelta
+import idindex
+import json
+import logging
+import lrucache
+import metrics
 import os
+import parsepool
 import pg
+import scheduler
+import writebehind
 
 memo = {
-    'boards': set(),
-    'members': set(),
-    'topics': set()
+    'boards': idindex.IdIndex(),
+    'members': idindex.IdIndex(),
+    'topics': idindex.IdIndex()
 }
 
+# Recently used records, so memo hits rarely have to query the DB, bounded
+# by entry count and by approximate size in bytes
+caches = {
+    'board': lrucache.LRUCache(1000, maxBytes=4 * 2 ** 20),
+    'member': lrucache.LRUCache(50000, maxBytes=64 * 2 ** 20),
+    'topic': lrucache.LRUCache(10000, maxBytes=16 * 2 ** 20)
+}
+
+# Messages per topic page, and whether to skip pages seen in full
+messagesPerPage = 20
+incremental = True
+# Fetch remaining pages through the "All" view when at least this many
+allViewMinPages = 2
+
+# Page 1 of recently scraped topics, by topic ID
+firstPages = lrucache.LRUCache(100)
+
+# Snapshot of memo for fast restarts, or None to rescan the DB every time
+snapshotPath = "{0}/data/memo".format(
+    os.path.dirname(os.path.abspath(__file__)))
+# DB time as of which memo holds every ID, and how far back to re-check it
+memoHighWater = None
+snapshotOverlap = timedelta(minutes=5)
+
+# Raw HTML goes to a compressed archive, or to one file per page if None
+archivePath = "{0}/data/archive".format(
+    os.path.dirname(os.path.abspath(__file__)))
+archiveStore = None
+
 
 def _insertBoardPage(data):
     """Insert just the board."""
     del data['topic_ids']
-    pg.insertBoard(data)
+    writebehind.add('board', data)
+
+
+def _insertMember(datum):
+    """Insert the member once the write-behind buffer is flushed."""
+    writebehind.add('member', datum)
 
 
 def _insertTopicPage(data):
     """Insert data as topic and messages and splice off messages."""
-    pg.insertMessages(data.pop('messages'))
-    pg.insertTopic(data)
+    messages = data.pop('messages')
+    pg.insertMessages(messages)
+    # Keep page 1 so scrapeTopicMessages need not request it again
+    firstPages.put(data['id'], dict(data, messages=messages))
+    del data['all_view']
+    writebehind.add('topic', data)
 
 entityFunctions = {
     'board': {
         'requestor': bitcointalk.requestBoardPage,
-        'parser': bitcointalk.parseBoardPage,
         'inserter': _insertBoardPage,
         'selector': pg.selectBoard
     },
     'member': {
         'requestor': bitcointalk.requestProfile,
-        'parser': bitcointalk.parseProfile,
-        'inserter': pg.insertMember,
+        'inserter': _insertMember,
         'selector': pg.selectMember
     },
     'topic': {
         'requestor': bitcointalk.requestTopicPage,
-        'parser': bitcointalk.parseTopicPage,
         'inserter': _insertTopicPage,
         'selector': pg.selectTopic
     }
@@ -56,30 +102,151 @@ def _saveToFile(html, fileType, fileDescriptor):
     f.close()
 
 
+def _archive():
+    """Open the page archive on first use."""
+    global archiveStore
+    if archiveStore is None:
+        archiveStore = archive.Archive(archivePath)
+    return archiveStore
+
+
+def _savePage(html, fileType, entityId, offset=None):
+    """Save a fetched page to the archive, or to a file without one."""
+    with metrics.timer('archive_write_seconds', entity=fileType):
+        if archivePath is None:
+            if offset is None:
+                _saveToFile(html, fileType, entityId)
+            else:
+                _saveToFile(html, fileType, "{0}.{1}".format(entityId,
+                                                             offset))
+        else:
+            _archive().append(fileType, entityId, html, offset or 0)
+
+
+def _loadSnapshot():
+    """Load memo from the snapshot. Returns its high-water mark or None."""
+    global memo
+    statePath = "{0}/state.json".format(snapshotPath or "")
+    if snapshotPath is None or not os.path.exists(statePath):
+        return None
+    try:
+        f = codecs.open(statePath, 'r', 'utf-8')
+        state = json.load(f)
+        f.close()
+        if state['tables'] != pg.tables:
+            return None
+        snapshot = {}
+        for key in memo.keys():
+            snapshot[key] = idindex.IdIndex.load("{0}/{1}.ids".format(
+                snapshotPath, key))
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning("Ignoring memo snapshot: {0}".format(e))
+        return None
+    memo.update(snapshot)
+    return datetime.strptime(state['high_water'], "%Y-%m-%dT%H:%M:%S.%f%z")
+
+
+def saveSnapshot():
+    """Store memo so the next run only checks rows changed since."""
+    """CAVEAT: Buffered writes are flushed first, so every ID is in the DB."""
+    if snapshotPath is None or memoHighWater is None:
+        return False
+    writebehind.flush()
+    if not os.path.isdir(snapshotPath):
+        os.makedirs(snapshotPath)
+    for key, ids in memo.items():
+        ids.save("{0}/{1}.ids".format(snapshotPath, key))
+    # The state goes last, so a partial save keeps the older high-water mark
+    f = codecs.open("{0}/state.json.tmp".format(snapshotPath), 'w', 'utf-8')
+    json.dump({
+        'high_water': memoHighWater.strftime("%Y-%m-%dT%H:%M:%S.%f%z"),
+        'tables': pg.tables
+    }, f)
+    f.close()
+    os.replace("{0}/state.json.tmp".format(snapshotPath),
+               "{0}/state.json".format(snapshotPath))
+    return True
+
+
 def remember():
     """Remember what's already in the database to avoid re-scraping."""
+    """CAVEAT: With a snapshot, only rows updated since it are queried."""
     global memo
-    cursor = pg.cursor()
+    global memoHighWater
+    writebehind.flush()
+    since = _loadSnapshot()
+    if since is not None:
+        # Rows committed late can carry a timestamp from before the mark
+        since -= snapshotOverlap
+    highWater = pg.currentTime()
     for key in memo.keys():
-        cursor.execute("SELECT sid FROM {0}".format(pg.tables[key[:-1]]))
-        rows = cursor.fetchall()
-        for row in rows:
-            memo[key].add(row[0])
+        for ids in pg.selectIds(key[:-1], since=since):
+            memo[key].extendSorted(ids)
+    memoHighWater = highWater
+    saveSnapshot()
     return True
 
 
+def _select(entity, entityId, required=True):
+    """Pull a scraped entity, even if it is still in the write buffer."""
+    """CAVEAT: Unless required, a missing entity comes back as None."""
+    datum = caches[entity].get(entityId)
+    if datum is None:
+        datum = writebehind.pending(entity, entityId)
+        if datum is None:
+            datum = entityFunctions[entity]['selector'](entityId, required)
+            if datum is None:
+                return None
+        caches[entity].put(entityId, dict(datum))
+        return datum
+    return dict(datum)
+
+
+def prefetchMembers(memberIds):
+    """Cache already scraped members with one query. Returns the count."""
+    """CAVEAT: Members not yet scraped are left to scrapeMember."""
+    cache = caches['member']
+    memberIds = [memberId for memberId in set(memberIds)
+                 if memberId in memo['members'] and memberId not in cache and
+                 writebehind.pending('member', memberId) is None]
+    if len(memberIds) == 0:
+        return 0
+    try:
+        data = pg.selectMembers(memberIds)
+    except Exception as e:
+        logging.warning("Could not prefetch members: {0}".format(e))
+        return 0
+    for datum in data:
+        cache.put(datum['id'], datum)
+    return len(data)
+
+
 def _scrape(entity, entityId):
     global memo
     global entityFunctions
     entityPlural = "{0}s".format(entity)
     if entityId in memo[entityPlural]:
-        return entityFunctions[entity]['selector'](entityId)
+        metrics.increment('memo_total', entity=entity, result="hit")
+        return _select(entity, entityId)
     else:
-        html = entityFunctions[entity]['requestor'](entityId)
-        _saveToFile(html, entity, entityId)
-        datum = entityFunctions[entity]['parser'](html)
+        metrics.increment('memo_total', entity=entity, result="miss")
+        try:
+            html = entityFunctions[entity]['requestor'](entityId)
+        except bitcointalk.NotModified:
+            # Unchanged since the last crawl, so normally already in the DB
+            datum = _select(entity, entityId, required=False)
+            if datum is not None:
+                memo[entityPlural].add(entityId)
+                return datum
+            logging.warning("{0} {1} is unchanged but not stored; "
+                            "requesting it again.".format(entity, entityId))
+            html = entityFunctions[entity]['requestor'](
+                entityId, conditional=False)
+        _savePage(html, entity, entityId)
+        datum = parsepool.parse(entity, html)
         entityFunctions[entity]['inserter'](datum)
         memo[entityPlural].add(entityId)
+        caches[entity].put(entityId, dict(datum))
         return datum
 
 
@@ -91,9 +258,14 @@ def scrapeBoard(boardId):
 def scrapeTopicIds(boardId, pageNum):
     """Scrape topic IDs from a board page. Will not store values."""
     offset = (pageNum-1)*40
-    html = bitcointalk.requestBoardPage(boardId, offset)
-    _saveToFile(html, "boardpage", "{0}.{1}".format(boardId, offset))
-    data = bitcointalk.parseBoardPage(html)
+    try:
+        html = bitcointalk.requestBoardPage(boardId, offset)
+    except bitcointalk.NotModified:
+        logging.info("Board {0} page {1} is unchanged.".format(
+            boardId, pageNum))
+        return []
+    _savePage(html, "boardpage", boardId, offset)
+    data = parsepool.parse('board', html)
     data = data['topic_ids']
     return data
 
@@ -103,18 +275,275 @@ def scrapeMember(memberId):
     return _scrape('member', memberId)
 
 
+async def _scrapeProfileAsync(memberId, conditional=True):
+    """Request and parse a profile, parsing while others download."""
+    html = await bitcointalk.requestProfileAsync(memberId, conditional)
+    datum = await asyncio.wrap_future(parsepool.submit('member', html))
+    return html, datum
+
+
+async def _scrapeProfiles(memberIds, conditional=True):
+    """Request and parse several profiles concurrently."""
+    """CAVEAT: Failures, including NotModified, are returned, not raised."""
+    return await asyncio.gather(*[
+        _scrapeProfileAsync(memberId, conditional) for memberId in memberIds],
+        return_exceptions=True)
+
+
+def scrapeMembers(memberIds):
+    """Scrape the profiles of several members, fetching new ones at once."""
+    """CAVEAT: Returns {member ID: profile}; failed members are left out."""
+    """CAVEAT: Up to bitcointalk.maxInFlight profiles are requested at once."""
+    memberIds = [memberId for memberId in dict.fromkeys(memberIds)
+                 if memberId > 0]
+    prefetchMembers(memberIds)
+    members = {}
+    misses = []
+    for memberId in memberIds:
+        if memberId in memo['members']:
+            members[memberId] = _select('member', memberId)
+        else:
+            misses.append(memberId)
+    metrics.increment('memo_total', len(memberIds) - len(misses),
+                      entity="member", result="hit")
+    metrics.increment('memo_total', len(misses), entity="member",
+                      result="miss")
+    if len(misses) == 0:
+        return members
+
+    results = list(zip(misses, asyncio.run(_scrapeProfiles(misses))))
+    # Unchanged since the last crawl, so normally already in the DB
+    unstored = []
+    for memberId, result in results:
+        if isinstance(result, bitcointalk.NotModified):
+            datum = _select('member', memberId, required=False)
+            if datum is None:
+                unstored.append(memberId)
+            else:
+                memo['members'].add(memberId)
+                members[memberId] = datum
+    if len(unstored) > 0:
+        logging.warning("{0} members are unchanged but not stored; "
+                        "requesting them again.".format(len(unstored)))
+        results.extend(zip(unstored, asyncio.run(
+            _scrapeProfiles(unstored, conditional=False))))
+    for memberId, result in results:
+        if isinstance(result, bitcointalk.NotModified):
+            continue
+        elif isinstance(result, Exception):
+            logging.error("Could not scrape member {0}: {1}".format(
+                memberId, result))
+        else:
+            html, datum = result
+            _savePage(html, 'member', memberId)
+            entityFunctions['member']['inserter'](datum)
+            memo['members'].add(memberId)
+            caches['member'].put(memberId, dict(datum))
+            members[memberId] = datum
+    return members
+
+
 def scrapeMessages(topicId, pageNum):
     """Scrape all messages on the specified topic, page combination."""
     """CAVEAT: Messages are not memoized."""
-    offset = (pageNum-1)*20
-    html = bitcointalk.requestTopicPage(topicId, offset)
-    _saveToFile(html, "topicpage", "{0}.{1}".format(topicId, offset))
-    data = bitcointalk.parseTopicPage(html)
+    """CAVEAT: Pages unchanged since the last crawl return no messages."""
+    offset = (pageNum-1)*messagesPerPage
+    try:
+        html = bitcointalk.requestTopicPage(topicId, offset)
+    except bitcointalk.NotModified:
+        logging.info("Topic {0} page {1} is unchanged.".format(
+            topicId, pageNum))
+        return []
+    _savePage(html, "topicpage", topicId, offset)
+    data = parsepool.parse('topic', html)
     data = data['messages']
     pg.insertMessages(data)
     return data
 
 
+async def _requestTopicPageAsync(topicId, offset, conditional=True):
+    """Request a topic page, yielding None if it is unchanged."""
+    try:
+        return await bitcointalk.requestTopicPageAsync(topicId, offset,
+                                                       conditional)
+    except bitcointalk.NotModified:
+        logging.info("Topic {0} page at offset {1} is unchanged.".format(
+            topicId, offset))
+        return None
+
+
+async def _scrapeTopicPageAsync(topicId, offset, conditional=True):
+    """Request and parse a topic page, parsing while others download."""
+    html = await _requestTopicPageAsync(topicId, offset, conditional)
+    if html is None:
+        return None, None
+    data = await asyncio.wrap_future(parsepool.submit('topic', html))
+    return html, data
+
+
+async def _scrapeTopicPages(topicId, offsets, conditional=True):
+    """Request and parse several topic pages concurrently."""
+    """CAVEAT: A page that failed comes back as its exception."""
+    return await asyncio.gather(*[
+        _scrapeTopicPageAsync(topicId, offset, conditional)
+        for offset in offsets], return_exceptions=True)
+
+
+def _scrapeMessagePages(topicId, pageNums, conditional=True):
+    """Scrape and load several pages of a topic. Returns the parsed pages."""
+    """CAVEAT: Unchanged pages are None. If any page failed, the others are
+    still loaded and the first error is raised."""
+    offsets = [(pageNum-1)*messagesPerPage for pageNum in pageNums]
+    results = asyncio.run(_scrapeTopicPages(topicId, offsets, conditional))
+    pages = []
+    error = None
+    for offset, result in zip(offsets, results):
+        if isinstance(result, BaseException):
+            logging.error("Could not scrape topic {0} page at offset "
+                          "{1}: {2}".format(topicId, offset, result))
+            error = error or result
+            pages.append(None)
+            continue
+        html, data = result
+        if html is None:
+            pages.append(None)
+            continue
+        _savePage(html, "topicpage", topicId, offset)
+        pg.insertMessages(data['messages'], commit=False)
+        pages.append(data)
+    pg.commit()
+    if error is not None:
+        raise error
+    return pages
+
+
+def _scrapeAllView(topicId, pageNums, conditional=True):
+    """Scrape and load several pages of a topic with one request."""
+    """CAVEAT: Returns a parsed page per page number, as if each had been
+    requested on its own; all are None if unchanged."""
+    """CAVEAT: If the view cannot be fetched or parsed, the pages are
+    requested one by one instead."""
+    try:
+        html = bitcointalk.requestTopicAll(topicId, conditional)
+        _savePage(html, "topicall", topicId)
+        data = parsepool.parse('topic', html)
+    except bitcointalk.NotModified:
+        logging.info("Topic {0} is unchanged.".format(topicId))
+        return [None] * len(pageNums)
+    except bitcointalk.FetchError as e:
+        logging.error("All view of topic {0} failed, fetching its pages "
+                      "one by one: {1}".format(topicId, e))
+        return _scrapeMessagePages(topicId, pageNums, conditional)
+    pages = []
+    for pageNum in pageNums:
+        pages.append(dict(data, messages=[
+            message for message in data['messages']
+            if (message['topic_position'] - 1) // messagesPerPage + 1 ==
+            pageNum]))
+    pg.insertMessages([message for page in pages
+                       for message in page['messages']], commit=False)
+    pg.commit()
+
+    # Fall back to single pages if the view left any out
+    missing = [pageNum for pageNum, page in zip(pageNums, pages)
+               if len(page['messages']) == 0]
+    if len(missing) > 0:
+        logging.info("All view of topic {0} lacks {1} pages.".format(
+            topicId, len(missing)))
+        fetched = dict(zip(missing, _scrapeMessagePages(
+            topicId, missing, conditional)))
+        pages = [fetched.get(pageNum, page)
+                 for pageNum, page in zip(pageNums, pages)]
+    return pages
+
+
+def scrapeMessagesBatch(topicId, pageNums):
+    """Scrape all messages on several pages of the specified topic."""
+    """CAVEAT: Up to bitcointalk.maxInFlight pages are requested at once."""
+    return [[] if data is None else data['messages']
+            for data in _scrapeMessagePages(topicId, pageNums)]
+
+
+def selectTopicState(topicId):
+    """Pull how far a topic has been crawled, or None if never."""
+    state = writebehind.pending('topic_state', topicId)
+    if state is None:
+        state = pg.selectTopicState(topicId)
+    return state
+
+
+def scrapeTopicMessages(topicId):
+    """Scrape the message pages of a topic, one batch at a time."""
+    """CAVEAT: Yields a list of (page number, messages) for each batch."""
+    """CAVEAT: In incremental mode, pages seen in full are skipped."""
+    """CAVEAT: Pages that could not be fetched raise, so the topic is
+    retried instead of being taken as crawled."""
+    previous = selectTopicState(topicId)
+    state = dict(previous) if incremental and previous else None
+    # Without a stored state, a 304 would not mean the page is in the DB
+    conditional = state is not None
+    if state is None:
+        state = {'id': topicId, 'num_pages': 1, 'last_page': 0,
+                 'last_position': 0}
+    countRead = None if previous is None else previous['count_read']
+    crawlTime = scheduler.now()
+    # Start over on the last page seen, which may have gained messages
+    pageNum = max(1, (state['last_position'] - 1) // messagesPerPage + 1)
+    numPages = max(pageNum, state['num_pages'])
+    allView = False
+    firstPage = firstPages.get(topicId)
+    firstPages.discard(topicId)
+    while pageNum <= numPages:
+        # Pick the fewest requests that cover the pages still to fetch
+        if pageNum == 1 and firstPage is not None:
+            pageNums = [1]
+            pages = [firstPage]
+        elif allView and numPages - pageNum + 1 >= allViewMinPages:
+            pageNums = list(range(pageNum, numPages + 1))
+            pages = _scrapeAllView(topicId, pageNums, conditional)
+        else:
+            pageNums = list(range(pageNum, min(
+                numPages, pageNum + bitcointalk.maxInFlight - 1) + 1))
+            pages = _scrapeMessagePages(topicId, pageNums, conditional)
+        batch = []
+        ended = False
+        for batchPageNum, data in zip(pageNums, pages):
+            if data is None:
+                # Unchanged since the last crawl, so already stored; if it
+                # was full, new messages start on the page after it
+                if (batchPageNum == numPages and state['last_position'] >=
+                        batchPageNum * messagesPerPage):
+                    numPages += 1
+                batch.append((batchPageNum, []))
+                continue
+            if data['num_pages'] < batchPageNum:
+                # Asked past the last page, so there is nothing more
+                ended = True
+                break
+            numPages = max(numPages, data['num_pages'])
+            countRead = data['count_read']
+            allView = data.pop('all_view', False)
+            state = {
+                'id': topicId,
+                'num_pages': numPages,
+                'last_page': batchPageNum,
+                'last_position': max([state['last_position']] + [
+                    message['topic_position']
+                    for message in data['messages']])
+            }
+            batch.append((batchPageNum, data.pop('messages')))
+            writebehind.add('topic', data)
+            caches['topic'].put(topicId, dict(data))
+        # Track how often the topic changes for the recrawl scheduler
+        state.update(scheduler.observe(
+            previous, countRead, state['last_position'], crawlTime))
+        writebehind.add('topic_state', state)
+        yield batch
+        if ended:
+            break
+        pageNum = pageNums[-1] + 1
+
+
 def scrapeTopic(topicId):
     """Scrape information on the specified topic."""
     return _scrape('topic', topicId)
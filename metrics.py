@@ -0,0 +1,234 @@
+""" Module for crawl metrics, exported as Prometheus text and JSON. """
+import codecs
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import logging
+import os
+import threading
+import time
+
+# Metric names are exported with this prefix
+prefix = "bitcointalk_"
+# Upper bounds (seconds) of the latency histogram buckets
+buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0, 30.0, 60.0)
+
+# Local endpoint serving /metrics; set port to None to turn it off, or to 0
+# for any free port. BITCOINTALK_METRICS_PORT sets it per process, with an
+# empty value turning the endpoint off.
+host = "127.0.0.1"
+port = os.environ.get("BITCOINTALK_METRICS_PORT", "9464")
+port = int(port) if port != "" else None
+# JSON snapshot rewritten every snapshotSeconds, one file per process; set
+# to None to turn it off
+snapshotPath = "{0}/data/metrics.{1}.json".format(
+    os.path.dirname(os.path.abspath(__file__)), os.getpid())
+snapshotSeconds = 60.0
+
+# {(name, ((label, value), ...)): value}
+counters = {}
+# {(name, ((label, value), ...)): [bucket counts..., +Inf, sum, count]}
+histograms = {}
+_lock = threading.Lock()
+_server = None
+_snapshotter = None
+
+
+def _key(name, labels):
+    """Build the registry key of a metric and its labels."""
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+def increment(name, amount=1, **labels):
+    """Add amount to a counter."""
+    key = _key(name, labels)
+    with _lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    """Record a latency in a histogram."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(buckets) + 3)
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(buckets)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """Time the enclosed block into a histogram, even if it raises."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+
+def reset():
+    """Drop every recorded metric."""
+    with _lock:
+        counters.clear()
+        histograms.clear()
+
+
+def _labelString(labels, extra=()):
+    """Format labels the way the Prometheus text format expects."""
+    labels = tuple(labels) + tuple(extra)
+    if len(labels) == 0:
+        return ""
+    return "{{{0}}}".format(",".join(
+        '{0}="{1}"'.format(k, v.replace("\\", "\\\\").replace(
+            '"', '\\"').replace("\n", "\\n")) for k, v in labels))
+
+
+def render():
+    """Render every metric in the Prometheus text exposition format."""
+    with _lock:
+        counterItems = sorted(counters.items())
+        histogramItems = sorted((key, list(histogram))
+                                for key, histogram in histograms.items())
+    lines = []
+    typed = set()
+    for (name, labels), value in counterItems:
+        if name not in typed:
+            lines.append("# TYPE {0}{1} counter".format(prefix, name))
+            typed.add(name)
+        lines.append("{0}{1}{2} {3}".format(
+            prefix, name, _labelString(labels), value))
+    for (name, labels), histogram in histogramItems:
+        if name not in typed:
+            lines.append("# TYPE {0}{1} histogram".format(prefix, name))
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip(buckets + ("+Inf",), histogram[:-2]):
+            cumulative += count
+            lines.append("{0}{1}_bucket{2} {3}".format(
+                prefix, name, _labelString(labels, (("le", str(bound)),)),
+                cumulative))
+        lines.append("{0}{1}_sum{2} {3}".format(
+            prefix, name, _labelString(labels), histogram[-2]))
+        lines.append("{0}{1}_count{2} {3}".format(
+            prefix, name, _labelString(labels), histogram[-1]))
+    return "\n".join(lines) + "\n"
+
+
+def snapshot():
+    """Summarize every metric as a JSON-friendly dict."""
+    with _lock:
+        return {
+            'time': time.time(),
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(counters.items())],
+            'histograms': [
+                {'name': name, 'labels': dict(labels),
+                 'buckets': dict(zip([str(b) for b in buckets] + ["+Inf"],
+                                     histogram[:-2])),
+                 'sum': histogram[-2], 'count': histogram[-1]}
+                for (name, labels), histogram in sorted(histograms.items())]
+        }
+
+
+def saveSnapshot(path=None):
+    """Write the JSON snapshot, atomically."""
+    path = path or snapshotPath
+    if path is None:
+        return False
+    f = codecs.open(path + ".tmp", 'w', 'utf-8')
+    json.dump(snapshot(), f)
+    f.close()
+    os.replace(path + ".tmp", path)
+    return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    """Serves the Prometheus text format on /metrics."""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Keep scrapes out of the crawl log."""
+        pass
+
+
+class _Snapshotter(threading.Thread):
+
+    """Thread rewriting the JSON snapshot every snapshotSeconds."""
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(snapshotSeconds):
+            try:
+                saveSnapshot()
+            except OSError as e:
+                logging.error("Could not save metrics: {0}".format(e))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def start():
+    """Start the /metrics endpoint and the periodic JSON snapshot."""
+    """CAVEAT: Returns the bound port, which differs from port if it is 0."""
+    """CAVEAT: If the port is taken, e.g. by another crawler, the endpoint
+    is skipped and None is returned; the snapshot is still written."""
+    global _server
+    global _snapshotter
+    if port is not None and _server is None:
+        try:
+            _server = ThreadingHTTPServer((host, port), _Handler)
+        except OSError as e:
+            logging.error("Could not serve metrics on {0}:{1}: {2}".format(
+                host, port, e))
+        else:
+            thread = threading.Thread(target=_server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            logging.info("Serving metrics on http://{0}:{1}/metrics".format(
+                *_server.server_address))
+    if snapshotPath is not None and snapshotSeconds and _snapshotter is None:
+        _snapshotter = _Snapshotter()
+        _snapshotter.start()
+    return _server.server_address[1] if _server is not None else None
+
+
+def stop():
+    """Stop the endpoint and write a last JSON snapshot."""
+    global _server
+    global _snapshotter
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+    if _snapshotter is not None:
+        _snapshotter.stop()
+        _snapshotter = None
+        saveSnapshot()
@@ -0,0 +1,59 @@
+""" Module for parsing bitcointalk HTML on a pool of worker processes. """
+import bitcointalk
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+import metrics
+import time
+
+parsers = {
+    'board': bitcointalk.parseBoardPage,
+    'member': bitcointalk.parseProfile,
+    'topic': bitcointalk.parseTopicPage
+}
+
+# Worker pool; parsing happens inline until start() is called
+pool = None
+
+
+def _parse(entity, html, *args):
+    """Parse the HTML of the given entity type into a plain record."""
+    return parsers[entity](html, *args)
+
+
+def start(processes=None):
+    """Start the worker pool, defaulting to one process per core."""
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=processes)
+    return pool
+
+
+def stop():
+    """Wait for queued pages and shut the worker pool down."""
+    global pool
+    if pool is not None:
+        pool.shutdown()
+        pool = None
+
+
+def submit(entity, html, *args):
+    """Queue HTML for parsing. Returns a future of the parsed record."""
+    """CAVEAT: Extra args (e.g. todaysDate) are passed on to the parser."""
+    """CAVEAT: Parse time is measured from submission, so includes queuing."""
+    start = time.monotonic()
+    if pool is not None:
+        future = pool.submit(_parse, entity, html, *args)
+    else:
+        future = Future()
+        try:
+            future.set_result(_parse(entity, html, *args))
+        except Exception as e:
+            future.set_exception(e)
+    future.add_done_callback(lambda done: metrics.observe(
+        'parse_seconds', time.monotonic() - start, entity=entity))
+    return future
+
+
+def parse(entity, html, *args):
+    """Parse HTML on the pool, blocking until the record is ready."""
+    return submit(entity, html, *args).result()
@@ -1,16 +1,24 @@
 """ Module for loading parsed data from bitcointalk into PostgreSQL. """
 import codecs
+from contextlib import contextmanager
+import io
+import metrics
 import os
 import psycopg2 as pg2
 import psycopg2.extras as pg2ext
-import random
+import psycopg2.pool as pg2pool
+import threading
+import time
+import weakref
 
 # Configuration variables
 tables = {
     "board": "board",
+    "frontier": "frontier",
     "member": "member",
     "message": "message",
-    "topic": "topic"
+    "topic": "topic",
+    "topic_state": "topic_state"
 }
 
 # Pull in postgres configuration information
@@ -27,18 +35,79 @@ dbcParams = {
 }
 dbcFile.close()
 
-# Connection variable
-conn = None
+# Connection pool shared by threads; each thread holds one connection
+minConnections = 1
+maxConnections = 8
+connectionPool = None
+_poolLock = threading.Lock()
+_local = threading.local()
+
+# Names of the statements prepared on each connection
+_prepared = weakref.WeakKeyDictionary()
+
+
+def _pool():
+    """Create the connection pool on first use."""
+    global connectionPool
+    with _poolLock:
+        if connectionPool is None:
+            connectionPool = pg2pool.ThreadedConnectionPool(
+                minConnections, maxConnections, **dbcParams)
+        return connectionPool
 
 
 def connect():
-    """Connect to the database."""
-    global conn
+    """Connect to the database, pulling this thread's pooled connection."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or conn.closed:
+        conn = _pool().getconn()
+        _local.conn = conn
+    return conn
+
+
+def release():
+    """Hand this thread's connection back to the pool."""
+    conn = getattr(_local, 'conn', None)
     if conn is not None:
-        return conn
-    else:
-        conn = pg2.connect(**dbcParams)
-        return conn
+        _local.conn = None
+        _pool().putconn(conn, close=bool(conn.closed))
+
+
+@contextmanager
+def separateTransaction():
+    """Run the enclosed block on a pooled connection of its own."""
+    """CAVEAT: Commits and rollbacks inside leave the thread's open
+    transaction alone; it is resumed once the block exits."""
+    outer = getattr(_local, 'conn', None)
+    conn = _pool().getconn()
+    _local.conn = conn
+    try:
+        yield conn
+    finally:
+        _local.conn = outer
+        _pool().putconn(conn, close=bool(conn.closed))
+
+
+@contextmanager
+def savepoint(name="block"):
+    """Run the enclosed block so a DB error only undoes its own writes."""
+    """CAVEAT: Earlier writes of the open transaction survive the error."""
+    conn = connect()
+    cursor = conn.cursor()
+    if (conn.status == pg2.extensions.STATUS_IN_TRANSACTION and
+            conn.info.transaction_status ==
+            pg2.extensions.TRANSACTION_STATUS_IDLE):
+        # A bare COMMIT statement ended psycopg2's transaction behind its
+        # back, so it would not open another one
+        cursor.execute("BEGIN")
+    cursor.execute("SAVEPOINT {0}".format(name))
+    try:
+        yield
+    except Exception:
+        if not conn.closed:
+            cursor.execute("ROLLBACK TO SAVEPOINT {0}".format(name))
+        raise
+    cursor.execute("RELEASE SAVEPOINT {0}".format(name))
 
 
 def cursor():
@@ -51,8 +120,21 @@ def dictCursor():
     return connect().cursor(cursor_factory=pg2ext.RealDictCursor)
 
 
+def _execute(cursor, name, query, params, types):
+    """Run a query as a statement prepared once per connection."""
+    """CAVEAT: The query takes $1, $2, ... placeholders of the given types."""
+    prepared = _prepared.setdefault(cursor.connection, set())
+    if name not in prepared:
+        cursor.execute("PREPARE {0} ({1}) AS {2}".format(
+            name, ",".join(types), query))
+        prepared.add(name)
+    cursor.execute("EXECUTE {0} ({1})".format(
+        name, ",".join(["%s"] * len(params))), params)
+
+
 def _insertSingle(datum, tableLabel):
     """Load a single row in to the database."""
+    start = time.monotonic()
     table = tables[tableLabel]
     cursor = dictCursor()
     dataFields = datum.keys()
@@ -64,19 +146,38 @@ def _insertSingle(datum, tableLabel):
             tableFields.append(dataField)
     cursor.execute("""
         DELETE FROM {0}
-        WHERE sid = {1}""".format(table, datum['id']))
+        WHERE sid = %(id)s""".format(table), datum)
     cursor.execute("""INSERT INTO {0} ({1}) VALUES ({2})""".format(
         table,
         ",".join(tableFields),
         ",".join(["%({0})s".format(field) for field in dataFields])), datum)
     cursor.execute("COMMIT")
+    metrics.observe('db_seconds', time.monotonic() - start, op="insert",
+                    table=tableLabel)
+    metrics.increment('db_rows_total', 1, op="insert", table=tableLabel)
 
 
-def _insertBatch(data, tableLabel):
+def _copyValue(value):
+    """Render a value as a field of COPY text format."""
+    if value is None:
+        return "\\N"
+    elif isinstance(value, bytes):
+        value = value.decode('utf-8')
+    else:
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace(
+        "\n", "\\n").replace("\r", "\\r")
+
+
+def _insertBatch(data, tableLabel, commit=True):
     """Load a batch of rows to the database."""
+    """CAVEAT: With commit=False the rows stay in the open transaction."""
+    if len(data) == 0:
+        return
+    start = time.monotonic()
     table = tables[tableLabel]
     cursor = dictCursor()
-    dataFields = data[0].keys()
+    dataFields = list(data[0].keys())
     tableFields = []
     for dataField in dataFields:
         if dataField == "id":
@@ -84,36 +185,52 @@ def _insertBatch(data, tableLabel):
         else:
             tableFields.append(dataField)
 
-    # Create staging table
-    stagingTable = "{0}_{1}".format(
-        table, str(int(pow(10, random.random()*10))).zfill(10))
-    cursor.execute("""CREATE TABLE {0} (LIKE {1}
+    # Session-scoped staging table, created once per connection
+    stagingTable = "{0}_staging".format(table)
+    cursor.execute("""CREATE TEMP TABLE IF NOT EXISTS {0} (LIKE {1}
         )""".format(stagingTable, table))
 
-    # Move data into staging table
-    cursor.executemany("""INSERT INTO {0} ({1}) VALUES ({2})""".format(
-        stagingTable,
-        ",".join(tableFields),
-        ",".join(["%({0})s".format(field) for field in dataFields])), data)
-
-    # Delete old data from original table
+    # Stream the rows into the staging table
+    rows = io.StringIO()
+    for datum in data:
+        rows.write("\t".join(
+            [_copyValue(datum[field]) for field in dataFields]))
+        rows.write("\n")
+    rows.seek(0)
+    cursor.copy_expert("COPY {0} ({1}) FROM STDIN".format(
+        stagingTable, ",".join(tableFields)), rows)
+
+    # Upsert into the target table, leaving unchanged rows untouched
+    updateFields = [field for field in tableFields if field != 'sid']
     cursor.execute("""
-        DELETE FROM {0} t
-        USING {1} s
-        WHERE t.sid = s.sid""".format(table, stagingTable))
+        INSERT INTO {0} AS t ({1})
+        SELECT DISTINCT ON (sid) {1}
+        FROM {2}
+        ORDER BY sid
+        ON CONFLICT (sid) DO UPDATE SET {3},
+            db_update_time = current_timestamp
+        WHERE ({4}) IS DISTINCT FROM ({5})""".format(
+        table, ",".join(tableFields), stagingTable,
+        ",".join(["{0} = EXCLUDED.{0}".format(field)
+                  for field in updateFields]),
+        ",".join(["t.{0}".format(field) for field in updateFields]),
+        ",".join(["EXCLUDED.{0}".format(field) for field in updateFields])))
+
+    # Clear the staging table for the next batch
+    cursor.execute("DELETE FROM {0}".format(stagingTable))
 
-    # Insert the new data into the target table
-    cursor.execute("""
-        INSERT INTO {0}
-        (SELECT *
-        FROM {1})""".format(table, stagingTable))
+    # Commit the transaction
+    if commit:
+        connect().commit()
+    metrics.observe('db_seconds', time.monotonic() - start, op="insert",
+                    table=tableLabel)
+    metrics.increment('db_rows_total', len(data), op="insert",
+                      table=tableLabel)
 
-    # Drop the staging table
-    cursor.execute("""
-        DROP TABLE {0}""".format(stagingTable))
 
-    # Commit the transaction
-    cursor.execute("COMMIT")
+def commit():
+    """Commit rows loaded with commit=False."""
+    connect().commit()
 
 
 def insertBoard(datum):
@@ -121,14 +238,24 @@ def insertBoard(datum):
     _insertSingle(datum, 'board')
 
 
+def insertBoards(data, commit=True):
+    """Load a batch of boards."""
+    _insertBatch(data, 'board', commit)
+
+
 def insertMember(datum):
     """Load a single member."""
     _insertSingle(datum, 'member')
 
 
-def insertMessages(data):
+def insertMembers(data, commit=True):
+    """Load a batch of members."""
+    _insertBatch(data, 'member', commit)
+
+
+def insertMessages(data, commit=True):
     """Load a batch of messages."""
-    _insertBatch(data, 'message')
+    _insertBatch(data, 'message', commit)
 
 
 def insertTopic(datum):
@@ -136,15 +263,31 @@ def insertTopic(datum):
     _insertSingle(datum, 'topic')
 
 
-def _selectSingle(datumId, tableLabel):
+def insertTopics(data, commit=True):
+    """Load a batch of topics."""
+    _insertBatch(data, 'topic', commit)
+
+
+def insertTopicStates(data, commit=True):
+    """Load a batch of topic crawl states."""
+    _insertBatch(data, 'topic_state', commit)
+
+
+def _selectSingle(datumId, tableLabel, required=True):
     """Pull a single datum from the DB."""
+    """CAVEAT: Unless required, a missing datum comes back as None."""
     cursor = dictCursor()
     table = tables[tableLabel]
-    cursor.execute("""SELECT *
-        FROM {0}
-        WHERE sid = {1}""".format(table, datumId))
-    rows = cursor.fetchall()
-    if len(rows) == 0:
+    with metrics.timer('db_seconds', op="select", table=tableLabel):
+        _execute(cursor, "select_{0}".format(table), """SELECT *
+            FROM {0}
+            WHERE sid = $1""".format(table), (datumId,), ["bigint"])
+        rows = cursor.fetchall()
+    metrics.increment('db_rows_total', len(rows), op="select",
+                      table=tableLabel)
+    if len(rows) == 0 and not required:
+        return None
+    elif len(rows) == 0:
         raise Exception("Found 0 entries in DB for {0} ID {1}".format(
             tableLabel, datumId))
     elif len(rows) > 1:
@@ -161,15 +304,18 @@ def _selectBatch(dataIds, tableLabel):
     """Pull batch of data from the DB."""
     cursor = dictCursor()
     table = tables[tableLabel]
-    cursor.execute("""SELECT *
-        FROM {0}
-        WHERE sid IN ({1})
-        ORDER BY sid""".format(
-        table, ",".join([str(datumId) for datumId in dataIds])))
-    rows = cursor.fetchall()
+    dataIds = sorted(set(dataIds))
+    with metrics.timer('db_seconds', op="select", table=tableLabel):
+        _execute(cursor, "select_batch_{0}".format(table), """SELECT *
+            FROM {0}
+            WHERE sid = ANY($1)
+            ORDER BY sid""".format(table), (dataIds,), ["bigint[]"])
+        rows = cursor.fetchall()
+    metrics.increment('db_rows_total', len(rows), op="select",
+                      table=tableLabel)
     if len(rows) != len(dataIds):
-        raise Exception("Found {0} entries, but passed {1} IDs").format(
-            len(rows), len(dataIds))
+        raise Exception("Found {0} entries, but passed {1} IDs".format(
+            len(rows), len(dataIds)))
     else:
         for datum in rows:
             del datum['db_update_time']
@@ -177,14 +323,57 @@ def _selectBatch(dataIds, tableLabel):
         return rows
 
 
-def selectBoard(datumId):
+def currentTime():
+    """Pull the database clock, e.g. as a high-water mark."""
+    cursor = connect().cursor()
+    cursor.execute("SELECT clock_timestamp()")
+    now = cursor.fetchone()[0]
+    connect().commit()
+    return now
+
+
+def selectIds(tableLabel, chunkSize=10000, since=None):
+    """Stream the IDs of a table in ascending chunks of up to chunkSize."""
+    """CAVEAT: Uses a server-side cursor, so rows are not all held at once."""
+    """CAVEAT: With since, only rows updated at or after it are returned."""
+    """CAVEAT: Reads on a pooled connection of its own, so the caller's
+    open transaction is left alone and its uncommitted rows are not seen."""
+    conn = _pool().getconn()
+    cursor = conn.cursor(name="select_ids_{0}".format(tables[tableLabel]))
+    cursor.itersize = chunkSize
+    try:
+        if since is None:
+            cursor.execute("SELECT sid FROM {0} ORDER BY sid".format(
+                tables[tableLabel]))
+        else:
+            cursor.execute("""SELECT sid FROM {0}
+                WHERE db_update_time >= %s
+                ORDER BY sid""".format(tables[tableLabel]), (since,))
+        while True:
+            rows = cursor.fetchmany(chunkSize)
+            if len(rows) == 0:
+                break
+            yield [row[0] for row in rows]
+    finally:
+        cursor.close()
+        if not conn.closed:
+            conn.rollback()
+        _pool().putconn(conn, close=bool(conn.closed))
+
+
+def selectBoard(datumId, required=True):
     """Pull a single board."""
-    return _selectSingle(datumId, 'board')
+    return _selectSingle(datumId, 'board', required)
 
 
-def selectMember(datumId):
+def selectMember(datumId, required=True):
     """Pull a single member."""
-    return _selectSingle(datumId, 'member')
+    return _selectSingle(datumId, 'member', required)
+
+
+def selectMembers(dataIds):
+    """Pull multiple members."""
+    return _selectBatch(dataIds, 'member')
 
 
 def selectMessages(dataIds):
@@ -199,6 +388,180 @@ def selectMessages(dataIds):
     return data
 
 
-def selectTopic(datumId):
+def selectTopic(datumId, required=True):
     """Pull a single topic."""
-    return _selectSingle(datumId, 'topic')
+    return _selectSingle(datumId, 'topic', required)
+
+
+def selectTopicStates(chunkSize=10000):
+    """Stream the crawl state of every topic crawled so far."""
+    """CAVEAT: Reads on a pooled connection of its own, like selectIds."""
+    conn = _pool().getconn()
+    cursor = conn.cursor(name="select_topic_states",
+                         cursor_factory=pg2ext.RealDictCursor)
+    cursor.itersize = chunkSize
+    try:
+        cursor.execute("SELECT * FROM {0}".format(tables['topic_state']))
+        for datum in cursor:
+            del datum['db_update_time']
+            datum['id'] = datum.pop('sid')
+            yield datum
+    finally:
+        cursor.close()
+        if not conn.closed:
+            conn.rollback()
+        _pool().putconn(conn, close=bool(conn.closed))
+
+
+def selectTopicState(datumId):
+    """Pull the crawl state of a topic, or None if never crawled."""
+    return _selectSingle(datumId, 'topic_state', required=False)
+
+
+def frontierStatus():
+    """Pull the latest crawl generation and its count of unfinished items."""
+    cursor = connect().cursor()
+    cursor.execute("""SELECT max(generation),
+        count(*) FILTER (WHERE state IN ('pending', 'running'))
+        FROM {0}""".format(tables['frontier']))
+    generation, unfinished = cursor.fetchone()
+    connect().commit()
+    return generation, unfinished
+
+
+def selectWorkers():
+    """Pull the workers holding running items, with a count for each."""
+    cursor = connect().cursor()
+    cursor.execute("""SELECT worker, count(*) FROM {0}
+        WHERE state = 'running'
+        GROUP BY worker""".format(tables['frontier']))
+    workers = dict(cursor.fetchall())
+    connect().commit()
+    return workers
+
+
+def resetWork(workers):
+    """Hand the running items of the given workers back as pending."""
+    """CAVEAT: Only for workers known to be dead; returns the count."""
+    if len(workers) == 0:
+        return 0
+    cursor = connect().cursor()
+    cursor.execute("""
+        UPDATE {0} SET state = 'pending', lease_until = NULL,
+            db_update_time = current_timestamp
+        WHERE state = 'running' AND worker = ANY(%s)""".format(
+        tables['frontier']), (list(workers),))
+    count = cursor.rowcount
+    connect().commit()
+    return count
+
+
+def addWork(items, generation):
+    """Queue (kind, ID, page, priority) items for a crawl generation."""
+    """CAVEAT: Items already queued in this generation are left alone."""
+    if len(items) == 0:
+        return
+    cursor = connect().cursor()
+    pg2ext.execute_values(cursor, """
+        INSERT INTO {0} AS f (kind, sid, page, priority, generation)
+        VALUES %s
+        ON CONFLICT (kind, sid, page) DO UPDATE SET
+            state = 'pending', attempts = 0, last_error = NULL,
+            not_before = NULL, priority = EXCLUDED.priority,
+            generation = EXCLUDED.generation,
+            db_update_time = current_timestamp
+        WHERE f.generation < EXCLUDED.generation""".format(
+        tables['frontier']),
+        [tuple(item) + (generation,) for item in items])
+    connect().commit()
+
+
+def claimWork(limit, worker=None, leaseSeconds=300):
+    """Lease up to limit pending items to a worker. Returns them as dicts."""
+    """CAVEAT: Items whose lease ran out are claimed again, and rows locked
+    by other workers are skipped rather than waited on."""
+    """CAVEAT: Items backing off after a failure wait until not_before."""
+    cursor = dictCursor()
+    cursor.execute("""
+        UPDATE {0} AS f SET state = 'running', attempts = attempts + 1,
+            worker = %(worker)s,
+            lease_until = current_timestamp + %(lease)s * interval '1 second',
+            db_update_time = current_timestamp
+        FROM (SELECT kind, sid, page FROM {0}
+              WHERE (state = 'pending' AND (not_before IS NULL OR
+                  not_before <= current_timestamp)) OR
+                  (state = 'running' AND lease_until < current_timestamp)
+              ORDER BY priority, sid, page
+              LIMIT %(limit)s
+              FOR UPDATE SKIP LOCKED) AS w
+        WHERE f.kind = w.kind AND f.sid = w.sid AND f.page = w.page
+        RETURNING f.kind, f.sid AS id, f.page, f.priority, f.attempts
+        """.format(tables['frontier']), {
+        'worker': worker,
+        'lease': leaseSeconds,
+        'limit': limit
+    })
+    items = sorted(cursor.fetchall(), key=lambda item: (
+        item['priority'], item['id'], item['page']))
+    connect().commit()
+    return items
+
+
+def renewWork(items, worker, leaseSeconds=300):
+    """Extend the lease on items a worker still holds. Returns the count."""
+    if len(items) == 0:
+        return 0
+    cursor = connect().cursor()
+    cursor.execute("""
+        UPDATE {0} AS f SET
+            lease_until = current_timestamp + %(lease)s * interval '1 second'
+        FROM unnest(%(kinds)s::varchar[], %(ids)s::integer[],
+                    %(pages)s::integer[]) AS w (kind, sid, page)
+        WHERE f.kind = w.kind AND f.sid = w.sid AND f.page = w.page AND
+            f.state = 'running' AND f.worker = %(worker)s
+        """.format(tables['frontier']), {
+        'worker': worker,
+        'lease': leaseSeconds,
+        'kinds': [item[0] for item in items],
+        'ids': [item[1] for item in items],
+        'pages': [item[2] for item in items]
+    })
+    count = cursor.rowcount
+    connect().commit()
+    return count
+
+
+def finishWork(items, state, error=None, maxAttempts=0, worker=None,
+               retrySeconds=0):
+    """Mark claimed (kind, ID, page) items as done or failed."""
+    """CAVEAT: Items with fewer than maxAttempts attempts go back to
+    pending instead, not to be claimed for retrySeconds, doubled on every
+    further attempt."""
+    """CAVEAT: With a worker, items since leased to another are left alone."""
+    if len(items) == 0:
+        return
+    cursor = connect().cursor()
+    cursor.execute("""
+        UPDATE {0} AS f SET
+            state = CASE WHEN f.attempts < %(maxAttempts)s
+                THEN 'pending' ELSE %(state)s END,
+            not_before = CASE WHEN f.attempts < %(maxAttempts)s
+                THEN current_timestamp + %(retry)s * 2 ^ (f.attempts - 1) *
+                    interval '1 second' END,
+            last_error = %(error)s, lease_until = NULL,
+            db_update_time = current_timestamp
+        FROM unnest(%(kinds)s::varchar[], %(ids)s::integer[],
+                    %(pages)s::integer[]) AS w (kind, sid, page)
+        WHERE f.kind = w.kind AND f.sid = w.sid AND f.page = w.page AND
+            (%(worker)s::varchar IS NULL OR f.worker = %(worker)s)
+        """.format(tables['frontier']), {
+        'worker': worker,
+        'maxAttempts': maxAttempts,
+        'retry': retrySeconds,
+        'state': state,
+        'error': error,
+        'kinds': [item[0] for item in items],
+        'ids': [item[1] for item in items],
+        'pages': [item[2] for item in items]
+    })
+    connect().commit()
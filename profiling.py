@@ -0,0 +1,177 @@
+""" Module for opt-in CPU and allocation profiling of crawl hot paths. """
+import atexit
+import codecs
+import cProfile
+import importlib
+import io
+import logging
+import os
+import pstats
+from random import random
+import threading
+import tracemalloc
+
+# Set BITCOINTALK_PROFILE=1 (or pass --profile) to profile a crawl
+enabled = os.environ.get("BITCOINTALK_PROFILE", "") not in ("", "0")
+# Share of calls profiled; the rest run untouched
+sampleRate = float(os.environ.get("BITCOINTALK_PROFILE_SAMPLE", "0.1"))
+outputPath = os.environ.get(
+    "BITCOINTALK_PROFILE_PATH",
+    "{0}/data/profile".format(os.path.dirname(os.path.abspath(__file__))))
+# Results are also written every this many samples, since parse pool
+# workers exit without running atexit hooks
+dumpEvery = 100
+# Rows per function in the text report, and frames kept per allocation
+topCount = 25
+traceFrames = 1
+
+# (module, function) pairs wrapped by install()
+targets = [
+    ('bitcointalk', 'parseBoardPage'),
+    ('bitcointalk', 'parseProfile'),
+    ('bitcointalk', 'parseTopicPage'),
+    ('pg', '_insertBatch'),
+    ('pg', '_insertSingle'),
+    ('memoizer', '_scrape')
+]
+
+# {"module.function": {'calls', 'samples', 'profile', 'allocations', ...}}
+stats = {}
+_originals = {}
+# Held while a call is sampled, so samples never nest or overlap
+_sampling = threading.Lock()
+_samples = 0
+_installed = False
+
+
+def _sample(name, function, args, kwargs):
+    """Run a call under cProfile and tracemalloc, recording its stats."""
+    global _samples
+    entry = stats[name]
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start(traceFrames)
+    tracemalloc.clear_traces()
+    tracemalloc.reset_peak()
+    try:
+        return entry['profile'].runcall(function, *args, **kwargs)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if not tracing:
+            tracemalloc.stop()
+        allocations = entry['allocations']
+        for statistic in snapshot.statistics('lineno'):
+            site = str(statistic.traceback)
+            size, count = allocations.get(site, (0, 0))
+            allocations[site] = (size + statistic.size,
+                                 count + statistic.count)
+        entry['samples'] += 1
+        entry['peak'] = max(entry['peak'], peak)
+        _samples += 1
+        if _samples % dumpEvery == 0:
+            dump()
+
+
+def _wrap(name, function):
+    """Wrap a function so a sample of its calls is profiled."""
+    stats[name] = {'calls': 0, 'samples': 0, 'peak': 0,
+                   'profile': cProfile.Profile(), 'allocations': {}}
+
+    def wrapper(*args, **kwargs):
+        stats[name]['calls'] += 1
+        if random() < sampleRate and _sampling.acquire(blocking=False):
+            try:
+                return _sample(name, function, args, kwargs)
+            finally:
+                _sampling.release()
+        return function(*args, **kwargs)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+def install(force=False):
+    """Wrap the target functions if profiling is enabled. Returns enabled."""
+    """CAVEAT: Call before parsepool.start(), so forked workers inherit it."""
+    """CAVEAT: Parser references held in parsepool.parsers are swapped too."""
+    global _installed
+    if not (enabled or force) or _installed:
+        return _installed
+    import parsepool
+    for moduleName, functionName in targets:
+        module = importlib.import_module(moduleName)
+        function = getattr(module, functionName)
+        name = "{0}.{1}".format(moduleName, functionName)
+        wrapper = _wrap(name, function)
+        _originals[name] = (module, functionName, function)
+        setattr(module, functionName, wrapper)
+        for entity, parser in parsepool.parsers.items():
+            if parser is function:
+                parsepool.parsers[entity] = wrapper
+    _installed = True
+    atexit.register(dump)
+    logging.info("Profiling {0} of calls to {1} functions.".format(
+        sampleRate, len(targets)))
+    return True
+
+
+def uninstall():
+    """Restore the original functions and drop collected stats."""
+    global _installed
+    import parsepool
+    for name, (module, functionName, function) in _originals.items():
+        wrapper = getattr(module, functionName)
+        setattr(module, functionName, function)
+        for entity, parser in parsepool.parsers.items():
+            if parser is wrapper:
+                parsepool.parsers[entity] = function
+    _originals.clear()
+    stats.clear()
+    if _installed:
+        atexit.unregister(dump)
+    _installed = False
+
+
+def report():
+    """Summarize CPU hot spots and allocation sites per function as text."""
+    lines = []
+    for name, entry in sorted(stats.items()):
+        lines.append("=" * 78)
+        lines.append("{0}: {1} calls, {2} sampled, peak {3:.1f} KiB".format(
+            name, entry['calls'], entry['samples'], entry['peak'] / 1024.0))
+        if entry['samples'] == 0:
+            continue
+        stream = io.StringIO()
+        pstats.Stats(entry['profile'], stream=stream).sort_stats(
+            'cumulative').print_stats(topCount)
+        lines.append(stream.getvalue().strip())
+        lines.append("")
+        lines.append("Top allocation sites (retained by sampled calls):")
+        allocations = sorted(entry['allocations'].items(),
+                             key=lambda item: item[1][0], reverse=True)
+        for site, (size, count) in allocations[:topCount]:
+            lines.append("{0:>12.1f} KiB {1:>9} blocks  {2}".format(
+                size / 1024.0, count, site))
+    return "\n".join(lines) + "\n"
+
+
+def dump():
+    """Write per-function .prof files and a text report for this process."""
+    """CAVEAT: Files are suffixed with the PID, one set per process."""
+    if len(stats) == 0:
+        return False
+    if not os.path.isdir(outputPath):
+        os.makedirs(outputPath)
+    pid = os.getpid()
+    for name, entry in stats.items():
+        if entry['samples'] > 0:
+            entry['profile'].dump_stats("{0}/{1}.{2}.prof".format(
+                outputPath, name, pid))
+    path = "{0}/report.{1}.txt".format(outputPath, pid)
+    f = codecs.open(path + ".tmp", 'w', 'utf-8')
+    f.write(report())
+    f.close()
+    os.replace(path + ".tmp", path)
+    return True
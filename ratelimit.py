@@ -0,0 +1,81 @@
+""" Module for pacing requests to bitcointalk.org. """
+import asyncio
+import logging
+import threading
+import time
+
+
+class TokenBucket(object):
+
+    """Token bucket whose rate adapts to the server's responses (AIMD)."""
+
+    def __init__(self, rate=0.5, burst=1, minRate=0.05, maxRate=1.0,
+                 increase=0.01, decrease=0.5, latencyTarget=5.0,
+                 cooldown=10.0, clock=time.monotonic):
+        """Create a bucket issuing rate tokens/sec, holding at most burst."""
+        self.rate = rate
+        self.burst = burst
+        self.minRate = minRate
+        self.maxRate = maxRate
+        self.increase = increase
+        self.decrease = decrease
+        self.latencyTarget = latencyTarget
+        self.cooldown = cooldown
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+        self.lastDecrease = None
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        """Add the tokens accrued since the last update."""
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Take a token and return the seconds to wait before using it."""
+        """CAVEAT: Tokens may go negative; callers queue up behind the debt."""
+        with self.lock:
+            self._refill(self.clock())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        """Block until a token is available. Returns the time slept."""
+        timeToSleep = self.reserve()
+        if timeToSleep > 0:
+            logging.info("Sleeping for {0} seconds before request.".format(
+                timeToSleep))
+            time.sleep(timeToSleep)
+        return timeToSleep
+
+    async def acquireAsync(self):
+        """Wait without blocking the loop until a token is available."""
+        timeToSleep = self.reserve()
+        if timeToSleep > 0:
+            logging.info("Sleeping for {0} seconds before request.".format(
+                timeToSleep))
+            await asyncio.sleep(timeToSleep)
+        return timeToSleep
+
+    def observe(self, statusCode, latency):
+        """Adjust the rate to the outcome of a request."""
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            if statusCode in (429, 503) or latency > self.latencyTarget:
+                # Back off at most once per cooldown for a burst of failures
+                if (self.lastDecrease is not None and
+                        now - self.lastDecrease < self.cooldown):
+                    return self.rate
+                self.lastDecrease = now
+                self.rate = max(self.minRate, self.rate * self.decrease)
+                self.tokens = min(self.tokens, 0)
+                logging.info("Throttling back to {0} requests/sec.".format(
+                    self.rate))
+            else:
+                self.rate = min(self.maxRate, self.rate + self.increase)
+            return self.rate
@@ -0,0 +1,113 @@
+""" Recrawl known topics, most likely changed first, on a request budget. """
+import argparse
+import atexit
+import bitcointalk
+import logging
+import memoizer
+import metrics
+import os
+import parsepool
+import pg
+import profiling
+import scheduler
+import signal
+import sys
+import time
+import traceback
+import writebehind
+
+
+def schedule(queue):
+    """Queue every known topic by its crawl state."""
+    states = {}
+    for state in pg.selectTopicStates():
+        states[state['id']] = state
+    for topicId in memoizer.memo['topics']:
+        queue.push(topicId, states.get(topicId))
+    return len(queue)
+
+
+def refreshTopic(topicId):
+    """Scrape new messages of a topic and any new posters."""
+    for batch in memoizer.scrapeTopicMessages(topicId):
+        memoizer.scrapeMembers([message['member']
+                                for pageNum, messages in batch
+                                for message in messages])
+    return memoizer.selectTopicState(topicId)
+
+
+def runCycle(queue, budget):
+    """Refresh topics in priority order until budget requests are spent."""
+    """CAVEAT: Stops early once every queued topic was refreshed."""
+    countRequestedStart = bitcointalk.countRequested
+    refreshed = set()
+    while (len(queue) > 0 and
+           bitcointalk.countRequested - countRequestedStart < budget):
+        if queue.peek()[0] in refreshed:
+            break
+        topicId, due = queue.pop()
+        writebehind.flushIfDue()
+        try:
+            state = refreshTopic(topicId)
+        except Exception as e:
+            print('-' * 60)
+            print("Could not refresh topic {0}:".format(topicId))
+            print(traceback.format_exc())
+            print('-' * 60)
+            logging.info(">Could not refresh topic {0}:".format(topicId))
+            state = memoizer.selectTopicState(topicId)
+        queue.push(topicId, state)
+        refreshed.add(topicId)
+    logging.info("Refreshed {0} topics with {1} requests.".format(
+        len(refreshed), bitcointalk.countRequested - countRequestedStart))
+    return len(refreshed)
+
+
+def main(argv=None):
+    argParser = argparse.ArgumentParser(description=__doc__.strip())
+    argParser.add_argument("--budget", type=int, default=1000,
+                           help="Requests to spend per cycle.")
+    argParser.add_argument("--cycles", type=int, default=1,
+                           help="Cycles to run, or 0 to run until stopped.")
+    argParser.add_argument("--interval", type=float, default=3600,
+                           help="Seconds between the start of cycles.")
+    argParser.add_argument("--profile", action="store_true",
+                           help="Sample CPU and allocation hot spots.")
+    args = argParser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s:%(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    profiling.install(args.profile)
+    parsepool.start()
+    metrics.start()
+    atexit.register(metrics.stop)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    memoizer.remember()
+    atexit.register(memoizer.saveSnapshot)
+    validatorsFile = "{0}/data/validators.json".format(
+        os.path.dirname(os.path.abspath(__file__)))
+    bitcointalk.loadValidators(validatorsFile)
+    atexit.register(bitcointalk.saveValidators, validatorsFile)
+
+    queue = scheduler.Scheduler()
+    logging.info("Scheduled {0} topics.".format(schedule(queue)))
+    cycle = 0
+    while args.cycles == 0 or cycle < args.cycles:
+        cycleStart = time.time()
+        runCycle(queue, args.budget)
+        writebehind.flush()
+        cycle += 1
+        if args.cycles == 0 or cycle < args.cycles:
+            time.sleep(max(0, args.interval - (time.time() - cycleStart)))
+
+    parsepool.stop()
+    writebehind.flush()
+    logging.info("All done.")
+    logging.info("Made {0} requests in total.".format(
+        bitcointalk.countRequested))
+
+if __name__ == "__main__":
+    main()
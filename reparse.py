@@ -0,0 +1,170 @@
+""" Offline re-parse of saved bitcointalk HTML into PostgreSQL. """
+import archive
+import argparse
+import codecs
+from collections import deque
+from datetime import datetime
+import logging
+import os
+import parsepool
+import pg
+import profiling
+import re
+import writebehind
+
+baseDir = os.path.dirname(os.path.abspath(__file__))
+
+# Files written by memoizer._saveToFile, e.g. topicpage_14.20_1404000000.html
+filePattern = re.compile(
+    r"^(board|boardpage|member|topic|topicpage|topicall)_(\d+)"
+    r"(?:\.(\d+))?_(\d+)\.html$")
+
+# Parser used for each saved page type; board pages only hold topic IDs
+parserEntities = {
+    'board': 'board',
+    'member': 'member',
+    'topic': 'topic',
+    'topicpage': 'topic',
+    'topicall': 'topic'
+}
+
+
+def findFiles(dataDir):
+    """List (fileType, ID, offset, fetch time, path) of saved HTML files."""
+    pages = []
+    for name in os.listdir(dataDir):
+        match = filePattern.match(name)
+        if match is None:
+            continue
+        fileType, entityId, offset, fetchTime = match.groups()
+        pages.append((fileType, int(entityId), int(offset or 0),
+                      int(fetchTime), os.path.join(dataDir, name)))
+    return pages
+
+
+def findPages(dataDir=None, store=None, fileTypes=None):
+    """Pick the latest saved copy of every page in the files and archive."""
+    """CAVEAT: Returns {(fileType, ID, offset): (fetch time, source)}."""
+    latest = {}
+    candidates = []
+    if dataDir is not None:
+        candidates += findFiles(dataDir)
+    if store is not None:
+        candidates += [key + (store,) for key in store.keys()]
+    for fileType, entityId, offset, fetchTime, source in candidates:
+        if fileType not in (fileTypes or parserEntities):
+            continue
+        key = (fileType, entityId, offset)
+        if key not in latest or latest[key][0] < fetchTime:
+            latest[key] = (fetchTime, source)
+    return latest
+
+
+def _readPage(key, source):
+    """Read a page from its file path or archive."""
+    if isinstance(source, archive.Archive):
+        fileType, entityId, offset = key
+        return source.get(fileType, entityId, offset)
+    f = codecs.open(source, 'r', 'utf-8')
+    html = f.read()
+    f.close()
+    return html
+
+
+def _submit(key, fetchTime, source):
+    """Queue a page for parsing as of the day it was fetched."""
+    entity = parserEntities[key[0]]
+    html = _readPage(key, source)
+    if entity == 'board':
+        return parsepool.submit(entity, html)
+    # "Today at" timestamps refer to the fetch date, not the reparse date
+    todaysDate = datetime.utcfromtimestamp(fetchTime).date()
+    return parsepool.submit(entity, html, todaysDate)
+
+
+def _load(fileType, data):
+    """Load a parsed page through the pg module."""
+    if fileType == 'board':
+        del data['topic_ids']
+        writebehind.add('board', data)
+    elif fileType == 'member':
+        writebehind.add('member', data)
+    elif fileType == 'topic':
+        del data['all_view']
+        if len(data['messages']) > 0:
+            pg.insertMessages(data.pop('messages'), commit=False)
+        else:
+            del data['messages']
+        writebehind.add('topic', data)
+    elif len(data['messages']) > 0:
+        pg.insertMessages(data['messages'], commit=False)
+
+
+def run(dataDir=None, store=None, processes=None, fileTypes=None):
+    """Re-parse saved pages on all cores and load them. Returns the count."""
+    pages = findPages(dataDir, store, fileTypes)
+    logging.info("Re-parsing {0} saved pages...".format(len(pages)))
+    parsepool.start(processes)
+    maxPending = 4 * (os.cpu_count() if processes is None else processes)
+    pending = deque()
+    loaded = 0
+    failed = 0
+    keys = iter(sorted(pages.keys()))
+    while True:
+        # Keep the workers busy without reading every page into memory
+        for key in keys:
+            pending.append((key, _submit(key, *pages[key])))
+            if len(pending) >= maxPending:
+                break
+        if len(pending) == 0:
+            break
+        key, future = pending.popleft()
+        try:
+            # A page the DB rejects must not abort the rest of the batch
+            with pg.savepoint("reparse_page"):
+                _load(key[0], future.result())
+            loaded += 1
+        except Exception as e:
+            logging.error("Could not re-parse {0}: {1}".format(key, e))
+            failed += 1
+        if (loaded + failed) % 1000 == 0:
+            pg.commit()
+            logging.info("Re-parsed {0} of {1} pages...".format(
+                loaded + failed, len(pages)))
+    writebehind.flush()
+    pg.commit()
+    parsepool.stop()
+    logging.info("Loaded {0} pages, {1} failed.".format(loaded, failed))
+    return loaded
+
+
+def main(argv=None):
+    argParser = argparse.ArgumentParser(description=__doc__.strip())
+    argParser.add_argument("--data-dir", default="{0}/data".format(baseDir),
+                           help="Directory of per-page HTML files.")
+    argParser.add_argument("--archive", default="{0}/data/archive".format(
+        baseDir), help="Page archive directory.")
+    argParser.add_argument("--processes", type=int, default=None)
+    argParser.add_argument("--type", action="append",
+                           choices=sorted(parserEntities.keys()),
+                           help="Only re-parse these page types.")
+    argParser.add_argument("--profile", action="store_true",
+                           help="Sample CPU and allocation hot spots.")
+    args = argParser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s:%(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    profiling.install(args.profile)
+    store = None
+    if os.path.isdir(args.archive):
+        store = archive.Archive(args.archive)
+    dataDir = args.data_dir if os.path.isdir(args.data_dir) else None
+    run(dataDir, store, args.processes, args.type)
+    if store is not None:
+        store.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+""" Module for scheduling topic recrawls by how likely topics have changed. """
+from datetime import datetime
+from datetime import timezone
+import heapq
+import math
+
+# Views count for this much of a new message when estimating activity
+readWeight = 0.01
+# Past observations lose half their weight after this many seconds
+halfLife = 7 * 86400.0
+# Change rate (per second) assumed for topics without history
+defaultRate = 1.0 / 86400
+
+
+def now():
+    """Pull the current time as the crawl state stores it."""
+    return datetime.now(timezone.utc)
+
+
+def observe(previous, countRead, lastPosition, when=None):
+    """Update a topic's change rate from a new crawl of it."""
+    """CAVEAT: Returns count_read, change_rate, crawl_time and change_time."""
+    when = when or now()
+    if previous is None or previous.get('crawl_time') is None:
+        return {
+            'count_read': countRead,
+            'change_rate': defaultRate,
+            'crawl_time': when,
+            'change_time': when
+        }
+    elapsed = max((when - previous['crawl_time']).total_seconds(), 1.0)
+    newMessages = max(lastPosition - previous['last_position'], 0)
+    newReads = max((countRead or 0) - (previous['count_read'] or 0), 0)
+    changes = newMessages + readWeight * newReads
+
+    # Weigh the latest interval by how long it covered
+    alpha = 1 - 0.5 ** (elapsed / halfLife)
+    rate = previous['change_rate'] or defaultRate
+    rate = alpha * changes / elapsed + (1 - alpha) * rate
+    if newMessages == 0:
+        # A topic quiet for a long time is unlikely to change soon
+        sinceChange = (when - previous['change_time']).total_seconds()
+        rate = min(rate, 1.0 / max(sinceChange, 1.0))
+    return {
+        'count_read': countRead,
+        'change_rate': rate,
+        'crawl_time': when,
+        'change_time': when if newMessages > 0 else previous['change_time']
+    }
+
+
+def probability(state, when=None):
+    """Estimate the chance a topic changed since it was last crawled."""
+    if state is None or state.get('crawl_time') is None:
+        return 1.0
+    when = when or now()
+    age = max((when - state['crawl_time']).total_seconds(), 0.0)
+    return 1 - math.exp(-(state.get('change_rate') or defaultRate) * age)
+
+
+class Scheduler(object):
+
+    """Priority queue of topics, soonest expected to have changed first."""
+
+    def __init__(self, threshold=1.0, minInterval=600.0,
+                 maxInterval=30 * 86400.0):
+        """Recrawl once threshold changes are expected, within bounds."""
+        self.threshold = threshold
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.heap = []
+        self.due = {}
+
+    def dueTime(self, state):
+        """Pull when a topic is next expected to have changed (epoch)."""
+        if state is None or state.get('crawl_time') is None:
+            return 0.0
+        rate = state.get('change_rate') or defaultRate
+        interval = min(max(self.threshold / rate, self.minInterval),
+                       self.maxInterval)
+        return state['crawl_time'].timestamp() + interval
+
+    def push(self, topicId, state=None):
+        """Queue a topic, replacing any earlier entry for it."""
+        due = self.dueTime(state)
+        self.due[topicId] = due
+        heapq.heappush(self.heap, (due, topicId))
+
+    def peek(self):
+        """Pull the (topic ID, due time) most likely to have changed."""
+        while len(self.heap) > 0:
+            due, topicId = self.heap[0]
+            if self.due.get(topicId) == due:
+                return topicId, due
+            # Drop entries superseded by a later push
+            heapq.heappop(self.heap)
+        raise IndexError("No topics scheduled")
+
+    def pop(self):
+        """Pull and unqueue the topic most likely to have changed."""
+        topicId, due = self.peek()
+        heapq.heappop(self.heap)
+        del self.due[topicId]
+        return topicId, due
+
+    def __len__(self):
+        return len(self.due)
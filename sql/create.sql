@@ -29,6 +29,40 @@ CREATE TABLE IF NOT EXISTS topic (
 );
 CREATE INDEX ON topic (name);
 CREATE INDEX ON topic (board);
+CREATE INDEX ON topic (db_update_time);
+
+CREATE TABLE IF NOT EXISTS topic_state (
+    sid INTEGER,
+    num_pages INTEGER,
+    last_page INTEGER,
+    last_position INTEGER,
+    count_read INTEGER,
+    change_rate DOUBLE PRECISION,
+    crawl_time TIMESTAMP WITH TIME ZONE,
+    change_time TIMESTAMP WITH TIME ZONE,
+    db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    PRIMARY KEY (sid)
+);
+
+CREATE TABLE IF NOT EXISTS frontier (
+    kind VARCHAR(16),
+    sid INTEGER,
+    page INTEGER,
+    priority SMALLINT,
+    generation INTEGER,
+    state VARCHAR(16) DEFAULT 'pending',
+    attempts INTEGER DEFAULT 0,
+    last_error TEXT,
+    worker VARCHAR(255),
+    lease_until TIMESTAMP WITH TIME ZONE,
+    not_before TIMESTAMP WITH TIME ZONE,
+    db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    PRIMARY KEY (kind, sid, page)
+);
+ALTER TABLE frontier ADD COLUMN IF NOT EXISTS
+    not_before TIMESTAMP WITH TIME ZONE;
+CREATE INDEX ON frontier (state, priority, sid, page);
+CREATE INDEX ON frontier (lease_until) WHERE state = 'running';
 
 CREATE TABLE IF NOT EXISTS board (
     sid INTEGER,
@@ -40,6 +74,7 @@ CREATE TABLE IF NOT EXISTS board (
     PRIMARY KEY(sid)
 );
 CREATE INDEX ON board (name);
+CREATE INDEX ON board (db_update_time);
 
 CREATE TABLE IF NOT EXISTS member (
     sid INTEGER,
@@ -57,4 +92,5 @@ CREATE TABLE IF NOT EXISTS member (
     PRIMARY KEY(sid)
 );
 CREATE INDEX ON member (name);
-CREATE INDEX ON member (bitcoin_address);
\ No newline at end of file
+CREATE INDEX ON member (bitcoin_address);
+CREATE INDEX ON member (db_update_time);
\ No newline at end of file
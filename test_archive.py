@@ -0,0 +1,141 @@
+import unittest
+import codecs
+import multiprocessing
+import os
+import shutil
+import tempfile
+from archive import *
+
+
+class TestArchive(unittest.TestCase):
+
+    """"Testing suite for archive module."""
+
+    def setUp(self):
+        """Setup an empty archive directory."""
+        self.path = tempfile.mkdtemp()
+        f = codecs.open("{0}/dummy/dummy_topic.html".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r', 'utf-8')
+        self.html = f.read()
+        f.close()
+
+    def tearDown(self):
+        """Remove the archive directory."""
+        shutil.rmtree(self.path)
+
+    def testAppendAndGet(self):
+        """Test storing and reading back pages."""
+        store = Archive(self.path)
+        store.append("topicpage", 14, self.html, 0, 1000)
+        store.append("topicpage", 14, self.html + u"é", 0, 2000)
+        store.append("member", 12, u"<html>12</html>", fetchTime=1500)
+        self.assertEqual(store.get("topicpage", 14), self.html + u"é")
+        self.assertEqual(store.get("topicpage", 14, 0, 1000), self.html)
+        self.assertEqual(store.get("member", 12), u"<html>12</html>")
+        self.assertEqual(store.versions("topicpage", 14), [1000, 2000])
+        # Pages appended after a read come back through a fresh mapping
+        store.append("member", 13, u"<html>13</html>", fetchTime=1500)
+        self.assertEqual(store.get("member", 13), u"<html>13</html>")
+        self.assertEqual(sorted(store.keys()), [
+            ("member", 12, 0, 1500),
+            ("member", 13, 0, 1500),
+            ("topicpage", 14, 0, 1000),
+            ("topicpage", 14, 0, 2000)])
+        self.assertEqual(len(store), 4)
+        with self.assertRaises(KeyError):
+            store.get("topicpage", 14, 20)
+        with self.assertRaises(KeyError):
+            store.get("topicpage", 14, 0, 3000)
+        store.close()
+
+        # Compressed pages take far less room than the HTML
+        segmentSize = os.path.getsize(
+            os.path.join(self.path, "segment_000000.dat"))
+        self.assertTrue(segmentSize < len(self.html))
+
+    def testReopen(self):
+        """Test that pages survive reopening the archive."""
+        store = Archive(self.path)
+        store.append("board", 74, self.html, fetchTime=1000)
+        store.close()
+        store = Archive(self.path)
+        self.assertEqual(store.get("board", 74), self.html)
+        store.append("board", 5, u"<html>5</html>", fetchTime=1000)
+        self.assertEqual(store.get("board", 5), u"<html>5</html>")
+        store.close()
+
+    def testSegments(self):
+        """Test rolling over to new segment files."""
+        store = Archive(self.path, segmentSize=1)
+        for offset in range(0, 100, 20):
+            store.append("topicpage", 14, self.html + str(offset), offset)
+        # Read back one page before writing more to the open segment
+        self.assertEqual(store.get("topicpage", 14, 40), self.html + "40")
+        store.close()
+        self.assertEqual(len([name for name in os.listdir(self.path)
+                              if name.startswith("segment_")]), 5)
+        store = Archive(self.path, segmentSize=1)
+        store.append("topicpage", 14, self.html, 100)
+        self.assertEqual(store.get("topicpage", 14, 100), self.html)
+        for offset in range(0, 100, 20):
+            self.assertEqual(
+                store.get("topicpage", 14, offset), self.html + str(offset))
+        store.close()
+
+    def testPartialIndex(self):
+        """Test recovering from an index record cut short by a crash."""
+        store = Archive(self.path)
+        store.append("member", 12, self.html, fetchTime=1000)
+        store.close()
+        f = open(os.path.join(self.path, "index.dat"), 'ab')
+        f.write(b"\0" * 7)
+        f.close()
+        store = Archive(self.path)
+        self.assertEqual(len(store), 1)
+        store.append("member", 13, self.html, fetchTime=1000)
+        store.close()
+        store = Archive(self.path)
+        self.assertEqual(store.get("member", 13), self.html)
+        store.close()
+
+    def testProcesses(self):
+        """Test that processes appending to one archive keep it consistent."""
+        store = Archive(self.path, segmentSize=256)
+        store.append("member", 1, u"<html>1</html>", fetchTime=1000)
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(2)
+        try:
+            pool.starmap(_appendPages, [(self.path, 100), (self.path, 200)])
+        finally:
+            pool.close()
+            pool.join()
+        # Pages from the other processes are found by an open archive
+        self.assertEqual(store.get("member", 249), _page(249))
+        store.append("member", 2, u"<html>2</html>", fetchTime=1000)
+        store.close()
+
+        store = Archive(self.path, segmentSize=256)
+        self.assertEqual(len(store), 2 + 2 * 50)
+        for memberId in list(range(100, 150)) + list(range(200, 250)):
+            self.assertEqual(store.get("member", memberId), _page(memberId))
+        self.assertEqual(store.get("member", 2), u"<html>2</html>")
+        self.assertTrue(len([name for name in os.listdir(self.path)
+                             if name.startswith("segment_")]) > 1)
+        store.close()
+
+
+def _page(memberId):
+    """Build a stand-in profile page."""
+    return u"<html>{0}</html>".format(str(memberId) * 100)
+
+
+def _appendPages(path, firstId):
+    """Append pages from a separate process."""
+    store = Archive(path, segmentSize=256)
+    for memberId in range(firstId, firstId + 50):
+        store.append("member", memberId, _page(memberId), fetchTime=1000)
+    store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
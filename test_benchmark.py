@@ -0,0 +1,57 @@
+import unittest
+import benchmark
+import os
+import shutil
+import tempfile
+
+
+class TestBenchmark(unittest.TestCase):
+
+    """"Testing suite for benchmark module."""
+
+    def testRun(self):
+        """Test that each parser reports the expected statistics."""
+        results = benchmark.run(1)
+        self.assertEqual(
+            sorted(results.keys()),
+            ['parseBoardPage', 'parseProfile', 'parseTopicPage'])
+        self.assertEqual(results['parseTopicPage']['pages'], 4)
+        self.assertTrue(results['parseTopicPage']['messages_per_sec'] > 0)
+        self.assertEqual(results['parseProfile']['messages_per_sec'], 0)
+        for stats in results.values():
+            self.assertTrue(stats['p50_ms'] <= stats['p99_ms'])
+            self.assertTrue(stats['peak_memory_bytes'] > 0)
+
+    def testCompare(self):
+        """Test that slower or hungrier parsers are flagged."""
+        baseline = {'parseProfile': {
+            'pages': 2, 'p50_ms': 1.0, 'pages_per_sec': 100.0,
+            'messages_per_sec': 0, 'peak_memory_bytes': 1000}}
+        results = {'parseProfile': {
+            'pages': 2, 'p50_ms': 1.1, 'pages_per_sec': 90.0,
+            'messages_per_sec': 0, 'peak_memory_bytes': 1000}}
+        self.assertEqual(benchmark.compare(results, baseline), [])
+        results['parseProfile']['p50_ms'] = 2.0
+        results['parseProfile']['pages_per_sec'] = 50.0
+        regressions = benchmark.compare(results, baseline)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith("parseProfile p50_ms"))
+
+    def testMain(self):
+        """Test saving a baseline and checking against it."""
+        directory = tempfile.mkdtemp()
+        try:
+            baseline = os.path.join(directory, "baseline.json")
+            output = os.path.join(directory, "results.json")
+            args = ["--iterations", "1", "--parser", "parseProfile",
+                    "--baseline", baseline]
+            self.assertEqual(benchmark.main(args + ["--save-baseline"]), 0)
+            self.assertTrue(os.path.exists(baseline))
+            self.assertEqual(benchmark.main(
+                args + ["--output", output, "--tolerance", "100"]), 0)
+            self.assertTrue(os.path.exists(output))
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    unittest.main()
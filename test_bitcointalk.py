@@ -1,5 +1,12 @@
 import unittest
+import bitcointalk
 from bitcointalk import *
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import gzip
+import pickle
+import shutil
+import tempfile
 
 class TestBitcointalk(unittest.TestCase):
 
@@ -50,6 +57,14 @@ class TestBitcointalk(unittest.TestCase):
         f.write(html)
         f.close()
 
+    def testSelectors(self):
+        """Method for testing that parser selectors are precompiled."""
+        for name, selector in selectors.items():
+            self.assertIsInstance(selector, lxml.etree.XPath, name)
+        docRoot = lxml.html.fromstring("<html><title>t</title></html>")
+        self.assertEqual(
+            selectors['title'](docRoot), docRoot.cssselect("title"))
+
     def testParseBoardPage(self):
         """Method for testing parseBoardPage."""
         f = codecs.open("{0}/dummy/dummy_board_2.html".format(
@@ -127,7 +142,8 @@ class TestBitcointalk(unittest.TestCase):
             'name': 'Break on the supply\'s increase',
             'board': 7,
             'count_read': 3051,
-            'num_pages': 1
+            'num_pages': 1,
+            'all_view': False
         }
         self.assertEqual(data, expectedData)
 
@@ -167,9 +183,24 @@ class TestBitcointalk(unittest.TestCase):
         f.close()
         data = parseTopicPage(html)
         self.assertEqual(data['num_pages'], 621)
+        self.assertFalse(data['all_view'])
         self.assertEqual(
             data['messages'][0]['post_time'],
             datetime.combine(datetime.utcnow().date(), tm(21, 3, 11)))
+
+        # Quotes are dropped from the no-quote variants only
+        quoted = [message for message in data['messages']
+                  if message['content'] != message['content_no_quote']]
+        self.assertEqual(len(quoted), 6)
+        self.assertEqual(quoted[-1]['content_no_quote'],
+                         b'<br>See this as a opportunity to learn :&gt;')
+        self.assertEqual(quoted[-1]['content_no_quote_no_html'],
+                         "See this as a opportunity to learn :>")
+        self.assertTrue(quoted[-1]['content'].startswith(
+            b'<div class="quoteheader">'))
+        unquoted = [message for message in data['messages']
+                    if message not in quoted][0]
+        self.assertTrue(unquoted['content_no_quote'] is unquoted['content'])
         # print "Content of Message 1"
         # print data['messages'][0]['content']
         # print "Content of Message 1, No HTML"
@@ -179,5 +210,340 @@ class TestBitcointalk(unittest.TestCase):
         # print "Content of Message 1, No Quote, No HTML"
         # print data['messages'][0]['content_no_quote_no_html']
 
+    def testMessage(self):
+        """Method for testing the Message record."""
+        message = Message(id=1, topic=14, subject="Hi")
+        self.assertEqual(message, {'id': 1, 'topic': 14, 'subject': "Hi"})
+        self.assertEqual(list(message.keys()), ['id', 'topic', 'subject'])
+        message['member'] = 0
+        del message['subject']
+        self.assertEqual(dict(message), {'id': 1, 'topic': 14, 'member': 0})
+        with self.assertRaises(KeyError):
+            message['subject']
+        with self.assertRaises(KeyError):
+            message['keys'] = 1
+        self.assertFalse(hasattr(message, '__dict__'))
+        self.assertEqual(pickle.loads(pickle.dumps(message)), message)
+
+    def testParseTopicPageAllView(self):
+        """Method for testing the "All" link of parseTopicPage."""
+        f = codecs.open("{0}/dummy/dummy_topic.html".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r', 'utf-8')
+        html = f.read()
+        f.close()
+        html = html.replace(
+            "Pages: [<b>1</b>] ",
+            "Pages: [<b>1</b>] <a class=\"navPages\" href=\"{0}?topic=14.0;"
+            "all\">All</a> ".format(baseUrl))
+        data = parseTopicPage(html)
+        self.assertTrue(data['all_view'])
+        self.assertEqual(data['num_pages'], 1)
+        self.assertEqual(len(data['messages']), 2)
+
+
+class _FixtureHandler(BaseHTTPRequestHandler):
+
+    """Stand-in for bitcointalk.org serving the dummy/ fixtures."""
+
+    fixtures = {
+        "board=74.0": "dummy_board_2.html",
+        "board=5.600": "dummy_board_1.html",
+        "action=profile;u=12": "dummy_profile.html",
+        "topic=14.0": "dummy_topic.html",
+        "topic=602041.12400": "dummy_topic_2.html"
+    }
+    delay = 0
+    failures = {}
+    inFlight = 0
+    maxInFlight = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        """Serve the fixture matching the query string."""
+        cls = _FixtureHandler
+        with cls.lock:
+            cls.inFlight += 1
+            cls.maxInFlight = max(cls.maxInFlight, cls.inFlight)
+        time.sleep(cls.delay)
+        payload = self.path.split("?", 1)[-1]
+        fixture = cls.fixtures.get(payload)
+        if len(cls.failures.get(payload, [])) > 0:
+            status = cls.failures[payload].pop(0)
+            body = b""
+            if status == "truncated":
+                # Promise a longer body than is sent, then hang up
+                self.send_response(200)
+                self.send_header("Content-Length", "100")
+                self.end_headers()
+                self.wfile.write(b"<html>")
+                self.close_connection = True
+                with cls.lock:
+                    cls.inFlight -= 1
+                return
+            self.send_response(status)
+        elif fixture is None:
+            self.send_response(404)
+            body = b""
+        else:
+            f = codecs.open("{0}/dummy/{1}".format(
+                os.path.dirname(os.path.abspath(__file__)), fixture),
+                'r', 'utf-8')
+            body = f.read().encode('utf-8')
+            f.close()
+            etag = '"{0}"'.format(fixture)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                body = b""
+            else:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = gzip.compress(body)
+                    self.send_header("Content-Encoding", "gzip")
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with cls.lock:
+            cls.inFlight -= 1
+
+    def log_message(self, format, *args):
+        """Keep the test output quiet."""
+        pass
+
+
+class TestBitcointalkServer(unittest.TestCase):
+
+    """"Testing suite for requestors against a local stand-in server."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Start the stand-in HTTP server."""
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _FixtureHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Stop the stand-in HTTP server."""
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        """Point the module at the stand-in server."""
+        self.configOriginal = (bitcointalk.baseUrl, bitcointalk.limiter,
+                               bitcointalk.maxInFlight,
+                               bitcointalk.conditionalGets)
+        bitcointalk.baseUrl = "http://127.0.0.1:{0}/index.php".format(
+            self.server.server_address[1])
+        bitcointalk.limiter = ratelimit.TokenBucket(
+            rate=1000, burst=1000, maxRate=1000)
+        bitcointalk.conditionalGets = False
+        self.retryOriginal = (bitcointalk.maxRetries, bitcointalk.backoffBase,
+                              bitcointalk.breakers)
+        bitcointalk.backoffBase = 0.01
+        bitcointalk.breakers = {}
+        self.validatorsOriginal = bitcointalk.validators
+        bitcointalk.validators = {}
+        self.cacheOriginal = (bitcointalk.responseTtl,
+                              bitcointalk.responseCachePath,
+                              bitcointalk._prunedTime)
+        bitcointalk.responseTtl = 0
+        bitcointalk.responseCache.clear()
+        _FixtureHandler.delay = 0
+        _FixtureHandler.maxInFlight = 0
+
+    def tearDown(self):
+        """Restore the module configuration."""
+        (bitcointalk.baseUrl, bitcointalk.limiter,
+         bitcointalk.maxInFlight,
+         bitcointalk.conditionalGets) = self.configOriginal
+        bitcointalk.validators = self.validatorsOriginal
+        (bitcointalk.responseTtl, bitcointalk.responseCachePath,
+         bitcointalk._prunedTime) = self.cacheOriginal
+        bitcointalk.responseCache.clear()
+        (bitcointalk.maxRetries, bitcointalk.backoffBase,
+         bitcointalk.breakers) = self.retryOriginal
+        _FixtureHandler.failures = {}
+
+    def testRequestAsync(self):
+        """Method for testing the async requestors."""
+        async def requestAll():
+            return await asyncio.gather(
+                requestBoardPageAsync(74),
+                requestProfileAsync(12),
+                requestTopicPageAsync(14))
+        htmls = asyncio.run(requestAll())
+        titles = [lxml.html.fromstring(html).cssselect("title")[0].text
+                  for html in htmls]
+        self.assertEqual(titles, [
+            "Legal",
+            "View the profile of nanaimogold",
+            "Break on the supply's increase"])
+
+    def testRequestAsyncError(self):
+        """Method for testing async requests for missing pages."""
+        with self.assertRaises(NotFoundError):
+            asyncio.run(requestTopicPageAsync(1))
+
+    def testRetry(self):
+        """Method for testing retries of transient failures."""
+        _FixtureHandler.failures = {"topic=14.0": [502, 503]}
+        countRequestedStart = bitcointalk.countRequested
+        html = requestTopicPage(14)
+        self.assertEqual(bitcointalk.countRequested - countRequestedStart, 3)
+        self.assertEqual(
+            lxml.html.fromstring(html).cssselect("title")[0].text,
+            "Break on the supply's increase")
+
+        _FixtureHandler.failures = {"topic=14.0": [429]}
+        html = asyncio.run(requestTopicPageAsync(14))
+        self.assertEqual(bitcointalk.countRequested - countRequestedStart, 5)
+
+        # A body cut short is retried like any other transient failure
+        _FixtureHandler.failures = {"topic=14.0": ["truncated"]}
+        self.assertEqual(requestTopicPage(14), html)
+        self.assertEqual(bitcointalk.breakers["topic"].outcomes.count(False),
+                         4)
+
+    def testRetryGiveUp(self):
+        """Method for testing that retries are bounded and classified."""
+        bitcointalk.maxRetries = 2
+        _FixtureHandler.failures = {"topic=14.0": [502] * 5}
+        countRequestedStart = bitcointalk.countRequested
+        with self.assertRaises(TransientError) as context:
+            requestTopicPage(14)
+        self.assertEqual(context.exception.statusCode, 502)
+        self.assertEqual(bitcointalk.countRequested - countRequestedStart, 3)
+
+        # Pages that do not exist are not retried
+        with self.assertRaises(NotFoundError):
+            requestTopicPage(1)
+        self.assertEqual(bitcointalk.countRequested - countRequestedStart, 4)
+
+    def testParseInvalid(self):
+        """Method for testing that non-topic pages are flagged as invalid."""
+        html = requestProfile(12)
+        with self.assertRaises(ParseInvalidError):
+            parseTopicPage(html)
+
+    def testConditionalRequest(self):
+        """Method for testing compressed and conditional requests."""
+        bitcointalk.conditionalGets = True
+        html = requestProfile(12)
+        title = lxml.html.fromstring(html).cssselect("title")[0].text
+        self.assertEqual(title, "View the profile of nanaimogold")
+        self.assertEqual(
+            bitcointalk.validators["action=profile;u=12"],
+            {'etag': '"dummy_profile.html"'})
+        with self.assertRaises(NotModified):
+            requestProfile(12)
+        with self.assertRaises(NotModified):
+            asyncio.run(requestProfileAsync(12))
+        # A 304 is a healthy answer, also to a half-open circuit's probe
+        circuit = bitcointalk.breakers["action=profile"]
+        self.assertEqual(list(circuit.outcomes), [True, True, True])
+        circuit.openedAt = circuit.clock() - circuit.cooldown
+        with self.assertRaises(NotModified):
+            requestProfile(12)
+        self.assertEqual(circuit.openedAt, None)
+        self.assertEqual(circuit.delay(), 0)
+        # Unconditional requests always come back with the page
+        self.assertEqual(requestProfile(12, conditional=False), html)
+        self.assertEqual(
+            asyncio.run(requestProfileAsync(12, conditional=False)), html)
+
+        bitcointalk.conditionalGets = False
+        html = requestProfile(12)
+        self.assertEqual(
+            lxml.html.fromstring(html).cssselect("title")[0].text, title)
+
+    def testMaxInFlight(self):
+        """Method for testing the cap on in-flight requests."""
+        bitcointalk.maxInFlight = 2
+        _FixtureHandler.delay = 0.2
+
+        async def requestMany():
+            return await asyncio.gather(*[
+                requestTopicPageAsync(14) for i in range(6)])
+        countRequestedStart = bitcointalk.countRequested
+        htmls = asyncio.run(requestMany())
+        self.assertEqual(len(htmls), 6)
+        self.assertEqual(bitcointalk.countRequested - countRequestedStart, 6)
+        self.assertEqual(_FixtureHandler.maxInFlight, 2)
+
+    def testResponseCache(self):
+        """Method for testing reuse of responses from memory and disk."""
+        bitcointalk.responseTtl = 60
+        countRequestedStart = bitcointalk.countRequested
+        html = requestTopicPage(14)
+        self.assertEqual(requestTopicPage(14), html)
+        self.assertEqual(asyncio.run(requestTopicPageAsync(14)), html)
+        self.assertEqual(bitcointalk.countRequested - countRequestedStart, 1)
+
+        # Missing pages are not cached
+        for i in range(2):
+            with self.assertRaises(NotFoundError):
+                requestTopicPage(1)
+        self.assertEqual(bitcointalk.countRequested - countRequestedStart, 3)
+
+        # Expired entries are fetched again
+        bitcointalk.responseCache.put("topic=14.0", (time.time() - 1, html))
+        requestTopicPage(14)
+        self.assertEqual(bitcointalk.countRequested - countRequestedStart, 4)
+
+        bitcointalk.responseCachePath = tempfile.mkdtemp()
+        try:
+            html = requestProfile(12)
+            bitcointalk.responseCache.clear()
+            self.assertEqual(requestProfile(12), html)
+            self.assertEqual(
+                bitcointalk.countRequested - countRequestedStart, 5)
+
+            # Files older than the disk TTL are ignored
+            bitcointalk.responseCache.clear()
+            path = bitcointalk._responseFile("action=profile;u=12")
+            os.utime(path, (time.time() - bitcointalk.responseCacheDiskTtl,
+                            time.time() - bitcointalk.responseCacheDiskTtl))
+            requestProfile(12)
+            self.assertEqual(
+                bitcointalk.countRequested - countRequestedStart, 6)
+
+            # Expired files are deleted rather than left to pile up
+            os.utime(path, (time.time() - bitcointalk.responseCacheDiskTtl,
+                            time.time() - bitcointalk.responseCacheDiskTtl))
+            kept = bitcointalk._responseFile("topic=14.0")
+            bitcointalk._cacheResponse("topic=14.0", html)
+            self.assertTrue(os.path.exists(path))
+            bitcointalk._prunedTime -= bitcointalk.responseCachePruneSeconds
+            bitcointalk._cacheResponse("topic=14.0", html)
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(os.path.exists(kept))
+            self.assertEqual(bitcointalk.pruneResponseCache(), 0)
+
+            # Concurrent writers of one key each use a temp file of their own
+            errors = []
+
+            def write():
+                for i in range(20):
+                    try:
+                        bitcointalk._cacheResponse("topic=14.0", html)
+                    except OSError as e:
+                        errors.append(e)
+            writers = [threading.Thread(target=write) for i in range(4)]
+            for writer in writers:
+                writer.start()
+            for writer in writers:
+                writer.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(sorted(os.listdir(
+                bitcointalk.responseCachePath)), [os.path.basename(kept)])
+            f = codecs.open(kept, 'r', 'utf-8')
+            self.assertEqual(f.read(), html)
+            f.close()
+        finally:
+            shutil.rmtree(bitcointalk.responseCachePath)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+from breaker import *
+
+
+class _Clock(object):
+
+    """Manually advanced clock for deterministic tests."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    """"Testing suite for breaker module."""
+
+    def setUp(self):
+        """Setup a breaker on a manual clock."""
+        self.clock = _Clock()
+        self.breaker = CircuitBreaker(
+            "topic", window=10, minRequests=4, errorRate=0.5, cooldown=30.0,
+            clock=self.clock)
+
+    def testStaysClosed(self):
+        """Test that sporadic failures do not trip the breaker."""
+        for success in [True, False, True, True, False, True, True]:
+            self.breaker.record(success)
+        self.assertEqual(self.breaker.delay(), 0)
+        self.assertFalse(self.breaker.isOpen())
+
+    def testMinRequests(self):
+        """Test that the breaker waits for enough samples."""
+        for i in range(3):
+            self.breaker.record(False)
+        self.assertFalse(self.breaker.isOpen())
+        self.breaker.record(False)
+        self.assertTrue(self.breaker.isOpen())
+
+    def testOpenAndClose(self):
+        """Test tripping, cooling down and closing on a good probe."""
+        for success in [True, False, True, False]:
+            self.breaker.record(success)
+        self.assertEqual(self.breaker.delay(), 30.0)
+        self.clock.now = 10.0
+        self.assertEqual(self.breaker.delay(), 20.0)
+        # Outcomes of requests already in flight are ignored while open
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.delay(), 20.0)
+        self.clock.now = 30.0
+        self.assertEqual(self.breaker.delay(), 0)
+        self.breaker.record(True)
+        self.assertFalse(self.breaker.isOpen())
+        self.breaker.record(False)
+        self.assertFalse(self.breaker.isOpen())
+
+    def testSingleProbe(self):
+        """Test that only one request probes a half-open breaker."""
+        for i in range(4):
+            self.breaker.record(False)
+        self.clock.now = 30.0
+        self.assertEqual(self.breaker.delay(), 0)
+        # Others wait for the probe's outcome, polling meanwhile
+        self.assertEqual(self.breaker.delay(), 1.0)
+        self.assertTrue(self.breaker.isOpen())
+        self.clock.now = 35.0
+        self.assertEqual(self.breaker.delay(), 1.0)
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.delay(), 0)
+        self.assertEqual(self.breaker.delay(), 0)
+
+        # A failed probe reopens it for a full cooldown
+        for i in range(4):
+            self.breaker.record(False)
+        self.clock.now = 65.0
+        self.assertEqual(self.breaker.delay(), 0)
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.delay(), 30.0)
+
+        # A probe that never reports back is replaced after a cooldown
+        self.clock.now = 95.0
+        self.assertEqual(self.breaker.delay(), 0)
+        self.clock.now = 125.0
+        self.assertEqual(self.breaker.delay(), 0)
+
+    def testReopen(self):
+        """Test that a failed probe reopens the breaker."""
+        for i in range(4):
+            self.breaker.record(False)
+        self.clock.now = 31.0
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.delay(), 30.0)
+
+if __name__ == "__main__":
+    unittest.main()
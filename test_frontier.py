@@ -0,0 +1,253 @@
+import multiprocessing
+import os
+import subprocess
+import threading
+import time
+import unittest
+import bitcointalk
+import frontier
+import pg
+
+
+class TestFrontier(unittest.TestCase):
+
+    """"Testing suite for frontier module."""
+
+    def setUp(self):
+        """Setup tables and stand-in crawlers for test."""
+        # Swap and sub tables
+        self.tablesOriginal = pg.tables
+        pg.tables = {}
+        for key, table in self.tablesOriginal.items():
+            pg.tables[key] = "{0}_test".format(table)
+        cur = pg.cursor()
+        for key, table in pg.tables.items():
+            cur.execute("""CREATE TABLE IF NOT EXISTS
+                {0} (LIKE {1} INCLUDING ALL)""".format(
+                table, self.tablesOriginal[key]))
+        cur.execute("""COMMIT""")
+
+        # Crawlers that record calls: board 74 has 2 pages of 2 topics
+        self.crawled = []
+        self.failing = set()
+        self.missing = set()
+        self.configOriginal = (frontier.retrySeconds, frontier.pollSeconds)
+        frontier.retrySeconds = 0
+        frontier.pollSeconds = 0.05
+        self.crawlersOriginal = dict(frontier.crawlers)
+        self.batchCrawlersOriginal = dict(frontier.batchCrawlers)
+        frontier.batchCrawlers.clear()
+        self.generationOriginal = frontier.generation
+
+        def crawler(kind, children):
+            def crawl(entityId, page):
+                self.crawled.append((kind, entityId, page))
+                if (kind, entityId) in self.failing:
+                    raise Exception("Could not crawl")
+                if (kind, entityId) in self.missing:
+                    raise bitcointalk.NotFoundError("Gone", 404)
+                return children(entityId, page)
+            return crawl
+        frontier.crawlers['board'] = crawler('board', lambda i, p: [
+            frontier.item('boardpage', i, 1), frontier.item('boardpage', i, 2)])
+        frontier.crawlers['boardpage'] = crawler('boardpage', lambda i, p: [
+            frontier.item('topic', p * 10), frontier.item('topic', p * 10 + 1)])
+        frontier.crawlers['topic'] = crawler('topic', lambda i, p: [
+            frontier.item('member', 5)])
+        frontier.crawlers['member'] = crawler('member', lambda i, p: [])
+
+    def tearDown(self):
+        """Teardown tables and restore crawlers."""
+        frontier.crawlers.update(self.crawlersOriginal)
+        frontier.batchCrawlers.update(self.batchCrawlersOriginal)
+        frontier.generation = self.generationOriginal
+        (frontier.retrySeconds,
+         frontier.pollSeconds) = self.configOriginal
+        cur = pg.cursor()
+        for table in pg.tables.values():
+            cur.execute("""DROP TABLE IF EXISTS
+                {0}""".format(table))
+        cur.execute("""COMMIT""")
+        pg.tables = self.tablesOriginal
+
+    def _states(self):
+        """Pull the state of every frontier item."""
+        cur = pg.cursor()
+        cur.execute("SELECT kind, sid, page, state, attempts FROM {0}".format(
+            pg.tables['frontier']))
+        rows = cur.fetchall()
+        pg.commit()
+        return dict(((kind, sid, page), (state, attempts))
+                    for kind, sid, page, state, attempts in rows)
+
+    def testRun(self):
+        """Test that a crawl expands every item once, in batches."""
+        self.assertEqual(frontier.seed([frontier.item('board', 74)]), 1)
+        self.assertEqual(frontier.run(), 8)
+        self.assertEqual(self.crawled, [
+            ('board', 74, 0), ('boardpage', 74, 1), ('boardpage', 74, 2),
+            ('topic', 10, 0), ('topic', 11, 0), ('topic', 20, 0),
+            ('topic', 21, 0), ('member', 5, 0)])
+        self.assertEqual(set(self._states().values()), set([('done', 1)]))
+
+        # A finished crawl is started over as a new generation
+        del self.crawled[:]
+        self.assertEqual(frontier.seed([frontier.item('board', 74)]), 2)
+        self.assertEqual(frontier.run(), 8)
+
+    def testFailure(self):
+        """Test that failing items are retried, then marked failed."""
+        self.failing.add(('topic', 10))
+        frontier.seed([frontier.item('boardpage', 74, 1)])
+        frontier.run()
+        self.assertEqual(self.crawled.count(('topic', 10, 0)),
+                         frontier.maxAttempts)
+        states = self._states()
+        self.assertEqual(states[('topic', 10, 0)],
+                         ('failed', frontier.maxAttempts))
+        self.assertEqual(states[('topic', 11, 0)], ('done', 1))
+
+    def testRetryBackoff(self):
+        """Test that failed items wait before being retried."""
+        self.failing.add(('topic', 10))
+        self.missing.add(('topic', 11))
+        frontier.retrySeconds = 300
+        frontier.seed([frontier.item('boardpage', 74, 1)])
+        frontier.run()
+        self.assertEqual(self.crawled.count(('topic', 10, 0)), 1)
+        states = self._states()
+        self.assertEqual(states[('topic', 10, 0)], ('pending', 1))
+        # A missing page is not retried at all
+        self.assertEqual(states[('topic', 11, 0)], ('failed', 1))
+        self.assertEqual(pg.claimWork(10, "other"), [])
+
+        cur = pg.cursor()
+        cur.execute("""SELECT not_before - db_update_time FROM {0}
+            WHERE kind = 'topic' AND sid = 10""".format(
+            pg.tables['frontier']))
+        self.assertEqual(cur.fetchone()[0].total_seconds(), 300)
+        pg.commit()
+
+    def testBatchCrawler(self):
+        """Test that batch crawlers take every claimed item of their kind."""
+        batches = []
+
+        def crawlMembers(keys):
+            batches.append(keys)
+            return dict((key, []) for key in keys if key[1] != 7)
+        frontier.batchCrawlers['member'] = crawlMembers
+        frontier.seed([frontier.item('member', memberId)
+                       for memberId in (5, 6, 7)])
+        self.assertEqual(frontier.run(limit=2), 2)
+        self.assertEqual(batches[0], [('member', 5, 0), ('member', 6, 0),
+                                      ('member', 7, 0)])
+        self.assertEqual(self.crawled, [])
+        states = self._states()
+        self.assertEqual(states[('member', 5, 0)], ('done', 1))
+        self.assertEqual(states[('member', 7, 0)], ('pending', 1))
+
+    def testResume(self):
+        """Test that a restart resumes the unfinished crawl."""
+        frontier.seed([frontier.item('board', 74)])
+        self.assertEqual(frontier.run(limit=1), 1)
+
+        # Simulate a dead worker holding an item and a live one holding
+        # another; only the expired lease is reclaimed
+        live = pg.claimWork(1, "live", leaseSeconds=300)[0]
+        liveKey = (live['kind'], live['id'], live['page'])
+        dead = pg.claimWork(1, "dead", leaseSeconds=0)[0]
+        self.assertEqual(pg.renewWork([liveKey], "live"), 1)
+        self.assertEqual(pg.renewWork([liveKey], "dead"), 0)
+        self.assertEqual(pg.selectWorkers(), {"live": 1, "dead": 1})
+
+        # A finish from a worker that lost its lease is ignored
+        pg.finishWork([liveKey], 'done', worker="dead")
+        self.assertEqual(self._states()[liveKey], ('running', 1))
+
+        # The run waits for the live worker instead of ending early
+        self.assertEqual(frontier.seed([frontier.item('board', 74)]), 1)
+        del self.crawled[:]
+
+        def finish():
+            pg.finishWork([liveKey], 'done', worker="live")
+            pg.release()
+        finisher = threading.Timer(0.5, finish)
+        finisher.start()
+        try:
+            started = time.monotonic()
+            self.assertEqual(frontier.run(), 4)
+            self.assertTrue(time.monotonic() - started >= 0.5)
+        finally:
+            finisher.join()
+        self.assertFalse(('board', 74, 0) in self.crawled)
+        self.assertTrue((dead['kind'], dead['id'], dead['page']) in
+                        self.crawled)
+        self.assertFalse(liveKey in self.crawled)
+        states = self._states()
+        self.assertEqual(states[(dead['kind'], dead['id'], dead['page'])],
+                         ('done', 2))
+        self.assertEqual(states[liveKey], ('done', 1))
+
+    def testReclaim(self):
+        """Test that a restart takes back what a dead process of its host
+        left running, but not what live workers hold."""
+        frontier.seed([frontier.item('member', memberId)
+                       for memberId in (5, 6, 7)])
+        host = frontier.worker.rsplit(":", 1)[0]
+        process = subprocess.Popen(["true"])
+        process.wait()
+        deadWorker = "{0}:{1}".format(host, process.pid)
+        pg.claimWork(1, deadWorker, leaseSeconds=300)
+        pg.claimWork(1, "{0}:{1}".format(host, os.getppid()), 300)
+        pg.claimWork(1, "elsewhere:{0}".format(process.pid), 300)
+        self.assertEqual(frontier.reclaim(), 1)
+        states = self._states()
+        self.assertEqual(states[('member', 5, 0)], ('pending', 1))
+        self.assertEqual(states[('member', 6, 0)], ('running', 1))
+        self.assertEqual(states[('member', 7, 0)], ('running', 1))
+        self.assertEqual(frontier.reclaim(), 0)
+
+    def testWorkers(self):
+        """Test that worker processes share the frontier without overlap."""
+        frontier.seed([frontier.item('boardpage', 74, page)
+                       for page in range(1, 7)])
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(3)
+        try:
+            results = pool.map(_worker, [pg.tables] * 3)
+        finally:
+            pool.close()
+            pool.join()
+        crawled = [key for result in results for key in result]
+        self.assertEqual(len(crawled), len(set(crawled)))
+        self.assertEqual(len(crawled), 6 + 12 + 1)
+        self.assertTrue(len([result for result in results if result]) > 1)
+        self.assertEqual(set(state for state, attempts in
+                             self._states().values()), set(['done']))
+
+
+def _worker(tables):
+    """Run a frontier worker process with stand-in crawlers."""
+    pg.tables = tables
+    frontier.batchSize = 2
+    frontier.pollSeconds = 0.05
+    frontier.batchCrawlers.clear()
+    crawled = []
+
+    def crawler(kind, children):
+        def crawl(entityId, page):
+            crawled.append((kind, entityId, page))
+            time.sleep(0.05)
+            return children(entityId, page)
+        return crawl
+    frontier.crawlers['boardpage'] = crawler('boardpage', lambda i, p: [
+        frontier.item('topic', p * 10), frontier.item('topic', p * 10 + 1)])
+    frontier.crawlers['topic'] = crawler('topic', lambda i, p: [
+        frontier.item('member', 5)])
+    frontier.crawlers['member'] = crawler('member', lambda i, p: [])
+    frontier.run()
+    return crawled
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+from array import array
+import os
+import shutil
+import tempfile
+import unittest
+from idindex import *
+
+
+class TestIdIndex(unittest.TestCase):
+
+    """"Testing suite for idindex module."""
+
+    def testMembership(self):
+        """Test adds, lookups and removal across merges."""
+        index = IdIndex([5, 3, 9], mergeSize=2)
+        self.assertEqual(list(index), [3, 5, 9])
+        index.add(7)
+        index.add(7)
+        self.assertTrue(7 in index)
+        self.assertEqual(len(index), 4)
+        index.add(1)
+        self.assertEqual(len(index.pending), 0)
+        self.assertEqual(list(index), [1, 3, 5, 7, 9])
+        self.assertFalse(4 in index)
+        self.assertFalse(10 in index)
+        index.discard(5)
+        index.discard(4)
+        self.assertEqual(index, set([1, 3, 7, 9]))
+        self.assertEqual(set([1, 3, 7, 9]), index)
+
+    def testExtendSorted(self):
+        """Test bulk loading of ascending chunks."""
+        index = IdIndex()
+        index.add(250)
+        index.extendSorted([1, 2, 3])
+        index.extendSorted([100, 250, 300])
+        self.assertEqual(len(index.pending), 0)
+        self.assertEqual(list(index), [1, 2, 3, 100, 250, 300])
+
+        # Chunks that overlap what is loaded still end up sorted and unique
+        index.extendSorted([2, 50, 400])
+        self.assertEqual(list(index), [1, 2, 3, 50, 100, 250, 300, 400])
+        self.assertEqual(len(index), 8)
+        self.assertEqual(index.ids.itemsize, 8)
+
+    def testSaveLoad(self):
+        """Test that a saved index is read back from its mapped file."""
+        path = tempfile.mkdtemp()
+        try:
+            IdIndex([7, 3, 5]).save(os.path.join(path, "ids"))
+            index = IdIndex.load(os.path.join(path, "ids"))
+            self.assertFalse(isinstance(index.ids, array))
+            self.assertEqual(list(index), [3, 5, 7])
+            self.assertTrue(5 in index)
+            self.assertFalse(4 in index)
+
+            # Writes copy the mapped IDs instead of touching the file
+            index.extendSorted([9])
+            index.discard(3)
+            self.assertEqual(list(index), [5, 7, 9])
+            self.assertEqual(list(IdIndex.load(os.path.join(path, "ids"))),
+                             [3, 5, 7])
+
+            IdIndex().save(os.path.join(path, "empty"))
+            self.assertEqual(len(IdIndex.load(os.path.join(path, "empty"))), 0)
+            f = open(os.path.join(path, "partial"), 'wb')
+            f.write(b"\0" * 12)
+            f.close()
+            with self.assertRaises(ValueError):
+                IdIndex.load(os.path.join(path, "partial"))
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+from lrucache import *
+
+
+class TestLRUCache(unittest.TestCase):
+
+    """"Testing suite for lrucache module."""
+
+    def testEviction(self):
+        """Test that the least recently used entry is evicted first."""
+        cache = LRUCache(maxSize=2)
+        cache.put(1, 'a')
+        cache.put(2, 'b')
+        self.assertEqual(cache.get(1), 'a')
+        cache.put(3, 'c')
+        self.assertTrue(1 in cache)
+        self.assertFalse(2 in cache)
+        self.assertTrue(3 in cache)
+        self.assertEqual(len(cache), 2)
+        cache.put(1, 'A')
+        cache.put(4, 'd')
+        self.assertEqual(cache.get(1), 'A')
+        self.assertEqual(cache.get(3), None)
+        cache.discard(1)
+        self.assertEqual(cache.get(1, 'missing'), 'missing')
+
+    def testMaxBytes(self):
+        """Test that entries are also evicted to stay under maxBytes."""
+        cache = LRUCache(maxSize=10, maxBytes=10, sizeOf=len)
+        cache.put(1, 'aaaa')
+        cache.put(2, 'bbbb')
+        self.assertEqual(cache.stats()['bytes'], 8)
+        cache.put(3, 'cccc')
+        self.assertFalse(1 in cache)
+        self.assertEqual(cache.stats()['bytes'], 8)
+        cache.put(2, 'bbbbbbb')
+        self.assertFalse(3 in cache)
+        self.assertEqual(cache.stats()['bytes'], 7)
+        cache.put(4, 'd' * 11)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['bytes'], 0)
+        cache.put(5, 'e')
+        cache.discard(5)
+        self.assertEqual(cache.stats()['bytes'], 0)
+        self.assertTrue(approximateSize({'name': 'x' * 100}) >
+                        approximateSize({'name': 'x'}))
+
+    def testStats(self):
+        """Test hit and miss counters."""
+        cache = LRUCache(maxSize=1)
+        cache.put(1, 'a')
+        cache.get(1)
+        cache.get(1)
+        cache.get(2)
+        cache.put(2, 'b')
+        self.assertEqual(cache.stats(), {
+            'size': 1, 'bytes': 0, 'hits': 2, 'misses': 1, 'evictions': 1,
+            'hit_rate': 2 / 3.0})
+        cache.clear()
+        self.assertEqual(cache.stats()['hits'], 0)
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,20 @@
 import unittest
 import bitcointalk
+import codecs
 from datetime import datetime
+from http.server import ThreadingHTTPServer
 import pg
+import idindex
+import memoizer
 from memoizer import *
+import os
+import ratelimit
+import scheduler
+import shutil
+import tempfile
+from test_bitcointalk import _FixtureHandler
+import threading
+import writebehind
 
 class TestMemoizer(unittest.TestCase):
 
@@ -35,6 +47,11 @@ class TestMemoizer(unittest.TestCase):
 
     def tearDown(self):
         """Teardown tables for test and restore memo."""
+        # Drop writes still buffered for the test tables
+        for rows in writebehind.buffers.values():
+            rows.clear()
+        writebehind._firstBuffered = None
+
         # Drop test tables
         cur = pg.cursor()
         for table in pg.tables.values():
@@ -146,6 +163,327 @@ class TestMemoizer(unittest.TestCase):
         }
         self.assertEqual(memo, expectedMemo)
 
+    def testRememberSnapshot(self):
+        """Test that remember loads its snapshot and only new rows."""
+        snapshotPathOriginal = memoizer.snapshotPath
+        memoOriginal = memoizer.memo
+        memoizer.snapshotPath = tempfile.mkdtemp()
+        try:
+            datum = {'id': 74, 'name': "Board", 'parent': None,
+                     'container': "Container", 'num_pages': 1}
+            pg.insertBoards([datum])
+            memoizer.memo = {'boards': idindex.IdIndex(),
+                             'members': idindex.IdIndex(),
+                             'topics': idindex.IdIndex()}
+            memoizer.remember()
+            self.assertEqual(memoizer.memo['boards'], set([74]))
+
+            # A restart reads the snapshot plus rows changed since; 74 is
+            # dropped from the DB so it can only come from the snapshot
+            cur = pg.cursor()
+            cur.execute("DELETE FROM {0}".format(pg.tables['board']))
+            pg.commit()
+            pg.insertBoards([dict(datum, id=75)])
+            memoizer.memo = {'boards': idindex.IdIndex(),
+                             'members': idindex.IdIndex(),
+                             'topics': idindex.IdIndex()}
+            memoizer.snapshotOverlap = memoizer.timedelta(0)
+            memoizer.remember()
+            self.assertEqual(memoizer.memo['boards'], set([74, 75]))
+            self.assertEqual(memoizer.memo['members'], set())
+        finally:
+            shutil.rmtree(memoizer.snapshotPath)
+            memoizer.snapshotPath = snapshotPathOriginal
+            memoizer.memo = memoOriginal
+            memoizer.snapshotOverlap = memoizer.timedelta(minutes=5)
+
+    def testPrefetchMembers(self):
+        """Test that memo hits are served from one batched query."""
+        data = [{'id': memberId, 'name': "Member {0}".format(memberId),
+                 'position': None, 'date_registered': None,
+                 'last_active': None, 'email': None, 'website_name': None,
+                 'website_link': None, 'bitcoin_address': None,
+                 'other_contact_info': None, 'signature': None}
+                for memberId in (12, 13)]
+        pg.insertMembers(data)
+        memoOriginal = memoizer.memo
+        memoizer.memo = {'boards': idindex.IdIndex(),
+                         'members': idindex.IdIndex([12, 13]),
+                         'topics': idindex.IdIndex()}
+        memoizer.caches['member'].clear()
+        try:
+            self.assertEqual(prefetchMembers([12, 13, 12, 99]), 2)
+            self.assertEqual(prefetchMembers([12, 13]), 0)
+            countRequestedStart = bitcointalk.countRequested
+            self.assertEqual(scrapeMember(12), data[0])
+            self.assertEqual(scrapeMember(13), data[1])
+            self.assertEqual(bitcointalk.countRequested, countRequestedStart)
+            self.assertEqual(memoizer.caches['member'].stats()['hits'], 2)
+
+            # Callers get copies, so the cached record stays intact
+            scrapeMember(12)['name'] = "Changed"
+            self.assertEqual(scrapeMember(12), data[0])
+        finally:
+            memoizer.memo = memoOriginal
+            memoizer.caches['member'].clear()
+
+    def testScrapeTopicMessagesIncremental(self):
+        """Test that a recrawl only fetches pages that may be new."""
+        requested = []
+        conditionals = []
+        topic = {'count': 45, 'unchanged': set(), 'failing': set()}
+
+        def scrapeMessagePages(topicId, pageNums, conditional=True):
+            requested.append(pageNums)
+            conditionals.append(conditional)
+            numPages = (topic['count'] - 1) // 20 + 1
+            pages = []
+            for pageNum in pageNums:
+                if pageNum in topic['failing']:
+                    raise bitcointalk.TransientError("Timed out.")
+                if pageNum in topic['unchanged']:
+                    pages.append(None)
+                    continue
+                positions = range((pageNum - 1) * 20 + 1,
+                                  min(pageNum * 20, topic['count']) + 1)
+                pages.append({
+                    'id': topicId, 'name': "Topic", 'board': 74,
+                    'num_pages': numPages, 'count_read': 1,
+                    'messages': [{'topic_position': position}
+                                 for position in positions]})
+            return pages
+
+        scrapeMessagePagesOriginal = memoizer._scrapeMessagePages
+        memoizer._scrapeMessagePages = scrapeMessagePages
+        try:
+            batches = list(scrapeTopicMessages(14))
+            self.assertEqual(requested, [[1], [2, 3]])
+            # Nothing is stored yet, so a 304 must not skip a page
+            self.assertEqual(conditionals, [False, False])
+            self.assertEqual([len(messages) for batch in batches
+                              for pageNum, messages in batch], [20, 20, 5])
+            writebehind.flush()
+            state = pg.selectTopicState(14)
+            self.assertEqual(
+                dict((key, state[key]) for key in (
+                    'id', 'num_pages', 'last_page', 'last_position',
+                    'count_read')),
+                {'id': 14, 'num_pages': 3, 'last_page': 3,
+                 'last_position': 45, 'count_read': 1})
+            self.assertEqual(state['change_rate'], scheduler.defaultRate)
+
+            # New posts: refetch the last page seen and the page after it
+            del requested[:]
+            topic['count'] = 61
+            list(scrapeTopicMessages(14))
+            self.assertEqual(requested, [[3], [4]])
+            self.assertEqual(conditionals[2:], [True, True])
+            writebehind.flush()
+            self.assertEqual(pg.selectTopic(14)['num_pages'], 4)
+
+            # Nothing new: the unchanged last page ends the crawl
+            del requested[:]
+            topic['unchanged'].add(4)
+            list(scrapeTopicMessages(14))
+            self.assertEqual(requested, [[4]])
+            writebehind.flush()
+            stateLast = pg.selectTopicState(14)
+            self.assertEqual(stateLast['last_position'], 61)
+            self.assertTrue(stateLast['crawl_time'] > state['crawl_time'])
+
+            # An unchanged full last page still looks for the page after it
+            topic['unchanged'].clear()
+            topic['count'] = 80
+            list(scrapeTopicMessages(14))
+            del requested[:]
+            topic['unchanged'].add(4)
+            list(scrapeTopicMessages(14))
+            self.assertEqual(requested, [[4], [5]])
+            topic['count'] = 81
+            batches = list(scrapeTopicMessages(14))
+            self.assertEqual(batches[-1], [(5, [{'topic_position': 81}])])
+            writebehind.flush()
+            self.assertEqual(pg.selectTopicState(14)['last_position'], 81)
+
+            # A failed page raises instead of passing for unchanged
+            del requested[:]
+            topic['count'] = 101
+            topic['failing'].add(6)
+            with self.assertRaises(bitcointalk.FetchError):
+                list(scrapeTopicMessages(14))
+            writebehind.flush()
+            self.assertEqual(pg.selectTopicState(14)['last_position'], 100)
+            topic['failing'].clear()
+            list(scrapeTopicMessages(14))
+            self.assertEqual(requested[-1], [5, 6])
+            writebehind.flush()
+            self.assertEqual(pg.selectTopicState(14)['last_position'], 101)
+        finally:
+            memoizer._scrapeMessagePages = scrapeMessagePagesOriginal
+            memoizer.caches['topic'].clear()
+
+    def testScrapeTopicMessagesAllView(self):
+        """Test that page 1 is reused and the rest come from one request."""
+        requested = []
+
+        def page(pageNum):
+            return {'id': 14, 'name': "Topic", 'board': 74, 'num_pages': 5,
+                    'count_read': 1, 'all_view': True,
+                    'messages': [{'topic_position': position} for position in
+                                 range((pageNum - 1) * 20 + 1,
+                                       pageNum * 20 + 1)]}
+
+        def scrapeMessagePages(topicId, pageNums, conditional=True):
+            requested.append(('pages', pageNums))
+            return [page(pageNum) for pageNum in pageNums]
+
+        def scrapeAllView(topicId, pageNums, conditional=True):
+            requested.append(('all', pageNums))
+            return [page(pageNum) for pageNum in pageNums]
+
+        originals = (memoizer._scrapeMessagePages, memoizer._scrapeAllView)
+        memoizer._scrapeMessagePages = scrapeMessagePages
+        memoizer._scrapeAllView = scrapeAllView
+        memoizer.firstPages.put(14, page(1))
+        try:
+            batches = list(scrapeTopicMessages(14))
+            self.assertEqual(requested, [('all', [2, 3, 4, 5])])
+            self.assertEqual([pageNum for batch in batches
+                              for pageNum, messages in batch],
+                             [1, 2, 3, 4, 5])
+            self.assertEqual(len(memoizer.firstPages), 0)
+            writebehind.flush()
+            self.assertEqual(pg.selectTopicState(14)['last_position'], 100)
+
+            # The last page alone is cheaper to fetch on its own
+            del requested[:]
+            list(scrapeTopicMessages(14))
+            self.assertEqual(requested, [('pages', [5])])
+        finally:
+            (memoizer._scrapeMessagePages,
+             memoizer._scrapeAllView) = originals
+            memoizer.caches['topic'].clear()
+
+    def testScrapeAllView(self):
+        """Test that the all view is split into pages, filling in gaps."""
+        f = codecs.open("{0}/dummy/dummy_topic_2.html".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r', 'utf-8')
+        html = f.read()
+        f.close()
+        requested = []
+
+        def scrapeMessagePages(topicId, pageNums, conditional=True):
+            requested.append(pageNums)
+            return [None for pageNum in pageNums]
+
+        originals = (bitcointalk.requestTopicAll, memoizer._scrapeMessagePages,
+                     memoizer.archivePath, memoizer.archiveStore)
+        bitcointalk.requestTopicAll = lambda topicId, conditional=True: html
+        memoizer._scrapeMessagePages = scrapeMessagePages
+        memoizer.archivePath = tempfile.mkdtemp()
+        memoizer.archiveStore = None
+        try:
+            pages = memoizer._scrapeAllView(602041, [620, 621])
+            self.assertEqual(requested, [[620]])
+            self.assertEqual(pages[0], None)
+            self.assertEqual([message['topic_position']
+                              for message in pages[1]['messages']],
+                             list(range(12401, 12409)))
+            self.assertEqual(len(pg._selectBatch([
+                message['id'] for message in pages[1]['messages']],
+                'message')), 8)
+
+            # A failed view falls back to the pages on their own
+            def requestTopicAll(topicId, conditional=True):
+                raise bitcointalk.TransientError("Timed out.")
+            bitcointalk.requestTopicAll = requestTopicAll
+            del requested[:]
+            self.assertEqual(memoizer._scrapeAllView(602041, [620, 621]),
+                             [None, None])
+            self.assertEqual(requested, [[620, 621]])
+        finally:
+            if memoizer.archiveStore is not None:
+                memoizer.archiveStore.close()
+            shutil.rmtree(memoizer.archivePath)
+            (bitcointalk.requestTopicAll, memoizer._scrapeMessagePages,
+             memoizer.archivePath, memoizer.archiveStore) = originals
+
+    def testScrapeMembers(self):
+        """Test that hits are batched and misses fetched concurrently."""
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _FixtureHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        configOriginal = (bitcointalk.baseUrl, bitcointalk.limiter,
+                          bitcointalk.conditionalGets, bitcointalk.validators,
+                          memoizer.archivePath, memoizer.archiveStore,
+                          memoizer.memo)
+        bitcointalk.baseUrl = "http://127.0.0.1:{0}/index.php".format(
+            server.server_address[1])
+        bitcointalk.limiter = ratelimit.TokenBucket(
+            rate=1000, burst=1000, maxRate=1000)
+        bitcointalk.conditionalGets = False
+        bitcointalk.validators = {}
+        memoizer.archivePath = tempfile.mkdtemp()
+        memoizer.archiveStore = None
+        memoizer.memo = {'boards': idindex.IdIndex(),
+                         'members': idindex.IdIndex([5]),
+                         'topics': idindex.IdIndex()}
+        memoizer.caches['member'].clear()
+        bitcointalk.responseCache.clear()
+        try:
+            member = {'id': 5, 'name': "Member 5", 'position': None,
+                      'date_registered': None, 'last_active': None,
+                      'email': None, 'website_name': None,
+                      'website_link': None, 'bitcoin_address': None,
+                      'other_contact_info': None, 'signature': None}
+            pg.insertMembers([member])
+            countRequestedStart = bitcointalk.countRequested
+            members = scrapeMembers([12, 5, 12, 13, 0, 5])
+            self.assertEqual(bitcointalk.countRequested - countRequestedStart,
+                             2)
+            self.assertEqual(sorted(members.keys()), [5, 12])
+            self.assertEqual(members[5], member)
+            self.assertEqual(members[12]['name'], "nanaimogold")
+            self.assertTrue(12 in memoizer.memo['members'])
+            self.assertFalse(13 in memoizer.memo['members'])
+
+            # Scraped members are now memo hits
+            self.assertEqual(scrapeMembers([12])[12], members[12])
+            self.assertEqual(bitcointalk.countRequested - countRequestedStart,
+                             2)
+
+            # A 304 for a member that never reached the DB is fetched again
+            bitcointalk.conditionalGets = True
+            for scrape in (scrapeMember, lambda memberId: scrapeMembers(
+                    [memberId])[memberId]):
+                writebehind.flush()
+                cur = pg.cursor()
+                cur.execute("DELETE FROM {0} WHERE sid = 12".format(
+                    pg.tables['member']))
+                pg.commit()
+                memoizer.memo['members'].discard(12)
+                memoizer.caches['member'].clear()
+                bitcointalk.responseCache.clear()
+                bitcointalk.validators["action=profile;u=12"] = {
+                    'etag': '"dummy_profile.html"'}
+                countRequestedStart = bitcointalk.countRequested
+                self.assertEqual(scrape(12)['name'], "nanaimogold")
+                self.assertEqual(
+                    bitcointalk.countRequested - countRequestedStart, 2)
+                self.assertTrue(12 in memoizer.memo['members'])
+        finally:
+            server.shutdown()
+            server.server_close()
+            memoizer.archiveStore.close()
+            shutil.rmtree(memoizer.archivePath)
+            (bitcointalk.baseUrl, bitcointalk.limiter,
+             bitcointalk.conditionalGets, bitcointalk.validators,
+             memoizer.archivePath, memoizer.archiveStore,
+             memoizer.memo) = configOriginal
+            memoizer.caches['member'].clear()
+            writebehind.flush()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import json
+import metrics
+import os
+import shutil
+import socket
+import tempfile
+import urllib.error
+import urllib.request
+
+
+class TestMetrics(unittest.TestCase):
+
+    """"Testing suite for metrics module."""
+
+    def setUp(self):
+        """Start from an empty registry."""
+        self.configOriginal = (metrics.port, metrics.snapshotPath)
+        metrics.reset()
+
+    def tearDown(self):
+        """Stop the exporter and restore the configuration."""
+        metrics.stop()
+        (metrics.port, metrics.snapshotPath) = self.configOriginal
+        metrics.reset()
+
+    def testRender(self):
+        """Test counters and histograms in the Prometheus text format."""
+        metrics.increment('fetch_bytes_total', 100, endpoint="topic")
+        metrics.increment('fetch_bytes_total', 50, endpoint="topic")
+        metrics.observe('fetch_seconds', 0.2, endpoint="topic", status=200)
+        metrics.observe('fetch_seconds', 100, endpoint="topic", status=200)
+        with self.assertRaises(ValueError):
+            with metrics.timer('parse_seconds', entity='say "hi"'):
+                raise ValueError()
+        lines = metrics.render().splitlines()
+        self.assertTrue("# TYPE bitcointalk_fetch_bytes_total counter"
+                        in lines)
+        self.assertTrue('bitcointalk_fetch_bytes_total{endpoint="topic"} 150'
+                        in lines)
+        self.assertTrue("# TYPE bitcointalk_fetch_seconds histogram" in lines)
+        self.assertTrue('bitcointalk_fetch_seconds_bucket{endpoint="topic",'
+                        'status="200",le="0.1"} 0' in lines)
+        self.assertTrue('bitcointalk_fetch_seconds_bucket{endpoint="topic",'
+                        'status="200",le="0.25"} 1' in lines)
+        self.assertTrue('bitcointalk_fetch_seconds_bucket{endpoint="topic",'
+                        'status="200",le="60.0"} 1' in lines)
+        self.assertTrue('bitcointalk_fetch_seconds_bucket{endpoint="topic",'
+                        'status="200",le="+Inf"} 2' in lines)
+        self.assertTrue('bitcointalk_fetch_seconds_sum{endpoint="topic",'
+                        'status="200"} 100.2' in lines)
+        self.assertTrue('bitcointalk_fetch_seconds_count{endpoint="topic",'
+                        'status="200"} 2' in lines)
+        self.assertTrue('bitcointalk_parse_seconds_count'
+                        '{entity="say \\"hi\\""} 1' in lines)
+
+    def testExport(self):
+        """Test the /metrics endpoint and the JSON snapshot."""
+        path = tempfile.mkdtemp()
+        metrics.port = 0
+        metrics.snapshotPath = "{0}/metrics.json".format(path)
+        try:
+            port = metrics.start()
+            metrics.increment('memo_total', entity="member", result="hit")
+            url = "http://127.0.0.1:{0}/metrics".format(port)
+            body = urllib.request.urlopen(url).read().decode('utf-8')
+            self.assertEqual(body, metrics.render())
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url[:-len("metrics")])
+
+            metrics.stop()
+            f = open(metrics.snapshotPath)
+            snapshot = json.load(f)
+            f.close()
+            self.assertEqual(snapshot['counters'], [{
+                'name': 'memo_total',
+                'labels': {'entity': "member", 'result': "hit"},
+                'value': 1}])
+            self.assertEqual(snapshot['histograms'], [])
+            self.assertFalse(os.path.exists(metrics.snapshotPath + ".tmp"))
+        finally:
+            shutil.rmtree(path)
+
+    def testPortInUse(self):
+        """Test that a taken port skips the endpoint but not the snapshot."""
+        path = tempfile.mkdtemp()
+        taken = socket.socket()
+        taken.bind(("127.0.0.1", 0))
+        taken.listen(1)
+        metrics.port = taken.getsockname()[1]
+        metrics.snapshotPath = "{0}/metrics.json".format(path)
+        try:
+            self.assertEqual(metrics.start(), None)
+            metrics.stop()
+            self.assertTrue(os.path.exists(metrics.snapshotPath))
+        finally:
+            taken.close()
+            shutil.rmtree(path)
+
+if __name__ == "__main__":
+    unittest.main()
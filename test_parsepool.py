@@ -0,0 +1,61 @@
+import unittest
+import bitcointalk
+import codecs
+from datetime import date
+import os
+import parsepool
+
+
+def _readDummy(name):
+    """Read one of the dummy/ fixtures."""
+    f = codecs.open("{0}/dummy/{1}".format(
+        os.path.dirname(os.path.abspath(__file__)), name), 'r', 'utf-8')
+    html = f.read()
+    f.close()
+    return html
+
+
+class TestParsePool(unittest.TestCase):
+
+    """"Testing suite for parsepool module."""
+
+    def tearDown(self):
+        """Make sure no pool outlives a test."""
+        parsepool.stop()
+
+    def testInline(self):
+        """Test parsing without a worker pool."""
+        html = _readDummy("dummy_board_2.html")
+        self.assertIsNone(parsepool.pool)
+        self.assertEqual(
+            parsepool.parse('board', html), bitcointalk.parseBoardPage(html))
+
+    def testPool(self):
+        """Test that worker processes return the same records."""
+        parsepool.start(2)
+        todaysDate = date(2014, 7, 29)
+        pages = [
+            ('board', _readDummy("dummy_board_1.html"), ()),
+            ('member', _readDummy("dummy_profile.html"), (todaysDate,)),
+            ('topic', _readDummy("dummy_topic.html"), (todaysDate,)),
+            ('topic', _readDummy("dummy_topic_2.html"), (todaysDate,))
+        ]
+        futures = [parsepool.submit(entity, html, *args)
+                   for entity, html, args in pages]
+        for (entity, html, args), future in zip(pages, futures):
+            self.assertEqual(
+                future.result(), parsepool.parsers[entity](html, *args))
+        self.assertEqual(
+            parsepool.parse('member', pages[1][1], todaysDate)['id'], 12)
+
+    def testErrors(self):
+        """Test that parse errors reach the caller, with or without a pool."""
+        html = _readDummy("dummy_profile.html")
+        with self.assertRaises(bitcointalk.ParseInvalidError):
+            parsepool.parse('topic', html)
+        parsepool.start(1)
+        with self.assertRaises(bitcointalk.ParseInvalidError):
+            parsepool.parse('topic', html)
+
+if __name__ == "__main__":
+    unittest.main()
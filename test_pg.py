@@ -1,8 +1,11 @@
 import unittest
 from datetime import date
+from datetime import datetime
 import bitcointalk
 import codecs
 import os
+import pg
+import threading
 from pg import *
 
 
@@ -18,6 +21,7 @@ class TestPg(unittest.TestCase):
         tables = {}
         for key, table in self.tablesOriginal.items():
             tables[key] = "{0}_test".format(table)
+        pg.tables = tables
 
         # Create test tables
         cur = cursor()
@@ -39,6 +43,7 @@ class TestPg(unittest.TestCase):
 
         # Undo swap / sub
         tables = self.tablesOriginal
+        pg.tables = tables
 
     def testBoard(self):
         """Test insert and select board functions."""
@@ -54,6 +59,87 @@ class TestPg(unittest.TestCase):
         selectDatum = selectBoard(74)
         self.assertEqual(datum, selectDatum)
 
+    def testConnectionPool(self):
+        """Test that threads query concurrently on their own connections."""
+        f = codecs.open("{0}/dummy/dummy_board_2.html".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r', 'utf-8')
+        html = f.read()
+        f.close()
+        datum = bitcointalk.parseBoardPage(html)
+        del datum["topic_ids"]
+        insertBoard(datum)
+        insertBoards([dict(datum, id=75), dict(datum, id=76)])
+
+        results = {}
+        barrier = threading.Barrier(3)
+
+        def worker(boardId):
+            results[boardId] = (connect(), selectBoard(boardId))
+            # Hold the connection until every thread has one
+            barrier.wait()
+            release()
+        threads = [threading.Thread(target=worker, args=(boardId,))
+                   for boardId in (74, 75, 76)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results.keys()), [74, 75, 76])
+        connections = [conn for conn, selectDatum in results.values()]
+        self.assertEqual(len(set(map(id, connections))), 3)
+        self.assertFalse(connect() in connections)
+        for boardId, (conn, selectDatum) in results.items():
+            self.assertEqual(selectDatum, dict(datum, id=boardId))
+
+        # Batches are selected by array parameter, ignoring duplicate IDs
+        selectData = pg._selectBatch([76, 74, 76], 'board')
+        self.assertEqual([row['id'] for row in selectData], [74, 76])
+        with self.assertRaises(Exception):
+            pg._selectBatch([74, 77], 'board')
+
+    def testSelectIds(self):
+        """Test that IDs stream back in ascending chunks."""
+        f = codecs.open("{0}/dummy/dummy_board_2.html".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r', 'utf-8')
+        html = f.read()
+        f.close()
+        datum = bitcointalk.parseBoardPage(html)
+        del datum["topic_ids"]
+        insertBoards([dict(datum, id=boardId) for boardId in (9, 3, 5, 1, 7)])
+        self.assertEqual(list(selectIds('board', chunkSize=2)),
+                         [[1, 3], [5, 7], [9]])
+        self.assertEqual(list(selectIds('member')), [])
+
+        # Only rows updated since the mark are streamed
+        since = currentTime()
+        insertBoards([dict(datum, id=4), dict(datum, id=9, name="Renamed")])
+        self.assertEqual(list(selectIds('board', since=since)), [[4, 9]])
+
+        # Streaming leaves the caller's open transaction uncommitted
+        commit()
+        insertBoards([dict(datum, id=2)], commit=False)
+        self.assertEqual(list(selectIds('board', chunkSize=2)),
+                         [[1, 3], [4, 5], [7, 9]])
+        connect().rollback()
+        self.assertEqual(list(selectIds('board')), [[1, 3, 4, 5, 7, 9]])
+
+    def testSelectTopicStates(self):
+        """Test that states stream without touching the open transaction."""
+        state = {'id': 14, 'num_pages': 1, 'last_page': 1,
+                 'last_position': 5, 'count_read': 2, 'change_rate': 0.5,
+                 'crawl_time': None, 'change_time': None}
+        insertTopicStates([state])
+        commit()
+        insertTopicStates([dict(state, id=15)], commit=False)
+        conn = connect()
+        self.assertEqual(list(selectTopicStates()), [state])
+        self.assertTrue(connect() is conn)
+        commit()
+        self.assertEqual(sorted(datum['id'] for datum in
+                                selectTopicStates()), [14, 15])
+        with separateTransaction() as other:
+            self.assertFalse(other is conn)
+
     def testMember(self):
         """Test insert and select member functions."""
         f = codecs.open("{0}/dummy/dummy_profile.html".format(
@@ -93,6 +179,39 @@ class TestPg(unittest.TestCase):
         datum = data[0]
         self.assertEqual(data, selectData)
 
+    def testMessagesCopy(self):
+        """Test that batches survive COPY escaping and share a commit."""
+        message = {
+            'id': 1,
+            'topic': 14,
+            'topic_position': 1,
+            'member': 16,
+            'post_time': datetime(2009, 12, 12, 14, 11, 37),
+            'subject': 'Tabs\tand\nnewlines',
+            'link': None,
+            'content': b'<b>back\\slash</b>\r\n',
+            'content_no_html': u'back\\slash \u00e9',
+            'content_no_quote': b'<b>back\\slash</b>\r\n',
+            'content_no_quote_no_html': u'back\\slash \u00e9'
+        }
+        otherPage = dict(message, id=2, topic_position=21)
+        insertMessages([message, dict(message)], commit=False)
+        insertMessages([otherPage], commit=False)
+        commit()
+        cur = dictCursor()
+        cur.execute("""SELECT sid, subject, link, content, content_no_html
+            FROM {0}
+            WHERE sid IN (1, 2)
+            ORDER BY sid""".format(tables['message']))
+        rows = cur.fetchall()
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0], {
+            'sid': 1,
+            'subject': 'Tabs\tand\nnewlines',
+            'link': None,
+            'content': '<b>back\\slash</b>\r\n',
+            'content_no_html': u'back\\slash \u00e9'})
+
     def testTopic(self):
         """Test insert and select topic functions."""
         f = codecs.open("{0}/dummy/dummy_topic.html".format(
@@ -101,6 +220,7 @@ class TestPg(unittest.TestCase):
         f.close()
         datum = bitcointalk.parseTopicPage(html)
         del datum['messages']
+        del datum['all_view']
         insertTopic(datum)
         # Make sure a second insert doesn't cause problems
         insertTopic(datum)
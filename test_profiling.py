@@ -0,0 +1,90 @@
+import unittest
+import bitcointalk
+import codecs
+import os
+import parsepool
+import profiling
+import shutil
+import tempfile
+
+
+def _parseTwice(html):
+    """Stand-in hot path calling a profiled parser from inside itself."""
+    parsepool.parse('topic', html)
+    return bitcointalk.parseTopicPage(html)
+
+
+class TestProfiling(unittest.TestCase):
+
+    """"Testing suite for profiling module."""
+
+    def setUp(self):
+        """Profile every call into a scratch directory."""
+        self.configOriginal = (profiling.enabled, profiling.targets,
+                               profiling.sampleRate, profiling.outputPath)
+        profiling.enabled = False
+        profiling.targets = [('bitcointalk', 'parseTopicPage'),
+                             (__name__, '_parseTwice')]
+        profiling.sampleRate = 1.0
+        profiling.outputPath = tempfile.mkdtemp()
+        f = codecs.open("{0}/dummy/dummy_topic.html".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r', 'utf-8')
+        self.html = f.read()
+        f.close()
+
+    def tearDown(self):
+        """Unwrap the targets and restore the configuration."""
+        profiling.uninstall()
+        shutil.rmtree(profiling.outputPath)
+        (profiling.enabled, profiling.targets,
+         profiling.sampleRate, profiling.outputPath) = self.configOriginal
+
+    def testInstall(self):
+        """Test that wrapping is opt-in and fully undone."""
+        parser = bitcointalk.parseTopicPage
+        self.assertFalse(profiling.install())
+        self.assertTrue(profiling.install(force=True))
+        self.assertTrue(bitcointalk.parseTopicPage.__wrapped__ is parser)
+        self.assertTrue(parsepool.parsers['topic'] is
+                        bitcointalk.parseTopicPage)
+        profiling.uninstall()
+        self.assertTrue(bitcointalk.parseTopicPage is parser)
+        self.assertTrue(parsepool.parsers['topic'] is parser)
+
+    def testSample(self):
+        """Test sampling, the nesting guard and the written results."""
+        profiling.install(force=True)
+        expected = bitcointalk.parseTopicPage(self.html)
+        self.assertEqual(_parseTwice(self.html), expected)
+        self.assertEqual(parsepool.parse('topic', self.html), expected)
+        stats = profiling.stats['bitcointalk.parseTopicPage']
+        # Calls made while another sample runs are counted, not profiled
+        self.assertEqual(stats['calls'], 4)
+        self.assertEqual(stats['samples'], 2)
+        self.assertTrue(stats['peak'] > 0)
+        self.assertTrue(len(stats['allocations']) > 0)
+        self.assertEqual(profiling.stats["{0}._parseTwice".format(
+            __name__)]['samples'], 1)
+
+        profiling.sampleRate = 0
+        bitcointalk.parseTopicPage(self.html)
+        self.assertEqual(stats['calls'], 5)
+        self.assertEqual(stats['samples'], 2)
+
+        self.assertTrue(profiling.dump())
+        files = sorted(os.listdir(profiling.outputPath))
+        self.assertEqual(files, sorted([
+            "bitcointalk.parseTopicPage.{0}.prof".format(os.getpid()),
+            "report.{0}.txt".format(os.getpid()),
+            "{0}._parseTwice.{1}.prof".format(__name__, os.getpid())]))
+        f = codecs.open("{0}/report.{1}.txt".format(
+            profiling.outputPath, os.getpid()), 'r', 'utf-8')
+        report = f.read()
+        f.close()
+        self.assertTrue("bitcointalk.parseTopicPage: 5 calls, 2 sampled"
+                        in report)
+        self.assertTrue("Top allocation sites" in report)
+        self.assertTrue("bitcointalk.py" in report)
+
+if __name__ == "__main__":
+    unittest.main()
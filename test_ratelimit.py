@@ -0,0 +1,93 @@
+import unittest
+import asyncio
+import threading
+from ratelimit import *
+
+
+class _Clock(object):
+
+    """Manually advanced clock for deterministic tests."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    """"Testing suite for ratelimit module."""
+
+    def setUp(self):
+        """Setup a bucket on a manual clock."""
+        self.clock = _Clock()
+        self.bucket = TokenBucket(
+            rate=2.0, burst=3, minRate=0.5, maxRate=4.0, increase=0.5,
+            decrease=0.5, latencyTarget=1.0, cooldown=10.0, clock=self.clock)
+
+    def testBurst(self):
+        """Test that a full bucket serves a burst without waiting."""
+        waits = [self.bucket.reserve() for i in range(5)]
+        self.assertEqual(waits, [0, 0, 0, 0.5, 1.0])
+
+    def testRefill(self):
+        """Test that tokens accrue at the configured rate up to burst."""
+        for i in range(3):
+            self.bucket.reserve()
+        self.clock.now = 1.0
+        self.assertEqual(self.bucket.reserve(), 0)
+        self.assertEqual(self.bucket.reserve(), 0)
+        self.assertEqual(self.bucket.reserve(), 0.5)
+        self.clock.now = 100.0
+        waits = [self.bucket.reserve() for i in range(4)]
+        self.assertEqual(waits, [0, 0, 0, 0.5])
+
+    def testThreads(self):
+        """Test that concurrent reservations share one budget."""
+        waits = []
+        lock = threading.Lock()
+
+        def reserve():
+            wait = self.bucket.reserve()
+            with lock:
+                waits.append(wait)
+        threads = [threading.Thread(target=reserve) for i in range(13)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(
+            sorted(waits), [0, 0, 0] + [0.5 * i for i in range(1, 11)])
+
+    def testAdditiveIncrease(self):
+        """Test that successful requests raise the rate up to maxRate."""
+        self.assertEqual(self.bucket.observe(200, 0.2), 2.5)
+        for i in range(10):
+            self.bucket.observe(200, 0.2)
+        self.assertEqual(self.bucket.rate, 4.0)
+
+    def testMultiplicativeDecrease(self):
+        """Test that throttling and slow responses cut the rate."""
+        self.assertEqual(self.bucket.observe(429, 0.2), 1.0)
+        # A burst of failures within the cooldown backs off only once
+        self.assertEqual(self.bucket.observe(503, 0.2), 1.0)
+        self.clock.now = 11.0
+        self.assertEqual(self.bucket.observe(200, 3.0), 0.5)
+        self.clock.now = 22.0
+        self.assertEqual(self.bucket.observe(429, 0.2), 0.5)
+        self.assertEqual(self.bucket.reserve(), 2.0)
+
+    def testAcquireAsync(self):
+        """Test waiting for tokens from async tasks."""
+        bucket = TokenBucket(rate=50.0, burst=1)
+
+        async def acquireAll():
+            return await asyncio.gather(
+                *[bucket.acquireAsync() for i in range(3)])
+        waits = asyncio.run(acquireAll())
+        self.assertEqual(waits[0], 0)
+        self.assertEqual(len([wait for wait in waits if wait > 0]), 2)
+
+if __name__ == "__main__":
+    unittest.main()
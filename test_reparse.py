@@ -0,0 +1,129 @@
+import unittest
+import archive
+import bitcointalk
+import codecs
+from datetime import date
+import os
+import pg
+import shutil
+import tempfile
+from reparse import *
+
+
+def _readDummy(name):
+    """Read one of the dummy/ fixtures."""
+    f = codecs.open("{0}/dummy/{1}".format(
+        os.path.dirname(os.path.abspath(__file__)), name), 'r', 'utf-8')
+    html = f.read()
+    f.close()
+    return html
+
+
+class TestReparse(unittest.TestCase):
+
+    """"Testing suite for reparse module."""
+
+    def setUp(self):
+        """Setup saved pages and test tables."""
+        self.path = tempfile.mkdtemp()
+        # 1406592000 is 2014-07-29, the day the dummy profile was fetched
+        pages = {
+            "member_12_1406592000.html": "dummy_profile.html",
+            "member_12_1306592000.html": "dummy_profile.html",
+            "topic_14_1406592000.html": "dummy_topic.html",
+            "board_74_1406592000.html": "dummy_board_2.html",
+            "boardpage_5.600_1406592000.html": "dummy_board_1.html",
+            "test_dummy_topic.html": "dummy_topic.html"
+        }
+        for name, fixture in pages.items():
+            f = codecs.open(os.path.join(self.path, name), 'w', 'utf-8')
+            f.write(_readDummy(fixture))
+            f.close()
+
+        # Swap and sub tables
+        self.tablesOriginal = pg.tables
+        pg.tables = {}
+        for key, table in self.tablesOriginal.items():
+            pg.tables[key] = "{0}_test".format(table)
+        cur = pg.cursor()
+        for key, table in pg.tables.items():
+            cur.execute("""CREATE TABLE IF NOT EXISTS
+                {0} (LIKE {1} INCLUDING ALL)""".format(
+                table, self.tablesOriginal[key]))
+        cur.execute("""COMMIT""")
+
+    def tearDown(self):
+        """Teardown saved pages and test tables."""
+        shutil.rmtree(self.path)
+        cur = pg.cursor()
+        for table in pg.tables.values():
+            cur.execute("""DROP TABLE IF EXISTS
+                {0}""".format(table))
+        cur.execute("""COMMIT""")
+        pg.tables = self.tablesOriginal
+
+    def testFindFiles(self):
+        """Test recognising the files written by memoizer._saveToFile."""
+        files = sorted(page[:4] for page in findFiles(self.path))
+        self.assertEqual(files, [
+            ('board', 74, 0, 1406592000),
+            ('boardpage', 5, 600, 1406592000),
+            ('member', 12, 0, 1306592000),
+            ('member', 12, 0, 1406592000),
+            ('topic', 14, 0, 1406592000)])
+
+    def testFindPages(self):
+        """Test picking the latest copy across files and the archive."""
+        store = archive.Archive(os.path.join(self.path, "archive"))
+        store.append("member", 12, _readDummy("dummy_profile.html"),
+                     fetchTime=1406000000)
+        store.append("topicpage", 14, _readDummy("dummy_topic.html"), 0,
+                     1406000000)
+        pages = findPages(self.path, store)
+        self.assertEqual(sorted(pages.keys()), [
+            ('board', 74, 0),
+            ('member', 12, 0),
+            ('topic', 14, 0),
+            ('topicpage', 14, 0)])
+        self.assertEqual(pages[('member', 12, 0)], (
+            1406592000,
+            os.path.join(self.path, "member_12_1406592000.html")))
+        self.assertEqual(pages[('topicpage', 14, 0)], (1406000000, store))
+        self.assertEqual(
+            list(findPages(self.path, store, ['member']).keys()),
+            [('member', 12, 0)])
+        store.close()
+
+    def testRun(self):
+        """Test re-parsing saved pages into the database."""
+        self.assertEqual(run(self.path, processes=2), 3)
+        self.assertEqual(
+            pg.selectMember(12),
+            bitcointalk.parseProfile(
+                _readDummy("dummy_profile.html"), date(2014, 7, 29)))
+        self.assertEqual(pg.selectTopic(14)['count_read'], 3051)
+        self.assertEqual(pg.selectBoard(74)['name'], 'Legal')
+        cur = pg.cursor()
+        cur.execute("SELECT COUNT(*) FROM {0}".format(pg.tables['message']))
+        self.assertEqual(cur.fetchone()[0], 2)
+
+    def testRunRejected(self):
+        """Test that a page the DB rejects does not sink later pages."""
+        f = codecs.open(os.path.join(
+            self.path, "topicpage_602041.12400_1406592000.html"), 'w',
+            'utf-8')
+        f.write(_readDummy("dummy_topic_2.html"))
+        f.close()
+        cur = pg.cursor()
+        cur.execute("""ALTER TABLE {0} ADD CHECK (topic <> 14)""".format(
+            pg.tables['message']))
+        pg.commit()
+        self.assertEqual(run(self.path, processes=2), 3)
+        cur = pg.cursor()
+        cur.execute("SELECT DISTINCT topic FROM {0}".format(
+            pg.tables['message']))
+        self.assertEqual(cur.fetchall(), [(602041,)])
+        pg.commit()
+
+if __name__ == "__main__":
+    unittest.main()
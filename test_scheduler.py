@@ -0,0 +1,75 @@
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import unittest
+import scheduler
+from scheduler import *
+
+
+class TestScheduler(unittest.TestCase):
+
+    """"Testing suite for scheduler module."""
+
+    def setUp(self):
+        """Setup a fixed start time."""
+        self.start = datetime(2014, 7, 29, tzinfo=timezone.utc)
+
+    def _state(self, previous, countRead, lastPosition, hours):
+        """Observe a crawl some hours after the start."""
+        state = {'last_position': lastPosition}
+        state.update(observe(previous, countRead, lastPosition,
+                             self.start + timedelta(hours=hours)))
+        return state
+
+    def testObserve(self):
+        """Test that busy topics get a higher change rate than quiet ones."""
+        first = self._state(None, 100, 10, 0)
+        self.assertEqual(first['change_rate'], scheduler.defaultRate)
+        self.assertEqual(first['change_time'], self.start)
+
+        busy = self._state(first, 200, 50, 24)
+        quiet = self._state(first, 101, 10, 24)
+        self.assertTrue(busy['change_rate'] > first['change_rate'])
+        self.assertTrue(quiet['change_rate'] <= first['change_rate'])
+        self.assertEqual(busy['change_time'], self.start + timedelta(hours=24))
+        self.assertEqual(quiet['change_time'], self.start)
+
+        # Quiet topics keep cooling off the longer nothing is posted
+        quieter = self._state(quiet, 101, 10, 24 * 30)
+        self.assertTrue(quieter['change_rate'] < quiet['change_rate'])
+        self.assertTrue(probability(quieter, quieter['crawl_time']) == 0)
+        self.assertTrue(probability(busy, busy['crawl_time'] +
+                                    timedelta(hours=24)) >
+                        probability(quieter, quieter['crawl_time'] +
+                                    timedelta(hours=24)))
+
+    def testOrder(self):
+        """Test that new topics come first, then the likeliest changed."""
+        queue = Scheduler(minInterval=0, maxInterval=365 * 86400.0)
+        first = self._state(None, 100, 10, 0)
+        busy = self._state(first, 200, 50, 24)
+        quiet = self._state(first, 101, 10, 24)
+        queue.push(1, quiet)
+        queue.push(2, busy)
+        queue.push(3)
+        queue.push(4, quiet)
+        queue.push(4, busy)
+        self.assertEqual(len(queue), 4)
+        self.assertEqual(queue.pop(), (3, 0.0))
+        self.assertEqual(queue.peek(), (2, queue.dueTime(busy)))
+        self.assertEqual(sorted([queue.pop()[0], queue.pop()[0]]), [2, 4])
+        self.assertEqual(queue.pop()[0], 1)
+        with self.assertRaises(IndexError):
+            queue.pop()
+
+    def testBounds(self):
+        """Test that intervals stay between minInterval and maxInterval."""
+        queue = Scheduler(minInterval=600.0, maxInterval=86400.0)
+        state = {'crawl_time': self.start, 'change_rate': 1.0}
+        self.assertEqual(queue.dueTime(state), self.start.timestamp() + 600)
+        state['change_rate'] = 1e-9
+        self.assertEqual(queue.dueTime(state), self.start.timestamp() + 86400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+import unittest
+import bitcointalk
+import codecs
+from datetime import date
+import os
+import pg
+import writebehind
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    """"Testing suite for writebehind module."""
+
+    def setUp(self):
+        """Setup tables, thresholds and a parsed member for test."""
+        # Swap and sub tables
+        self.tablesOriginal = pg.tables
+        pg.tables = {}
+        for key, table in self.tablesOriginal.items():
+            pg.tables[key] = "{0}_test".format(table)
+        cur = pg.cursor()
+        for key, table in pg.tables.items():
+            cur.execute("""CREATE TABLE IF NOT EXISTS
+                {0} (LIKE {1} INCLUDING ALL)""".format(
+                table, self.tablesOriginal[key]))
+        cur.execute("""COMMIT""")
+
+        # Swap thresholds and clock
+        self.configOriginal = (writebehind.maxRows, writebehind.maxAge,
+                               writebehind.clock)
+        self.now = 0.0
+        writebehind.clock = lambda: self.now
+        writebehind.maxRows = 3
+        writebehind.maxAge = 30.0
+
+        f = codecs.open("{0}/dummy/dummy_profile.html".format(
+            os.path.dirname(os.path.abspath(__file__))), 'r', 'utf-8')
+        self.member = bitcointalk.parseProfile(f.read(), date(2014, 7, 29))
+        f.close()
+
+    def tearDown(self):
+        """Teardown tables and restore thresholds."""
+        for rows in writebehind.buffers.values():
+            rows.clear()
+        writebehind._firstBuffered = None
+        (writebehind.maxRows, writebehind.maxAge,
+         writebehind.clock) = self.configOriginal
+        cur = pg.cursor()
+        for table in pg.tables.values():
+            cur.execute("""DROP TABLE IF EXISTS
+                {0}""".format(table))
+        cur.execute("""COMMIT""")
+        pg.tables = self.tablesOriginal
+
+    def _count(self, tableLabel):
+        """Count the rows that reached the database."""
+        cur = pg.cursor()
+        cur.execute("SELECT COUNT(*) FROM {0}".format(pg.tables[tableLabel]))
+        return cur.fetchone()[0]
+
+    def testPendingAndFlush(self):
+        """Test that rows are served from the buffer until flushed."""
+        writebehind.add('member', self.member)
+        self.assertEqual(self._count('member'), 0)
+        self.assertEqual(writebehind.pending('member', 12), self.member)
+        self.assertIsNone(writebehind.pending('member', 13))
+        self.assertEqual(writebehind.flush(), 1)
+        self.assertIsNone(writebehind.pending('member', 12))
+        self.assertEqual(pg.selectMember(12), self.member)
+        self.assertEqual(writebehind.flush(), 0)
+
+    def testSizeThreshold(self):
+        """Test flushing once enough rows are buffered."""
+        writebehind.add('member', self.member)
+        # Rewriting a buffered row does not grow the buffer
+        writebehind.add('member', dict(self.member, name='renamed'))
+        writebehind.add('member', dict(self.member, id=13))
+        self.assertEqual(self._count('member'), 0)
+        writebehind.add('topic', {
+            'id': 14, 'name': 'Topic', 'board': 7, 'num_pages': 1,
+            'count_read': 3051})
+        self.assertEqual(self._count('member'), 2)
+        self.assertEqual(self._count('topic'), 1)
+        self.assertEqual(pg.selectMember(12)['name'], 'renamed')
+
+    def testAgeThreshold(self):
+        """Test flushing once the oldest buffered row is too old."""
+        writebehind.add('member', self.member)
+        self.now = 29.0
+        writebehind.add('member', dict(self.member, id=13))
+        self.assertEqual(self._count('member'), 0)
+        self.now = 31.0
+        writebehind.add('board', {
+            'id': 74, 'name': 'Legal', 'container': 'Bitcoin', 'parent': 1,
+            'num_pages': 23})
+        self.assertEqual(self._count('member'), 2)
+        self.assertEqual(self._count('board'), 1)
+
+        # Loops that stop adding rows still flush old ones
+        writebehind.add('member', dict(self.member, id=15))
+        self.now = 60.0
+        self.assertEqual(writebehind.flushIfDue(), 0)
+        self.now = 62.0
+        self.assertEqual(writebehind.flushIfDue(), 1)
+        self.assertEqual(self._count('member'), 3)
+
+    def testSkipUnchanged(self):
+        """Test that rewriting an unchanged row leaves it untouched."""
+        writebehind.add('member', self.member)
+        writebehind.flush()
+        cur = pg.cursor()
+        cur.execute("SELECT db_update_time FROM {0}".format(
+            pg.tables['member']))
+        updateTime = cur.fetchone()[0]
+        pg.commit()
+        writebehind.add('member', self.member)
+        writebehind.flush()
+        cur.execute("SELECT db_update_time FROM {0}".format(
+            pg.tables['member']))
+        self.assertEqual(cur.fetchone()[0], updateTime)
+        pg.commit()
+        writebehind.add('member', dict(self.member, position='Legendary'))
+        writebehind.flush()
+        cur.execute("SELECT db_update_time FROM {0}".format(
+            pg.tables['member']))
+        self.assertTrue(cur.fetchone()[0] > updateTime)
+
+    def testSeparateTransaction(self):
+        """Test that a flush leaves the caller's open transaction alone."""
+        message = {
+            'id': 1, 'topic': 14, 'topic_position': 1, 'member': 12,
+            'post_time': None, 'subject': 'Hi', 'link': None,
+            'content': b'Hi', 'content_no_html': 'Hi',
+            'content_no_quote': b'Hi', 'content_no_quote_no_html': 'Hi'}
+        # A bare COMMIT statement leaves psycopg2 outside any transaction
+        pg.commit()
+        pg.insertMessages([message], commit=False)
+        writebehind.add('member', self.member)
+        self.assertEqual(writebehind.flush(), 1)
+        pg.connect().rollback()
+        self.assertEqual(self._count('message'), 0)
+        self.assertEqual(self._count('member'), 1)
+        pg.commit()
+
+        # A failed flush leaves the caller's rows alone too
+        pg.insertMessages([message], commit=False)
+        writebehind.add('member', dict(self.member, id=13, bogus=1))
+        self.assertEqual(writebehind.flush(), 0)
+        pg.commit()
+        self.assertEqual(self._count('message'), 1)
+
+    def testBadRow(self):
+        """Test that a row the DB rejects is dropped, not retried forever."""
+        writebehind.add('member', self.member)
+        writebehind.add('member', dict(self.member, id=13, name='x' * 300))
+        writebehind.add('topic', {
+            'id': 14, 'name': 'Topic', 'board': 7, 'num_pages': 1,
+            'count_read': 3051})
+        self.assertEqual(self._count('member'), 1)
+        self.assertEqual(self._count('topic'), 1)
+        self.assertIsNone(writebehind.pending('member', 13))
+        # Later rows are not held back by it
+        writebehind.add('member', dict(self.member, id=15))
+        self.assertEqual(writebehind.flush(), 1)
+        self.assertEqual(self._count('member'), 2)
+
+if __name__ == "__main__":
+    unittest.main()
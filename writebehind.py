@@ -0,0 +1,125 @@
+""" Module for buffering entity writes and flushing them as group commits. """
+import atexit
+import logging
+import pg
+import psycopg2
+import threading
+import time
+
+# Flush once this many rows are buffered, or the oldest is this many seconds old
+maxRows = 500
+maxAge = 30.0
+clock = time.monotonic
+
+inserters = {
+    'board': pg.insertBoards,
+    'member': pg.insertMembers,
+    'topic': pg.insertTopics,
+    'topic_state': pg.insertTopicStates
+}
+
+# Buffered rows by table label, keyed by entity ID so later writes win
+buffers = {
+    'board': {},
+    'member': {},
+    'topic': {},
+    'topic_state': {}
+}
+_firstBuffered = None
+_lock = threading.RLock()
+
+
+def add(tableLabel, datum):
+    """Buffer a row, flushing if the size or age threshold is reached."""
+    global _firstBuffered
+    with _lock:
+        buffers[tableLabel][datum['id']] = dict(datum)
+        if _firstBuffered is None:
+            _firstBuffered = clock()
+        size = sum(len(rows) for rows in buffers.values())
+        if size >= maxRows:
+            flush()
+        else:
+            flushIfDue()
+
+
+def flushIfDue():
+    """Flush if the oldest buffered row reached the age threshold."""
+    """CAVEAT: Call it from loops that may go a while without adding rows."""
+    with _lock:
+        if _firstBuffered is not None and clock() - _firstBuffered >= maxAge:
+            return flush()
+        return 0
+
+
+def pending(tableLabel, datumId):
+    """Pull a row that is buffered but not yet flushed, or None."""
+    with _lock:
+        datum = buffers[tableLabel].get(datumId)
+        return None if datum is None else dict(datum)
+
+
+def _flushRows(conn):
+    """Write buffered rows one at a time, dropping those that fail."""
+    """CAVEAT: Lost connections still raise, keeping the rows buffered."""
+    dropped = 0
+    for tableLabel, rows in buffers.items():
+        for datumId, datum in list(rows.items()):
+            try:
+                inserters[tableLabel]([datum], commit=False)
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                raise
+            except Exception as e:
+                conn.rollback()
+                logging.error("Dropping buffered {0} {1}: {2}".format(
+                    tableLabel, datumId, e))
+                dropped += 1
+    return dropped
+
+
+def flush():
+    """Write all buffered rows as batched upserts in one transaction."""
+    """CAVEAT: Runs on its own connection, so the caller's open transaction
+    is neither committed nor rolled back."""
+    """CAVEAT: If the batch fails, rows are retried one by one and the
+    ones that still fail are logged and dropped. Returns the rows written."""
+    global _firstBuffered
+    with _lock:
+        size = sum(len(rows) for rows in buffers.values())
+        if size == 0:
+            return 0
+        # Rows the caller left uncommitted stay out of this transaction
+        with pg.separateTransaction() as conn:
+            try:
+                for tableLabel, rows in buffers.items():
+                    if len(rows) > 0:
+                        inserters[tableLabel](list(rows.values()),
+                                              commit=False)
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # Keep the rows buffered so a later flush can retry them
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            except Exception as e:
+                # One bad row must not hold back the rest
+                conn.rollback()
+                logging.warning("Could not flush {0} buffered rows at once, "
+                                "writing them one by one: {1}".format(size, e))
+                size -= _flushRows(conn)
+        logging.info("Flushed {0} buffered rows.".format(size))
+        for rows in buffers.values():
+            rows.clear()
+        _firstBuffered = None
+        return size
+
+
+def _flushAtExit():
+    """Flush on interpreter exit, including after an uncaught exception."""
+    try:
+        flush()
+    except Exception as e:
+        logging.error("Could not flush buffered rows at exit: {0}".format(e))
+
+atexit.register(_flushAtExit)